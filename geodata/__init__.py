@@ -1,9 +1,14 @@
 
 from .geodata import *
 from .join_goes_merra2 import *
+from .joined_h5 import *
+from .join_engine import *
 from .stopwatch import *
+from .metrics import *
+from .partition import *
+from .modis import *
 # from join_goes_merra2 import join_goes_and_m2_to_h5
 
-__all__ = ['geodata','modis_coarse_to_fine_geolocation','join_goes_merra2','stopwatch']
+__all__ = ['geodata','modis_coarse_to_fine_geolocation','join_goes_merra2','joined_h5','join_engine','stopwatch','metrics','pystare_instrument','partition','benchmark','synthetic','modis','modis_to_stare']
 
 
@@ -0,0 +1,440 @@
+
+# geodata/benchmark.py
+
+# Benchmarks of the hot paths at a range of sizes, on generated data so
+# that they run offline, with results saved as JSON and compared.
+#
+#   python -m geodata.benchmark run -o base.json --sizes 10000 100000
+#   python -m geodata.benchmark run -o new.json  --sizes 10000 100000
+#   python -m geodata.benchmark compare base.json new.json --threshold 0.1
+#
+# compare exits with status 1 if any benchmark got slower (or used more
+# peak memory) than the threshold allows.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter, process_time, time
+
+import h5py as h5
+import numpy as np
+import pystare as ps
+
+import geodata as gd
+
+try:
+    from geodata.stopwatch import rss_bytes
+    import geodata.joined_h5 as jh5
+    import geodata.join_engine as je
+    import geodata.join_goes_merra2 as jgm
+    import geodata.partition as partition
+    import geodata.modis as modis
+    import geodata.synthetic as synthetic
+    import geodata.modis_coarse_to_fine_geolocation.modis_5km_to_1km_geolocation as modis_5km_to_1km
+    import geodata.modis_coarse_to_fine_geolocation.modis_1km_to_250m_geolocation as modis_1km_to_250m
+except ImportError:
+    from stopwatch import rss_bytes
+    import joined_h5 as jh5
+    import join_engine as je
+    import join_goes_merra2 as jgm
+    import partition
+    import modis
+    import synthetic
+    import modis_coarse_to_fine_geolocation.modis_5km_to_1km_geolocation as modis_5km_to_1km
+    import modis_coarse_to_fine_geolocation.modis_1km_to_250m_geolocation as modis_1km_to_250m
+
+default_sizes = [10000,100000]
+
+###########################################################################
+# Generated inputs.
+
+def random_latlon(size,seed=0,lat_range=(-60.0,60.0),lon_range=(-180.0,180.0)):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(lat_range[0],lat_range[1],size),rng.uniform(lon_range[0],lon_range[1],size)
+
+def swath_latlon(n_along,n_across,lat0=30.0,lon0=-100.0,dlat=0.01,dlon=0.012):
+    "A smooth, slightly skewed swath of n_along x n_across positions."
+    i,j = np.meshgrid(np.arange(n_along),np.arange(n_across),indexing='ij')
+    return lat0+dlat*i+0.1*dlat*j,lon0+dlon*j-0.1*dlon*i
+
+def joined_columns(size,seed=0):
+    "Columns like join_goes_merra2's /image."
+    rng = np.random.default_rng(seed)
+    lat,lon = random_latlon(size,seed)
+    sid = ps.from_latlon(lat,lon,10)
+    return {'stare_spatial':sid
+            ,'stare_temporal':np.full(size,0x007d5c684080008a,dtype=np.int64)
+            ,'goes_src_coord':np.arange(size,dtype=np.int64)
+            ,'goes_b3':rng.integers(0,1024,size)
+            ,'goes_b4':rng.integers(0,1024,size)
+            ,'goes_b5':rng.integers(0,1024,size)
+            ,'merra2_src_coord':rng.integers(-1,size//100+1,size)
+            ,'merra2_tpw':rng.integers(-1,60000,size)}
+
+###########################################################################
+# Benchmarks. Each setup_* prepares its inputs in workdir and returns a
+# function that does the measured work and returns (items,bytes).
+
+def setup_stare_from_latlon(size,workdir):
+    lat,lon = random_latlon(size)
+    def run():
+        sid = ps.from_latlon(lat,lon,10)
+        return size,lat.nbytes+lon.nbytes+sid.nbytes
+    return run
+
+def goes_merra2_inputs(size,workdir):
+    """Synthetic GOES bands 3, 4 and 5 of about size pixels and a full
+    MERRA-2 day in workdir. Returns a join_goes_and_m2 on them."""
+    ny    = max(2,int(np.sqrt(size*5.0/8.0)))
+    files = synthetic.make_dataset(workdir,goes_shape=(ny,max(2,size//ny)))
+    datapath = workdir+os.sep
+    with contextlib.redirect_stdout(io.StringIO()):
+        return jgm.join_goes_and_m2(datapath,files['goes'],datapath,files['merra2'][0],verbose_progress=False)
+
+def close_goes(joiner):
+    "Close the GOES dataset join opened, so that repeats do not pile up open files."
+    if getattr(joiner,'goes_ds',None) is not None and joiner.goes_ds.isopen():
+        joiner.goes_ds.close()
+    return
+
+def setup_join(size,workdir):
+    "join_goes_and_m2.join of size GOES pixels with a MERRA-2 day, from synthetic files."
+    joiner = goes_merra2_inputs(size,workdir)
+    def run():
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                joiner.join()
+        finally:
+            close_goes(joiner)
+        return joiner.m2_src_coord_h5.size,joiner.m2_src_coord_h5.nbytes+joiner.m2_tpw_h5.nbytes
+    return run
+
+def setup_join_to_h5(size,workdir):
+    "join_goes_and_m2.join and to_h5 of size GOES pixels, reading all three bands."
+    joiner   = goes_merra2_inputs(size,workdir)
+    fileName = os.path.join(workdir,'join_to_h5.h5')
+    def run():
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                joiner.join().to_h5(fileName)
+        finally:
+            close_goes(joiner)
+        return joiner.m2_src_coord_h5.size,os.path.getsize(fileName)
+    return run
+
+def setup_join_engine(size,workdir):
+    "A GOES-like scatter of size points joined with a MERRA-2-like grid at about a hundredth the density."
+    lat,lon = random_latlon(size,lat_range=(-50.0,50.0),lon_range=(-150.0,-50.0))
+    goes = je.array_source('goes',ps.from_latlon(lat,lon,10),0,{'b4':np.arange(size,dtype=np.int64)})
+    n    = max(2,int(np.sqrt(size/100.0)))
+    m2_lat,m2_lon = np.meshgrid(np.linspace(-50.0,50.0,n),np.linspace(-150.0,-50.0,n))
+    m2_sid = ps.from_latlon(m2_lat.flatten(),m2_lon.flatten(),5)
+    merra2 = je.array_source('merra2',m2_sid,0,{'tpw':np.linspace(0.0,60.0,m2_sid.size)})
+    def run():
+        joined = je.join_sources([goes,merra2],5)
+        return size,sum(v.nbytes for v in joined.values())
+    return run
+
+def setup_h5_write(layout,**kwargs):
+    def setup(size,workdir):
+        columns  = joined_columns(size)
+        fileName = os.path.join(workdir,'h5_write_%s.h5'%layout)
+        def run():
+            with h5.File(fileName,'w') as workFile:
+                image = jh5.image_writer(workFile,size,layout=layout,**kwargs)
+                for name in jh5.image_dtype.names:
+                    image.write(name,columns[name])
+            return size,os.path.getsize(fileName)
+        return run
+    return setup
+
+def setup_h5_read(layout,columns=('merra2_tpw','goes_b5')):
+    def setup(size,workdir):
+        fileName = os.path.join(workdir,'h5_read_%s.h5'%layout)
+        values   = joined_columns(size)
+        with h5.File(fileName,'w') as workFile:
+            image = jh5.image_writer(workFile,size,layout=layout)
+            for name in jh5.image_dtype.names:
+                image.write(name,values[name])
+        def run():
+            ret = jh5.read_image(fileName,columns=list(columns))
+            return size,sum(v.nbytes for v in ret.values())
+        return run
+    return setup
+
+def partition_inputs(size,workdir,level=5):
+    lat,lon = swath_latlon(max(1,size//100),100)
+    sare    = ps.from_latlon(lat.flatten(),lon.flatten(),10)
+    cover   = np.unique(gd.spatial_clear_to_resolution(gd.spatial_coerce_resolution(sare,level)))
+    vars    = {'src_coord':np.arange(sare.size,dtype=np.int64),'Water_Vapor_Near_Infrared':lat.flatten()}
+    return sare,cover,vars,lat.shape
+
+def setup_sare_partition(size,workdir):
+    sare,cover,vars,shape = partition_inputs(size,workdir)
+    def run():
+        fnames,nmax = partition.write_partitions(cover,'bench',sare,vars,shape,dataset_name='wv_nir',directory=workdir)
+        n = 0
+        for fname in fnames:
+            n += partition.sare_partition(partition.sare_from_fname(fname),'bench',directory=workdir).read1()[2]['sare'].size
+        return n,sum(os.path.getsize(f) for f in fnames)
+    return run
+
+def setup_vds(size,workdir):
+    sare,cover,vars,shape = partition_inputs(size,workdir)
+    fnames,nmax = partition.write_partitions(cover,'bench',sare,vars,shape,dataset_name='wv_nir',directory=workdir)
+    vars_dtype  = partition.sare_partition(partition.sare_from_fname(fnames[0]),'bench',directory=workdir).read1()[3]
+    vds_fname   = os.path.join(workdir,'bench.vds.h5')
+    def run():
+        partition.make_vds(vds_fname,fnames,'wv_nir',nmax,vars_dtype)
+        with h5.File(vds_fname,'r') as f:
+            n = int(np.count_nonzero(f['wv_nir']['src_coord'] >= 0))
+        return n,os.path.getsize(vds_fname)
+    return run
+
+def setup_catalog_scan(size,workdir):
+    "A directory of max(10,size/100) empty GOES and MERRA-2 files, indexed by time."
+    n_files = max(10,size//100)
+    for k in range(n_files):
+        if k % 2 == 0:
+            fname = 'goes10.2005.%03i.%02i%02i15.BAND_0%i.nc'%(1+(k//96)%365,(k//4)%24,15*(k%4),3+k%3)
+        else:
+            fname = 'MERRA2_400.tavg1_2d_slv_Nx.2005%02i%02i.nc4'%(1+(k//28)%12,1+k%28)
+        open(os.path.join(workdir,fname),'w').close()
+    config = {'directory':workdir,'patterns':['goes*.nc','MERRA*.nc4']}
+    def run():
+        catalog = gd.data_catalog(config)
+        index   = catalog.get_tid_centered_index()
+        return len(catalog.get_files()),sum(len(v) for v in index.values())
+    return run
+
+def setup_modis_geolocation(size,workdir):
+    "The scalar 5km to 1km interpolation of size pixels of a synthetic granule."
+    # Whole scans: a scan is 10 lines at 1km, 2 at 5km.
+    n_along_5km = 2*max(1,int(np.ceil(size/(10.0*1354))))
+    lat_5km,lon_5km = swath_latlon(n_along_5km,270,dlat=0.05,dlon=0.06)
+    n_across = 1354
+    n = min(size,5*n_along_5km*n_across)
+    def run():
+        for k in range(n):
+            modis_5km_to_1km.get_1km_pix_pos(k//n_across,k%n_across,lat_5km,lon_5km)
+        return n,16*n
+    return run
+
+def setup_track_field(size,workdir):
+    "A moving track's field on a global grid of size points, 5 grid spacings thick."
+    ny = max(2,int(np.sqrt(size/2.0)))
+    x,y = np.meshgrid(np.linspace(-180.0,180.0,2*ny),np.linspace(-90.0,90.0,ny))
+    t = synthetic.track([0,0,-1.0/90.0],rthick=5*180.0/ny,xyc=[0,45],dxmnmx=[-90,90])
+    def run():
+        f = t.evaluate(x,y,cutoff=10.0)
+        return f.size,f.nbytes
+    return run
+
+def setup_modis_geolocation_granule(size,workdir):
+    "The whole granule 5km to 1km interpolation of size pixels, in whole scans."
+    n_along_5km = 2*max(1,int(np.ceil(size/(10.0*1354))))
+    lat_5km,lon_5km = swath_latlon(n_along_5km,270,dlat=0.05,dlon=0.06)
+    def run():
+        lat,lon = modis_5km_to_1km.get_1km_geolocation(lat_5km,lon_5km)
+        return lat.size,lat.nbytes+lon.nbytes
+    return run
+
+def setup_modis_geolocation_250m(size,workdir):
+    "The 1km to 250m interpolation of size pixels, in whole scans, as float32."
+    n_along_1km = 10*max(1,int(np.ceil(size/(40.0*5416))))
+    lat_1km,lon_1km = swath_latlon(n_along_1km,1354)
+    def run():
+        lat,lon = modis_1km_to_250m.get_250m_geolocation(lat_1km,lon_1km,dtype=np.float32)
+        return lat.size,lat.nbytes+lon.nbytes
+    return run
+
+def setup_modis_geolocation_plan(size,workdir):
+    "The 5km to 1km interpolation of size pixels, in whole scans, with a cached interpolation_plan."
+    n_along_5km = 2*max(1,int(np.ceil(size/(10.0*1354))))
+    lat_5km,lon_5km = swath_latlon(n_along_5km,270,dlat=0.05,dlon=0.06)
+    def run():
+        lat,lon = modis.coarse_to_fine_geolocation(lat_5km,lon_5km,'5km_to_1km')
+        return lat.size,lat.nbytes+lon.nbytes
+    return run
+
+benchmarks = {
+    'stare_from_latlon'          : setup_stare_from_latlon
+    ,'join'                      : setup_join
+    ,'join_to_h5'                : setup_join_to_h5
+    ,'join_engine'               : setup_join_engine
+    ,'h5_write_compound'         : setup_h5_write('compound')
+    ,'h5_write_columnar'         : setup_h5_write('columnar',compression='gzip',shuffle=True)
+    ,'h5_read_compound'          : setup_h5_read('compound')
+    ,'h5_read_columnar'          : setup_h5_read('columnar')
+    ,'sare_partition'            : setup_sare_partition
+    ,'vds'                       : setup_vds
+    ,'catalog_scan'              : setup_catalog_scan
+    ,'modis_geolocation'         : setup_modis_geolocation
+    ,'modis_geolocation_granule' : setup_modis_geolocation_granule
+    ,'modis_geolocation_250m'    : setup_modis_geolocation_250m
+    ,'modis_geolocation_plan'    : setup_modis_geolocation_plan
+    ,'track_field'               : setup_track_field
+}
+
+###########################################################################
+# Running and comparing.
+
+def measure(name,size,repeat=3,memory=True):
+    """Run benchmark name at size, returning a result dict.
+
+    The time is the best of repeat runs. With memory, one more run under
+    tracemalloc gives the peak traced allocation, since tracing slows the
+    timed runs.
+    """
+    workdir = tempfile.mkdtemp(prefix='geodata_benchmark_')
+    result  = {'name':name,'size':size,'repeat':repeat}
+    try:
+        run = benchmarks[name](size,workdir)
+        walls = []
+        cpus  = []
+        rss0  = rss_bytes()
+        for i in range(repeat):
+            t0,c0 = perf_counter(),process_time()
+            items,nbytes = run()
+            walls.append(perf_counter()-t0)
+            cpus.append(process_time()-c0)
+        rss1 = rss_bytes()
+        result.update({'wall':min(walls),'wall_median':float(np.median(walls)),'cpu':min(cpus)
+                       ,'items':items,'bytes':nbytes
+                       ,'items_per_s':items/min(walls) if min(walls) > 0 else None
+                       ,'bytes_per_s':nbytes/min(walls) if min(walls) > 0 else None
+                       ,'rss_delta':None if rss0 is None or rss1 is None else rss1-rss0})
+        if memory:
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            run()
+            result['peak_traced'] = tracemalloc.get_traced_memory()[1]-base
+            if not tracing:
+                tracemalloc.stop()
+    except Exception as e:
+        result['error'] = '%s: %s'%(type(e).__name__,e)
+    finally:
+        shutil.rmtree(workdir,ignore_errors=True)
+    return result
+
+def run_benchmarks(names=None,sizes=None,repeat=3,memory=True,verbose=True):
+    "Measure each benchmark at each size. Returns a dict ready for JSON."
+    if names is None:
+        names = list(benchmarks.keys())
+    if sizes is None:
+        sizes = default_sizes
+    results = []
+    for name in names:
+        if name not in benchmarks:
+            raise KeyError("Unknown benchmark '%s', expected one of %s."%(name,list(benchmarks.keys())))
+        for size in sizes:
+            result = measure(name,size,repeat=repeat,memory=memory)
+            results.append(result)
+            if verbose:
+                print(format_result(result),flush=True)
+    return {'time':time(),'host':platform.node(),'python':platform.python_version()
+            ,'versions':{'numpy':np.__version__,'h5py':h5.__version__
+                         ,'pystare':getattr(ps,'__version__','unknown')}
+            ,'results':results}
+
+def format_result(result):
+    if 'error' in result:
+        return '%-18s %9i  error %s'%(result['name'],result['size'],result['error'])
+    ret = '%-18s %9i %10.4f s %12.0f items/s'%(result['name'],result['size'],result['wall'],result['items_per_s'] or 0)
+    if result.get('peak_traced') is not None:
+        ret = ret + ' %9.1f MB peak'%(result['peak_traced']/1.0e6)
+    return ret
+
+def compare(base,new,threshold=0.1,memory_threshold=0.2):
+    """Match results by (name,size) and flag regressions.
+
+    A regression is a time more than (1+threshold) times the base, or a
+    peak traced allocation more than (1+memory_threshold) times the base.
+    A new result that errored or has no usable base result, and a base
+    result absent from new, are also regressions. Returns a list of dicts
+    with the ratios, a 'regression' flag and the 'reason' for it.
+    """
+    base_index = dict(((r['name'],r['size']),r) for r in base['results'])
+    new_keys   = set((r['name'],r['size']) for r in new['results'])
+    ret = []
+    for r in new['results']:
+        b = base_index.get((r['name'],r['size']))
+        c = {'name':r['name'],'size':r['size'],'base':None,'new':r.get('wall')
+             ,'time_ratio':None,'memory_ratio':None,'regression':True,'reason':None}
+        if 'error' in r:
+            c['reason'] = 'error: %s'%r['error']
+        elif b is None:
+            c['reason'] = 'not in base'
+        elif 'error' in b:
+            c['reason'] = 'base error: %s'%b['error']
+        else:
+            c['base'] = b['wall']
+            c['time_ratio'] = r['wall']/b['wall'] if b['wall'] > 0 else None
+            if b.get('peak_traced') and r.get('peak_traced') is not None:
+                c['memory_ratio'] = r['peak_traced']/b['peak_traced']
+            slower = c['time_ratio'] is not None and c['time_ratio'] > 1.0+threshold
+            bigger = c['memory_ratio'] is not None and c['memory_ratio'] > 1.0+memory_threshold
+            c['regression'] = slower or bigger
+            c['reason'] = 'time' if slower else 'memory' if bigger else None
+        ret.append(c)
+    for b in base['results']:
+        if (b['name'],b['size']) not in new_keys:
+            ret.append({'name':b['name'],'size':b['size'],'base':b.get('wall'),'new':None
+                        ,'time_ratio':None,'memory_ratio':None,'regression':True,'reason':'missing from new'})
+    return ret
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='geodata.benchmark',description='Benchmark geodata hot paths.')
+    commands = parser.add_subparsers(dest='command',required=True)
+    run = commands.add_parser('run',help='run benchmarks and write the results as JSON')
+    run.add_argument('-o','--output',default='benchmark.json')
+    run.add_argument('--sizes',type=int,nargs='+',default=default_sizes)
+    run.add_argument('--only',nargs='+',default=None,choices=list(benchmarks.keys()))
+    run.add_argument('--repeat',type=int,default=3)
+    run.add_argument('--no-memory',action='store_true',help='skip the traced peak memory run')
+    cmp = commands.add_parser('compare',help='compare two result files, exit 1 on regressions')
+    cmp.add_argument('base')
+    cmp.add_argument('new')
+    cmp.add_argument('--threshold',type=float,default=0.1,help='allowed relative slow down')
+    cmp.add_argument('--memory-threshold',type=float,default=0.2,help='allowed relative peak memory growth')
+    commands.add_parser('list',help='list the benchmarks')
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        for name in benchmarks:
+            print(name)
+        return 0
+    if args.command == 'run':
+        results = run_benchmarks(args.only,args.sizes,repeat=args.repeat,memory=not args.no_memory)
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=1)
+        print('wrote %s'%args.output)
+        return 0
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    regressions = 0
+    def optional(fmt,value):
+        return '-' if value is None else fmt%value
+    print('%-18s %9s %10s %10s %7s %7s'%('benchmark','size','base (s)','new (s)','time','memory'))
+    for c in compare(base,new,args.threshold,args.memory_threshold):
+        print('%-18s %9i %10s %10s %7s %7s %s'
+              %(c['name'],c['size'],optional('%.4f',c['base']),optional('%.4f',c['new'])
+                ,optional('%.2f',c['time_ratio']),optional('%.2f',c['memory_ratio'])
+                ,'REGRESSION (%s)'%c['reason'] if c['regression'] else ''))
+        regressions += c['regression']
+    return 1 if regressions > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,342 @@
+
+# geodata/join_engine.py
+
+# Join any number of sources at a chosen spatial and temporal resolution in one sort-merge pass.
+#
+# Each source is a reader plugin, a join_source, yielding blocks of
+# (sid, tid, src_coord, columns) arrays. The engine reduces every sid to
+# the join resolution, bins every tid, sorts all of the sources together
+# once, and aggregates each secondary source onto the rows of the primary
+# source, i.e. the same result as join_goes_and_m2.join, but for N sources.
+
+import h5py as h5
+from netCDF4 import Dataset
+import numpy as np
+import pystare as ps
+
+import geodata as gd
+
+try:
+    from geodata.stopwatch import sw_timer
+except ImportError:
+    from stopwatch import sw_timer
+
+try:
+    from geodata.metrics import metrics_registry
+except ImportError:
+    from metrics import metrics_registry
+
+try:
+    import geodata.joined_h5 as jh5
+except ImportError:
+    import joined_h5 as jh5
+
+try:
+    from geodata.join_goes_merra2 import read_goes_bands
+except ImportError:
+    from join_goes_merra2 import read_goes_bands
+
+try:
+    from geodata.modis import modis05_granule, modis_mosaic
+except ImportError:
+    from modis import modis05_granule, modis_mosaic
+
+###########################################################################
+# Widths of the temporal bins, keyed as in gd.stare_temporal_resolutions.
+#
+temporal_bin_ms = {
+    '1year'   : 365*86400000
+    ,'1day'   : 86400000
+    ,'1/2day' : 43200000
+    ,'4hr'    : 14400000
+    ,'1hr'    : 3600000
+    ,'1/2hr'  : 1800000
+    ,'1/4hr'  : 900000
+    ,'1/8hr'  : 450000
+    ,'1/16hr' : 225000
+    ,'1sec'   : 1000
+    ,'1msec'  : 1
+}
+
+def spatial_key(sid,resolution):
+    "Reduce an array of sids to the trixels containing them at resolution."
+    return gd.spatial_clear_to_resolution(gd.spatial_coerce_resolution(sid,resolution))
+
+def temporal_key(tid,temporal_resolution):
+    "Bin an array of STARE temporal ids into temporal_resolution wide bins. None puts everything in one bin."
+    if temporal_resolution is None:
+        return np.zeros(np.shape(tid),dtype=np.int64)
+    ms = gd.datetime_from_stare(np.asarray(tid,dtype=np.int64)).astype(np.int64)
+    return ms // temporal_bin_ms[temporal_resolution]
+
+###########################################################################
+# Reader plugins
+#
+class join_source(object):
+    "A source for join_sources. Subclasses set name and implement read."
+    name = None
+
+    def read(self):
+        """Yield (sid, tid, src_coord, columns) blocks.
+
+        sid, tid and src_coord are int64 arrays of one length and columns is a
+        dictionary of arrays of that length. Rows with sid < 0 are ignored.
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '<%s %s>'%(self.__class__.__name__,self.name)
+
+class array_source(join_source):
+    "A source for data already in memory. tid may be a scalar."
+    def __init__(self,name,sid,tid,columns,src_coord=None):
+        self.name      = name
+        self.sid       = np.asarray(sid,dtype=np.int64)
+        self.tid       = np.broadcast_to(np.asarray(tid,dtype=np.int64),self.sid.shape)
+        if src_coord is None:
+            src_coord = np.arange(self.sid.size,dtype=np.int64)
+        self.src_coord = np.asarray(src_coord,dtype=np.int64)
+        self.columns   = columns
+        return
+
+    def read(self):
+        yield self.sid,self.tid,self.src_coord,self.columns
+
+class goes_source(join_source):
+    "GOES imager bands, one netCDF file per band, sharing the geolocation of the first."
+    def __init__(self,datapath,filenames,name='goes',bandnames=None,band_reader='thread'):
+        self.name      = name
+        self.datapath  = datapath
+        if bandnames is None:
+            bandnames = {"BAND_03":"b3","BAND_04":"b4","BAND_05":"b5"}
+        self.bandnames = bandnames
+        self.filenames = [f for f in filenames if f.split('.')[4] in self.bandnames.keys()]
+        if len(self.filenames) == 0:
+            raise ValueError('goes_source: no valid GOES filenames in %s'%filenames)
+        self.band_reader = band_reader
+        return
+
+    def read(self):
+        ds    = Dataset(self.datapath+self.filenames[0])
+        g_lat = ds['lat'][:,:].flatten()
+        g_lon = ds['lon'][:,:].flatten()
+        tid   = gd.goes10_img_stare_time(ds)[0]
+        resolution = int(gd.resolution(ds['elemRes'][0]))
+        ds.close()
+        valid = np.where((g_lat>=-90.0) & (g_lat<=90.0))
+        sid   = np.full(g_lat.shape,-1,dtype=np.int64)
+        sid[valid] = ps.from_latlon(g_lat[valid],g_lon[valid],resolution)
+        columns = {}
+        paths = [self.datapath+f for f in self.filenames]
+        for fname,data in zip(self.filenames,read_goes_bands(paths,reader=self.band_reader)):
+            columns[self.bandnames[fname.split('.')[4]]] = data
+        yield sid,np.full(sid.shape,tid,dtype=np.int64),np.arange(sid.size,dtype=np.int64),columns
+
+class merra2_source(join_source):
+    """MERRA-2 tavg1_2d_slv_Nx total precipitable water, TQI+TQL+TQV.
+
+    Yields one block per hour. If tid is given only the hours matching it
+    (ps.cmp_temporal) are read, as in join_goes_and_m2.join.
+    """
+    def __init__(self,datapath,filename,name='merra2',tid=None,resolution=None):
+        self.name     = name
+        self.datapath = datapath
+        self.filename = filename
+        self.tid      = tid
+        if resolution is None:
+            m2_dLonkm  = (5.0/8.0) * gd.re_km/gd.deg_per_rad
+            resolution = int(gd.resolution(m2_dLonkm*2))
+        self.resolution = resolution
+        return
+
+    def read(self):
+        m2_ds = Dataset(self.datapath+self.filename)
+        m2_lat,m2_lon = np.meshgrid(m2_ds['lat'],m2_ds['lon'])
+        m2_lat = m2_lat.flatten()
+        m2_lon = m2_lon.flatten()
+        sid    = ps.from_latlon(m2_lat,m2_lon,self.resolution)
+        src_coord = np.arange(sid.size,dtype=np.int64)
+        m2_tid = gd.merra2_stare_time(m2_ds)
+        if self.tid is None:
+            hours = np.arange(len(m2_tid))
+        else:
+            hours = np.nonzero(ps.cmp_temporal(np.array([self.tid],dtype=np.int64),m2_tid))[0]
+        for ihr in hours:
+            tpw = m2_ds['TQI'][ihr,:,:] + m2_ds['TQL'][ihr,:,:] + m2_ds['TQV'][ihr,:,:]
+            yield sid,np.full(sid.shape,m2_tid[ihr],dtype=np.int64),src_coord,{'tpw':tpw.T.flatten()}
+        m2_ds.close()
+
+class modis05_source(join_source):
+    """MODIS MOD05_L2 variables at 1km, geolocated with the companion MOD03
+    file, or, if geo_filename is None, by interpolating the 5km geolocation
+    in the MOD05_L2 file itself."""
+    def __init__(self,datapath,filename,geo_filename=None,name='modis',variables=None,resolution=None,geo_datapath=None):
+        self.name         = name
+        self.datapath     = datapath
+        self.filename     = filename
+        self.geo_filename = geo_filename
+        if geo_datapath is None:
+            geo_datapath = datapath
+        self.geo_datapath = geo_datapath
+        if variables is None:
+            variables = ['Water_Vapor_Near_Infrared']
+        self.variables    = variables
+        if resolution is None:
+            resolution = int(gd.resolution(1))
+        self.resolution   = resolution
+        return
+
+    def read(self,max_pixels=1<<20):
+        """Blocks of whole scans in row order, reading only each block's rows
+        of the variables and geolocation, see modis05_granule."""
+        geo_fname = None if self.geo_filename is None else self.geo_datapath+self.geo_filename
+        tid = gd.temporal_id_centered_from_modis_filename(self.filename)[0]
+        with modis05_granule(self.datapath+self.filename,geo_fname) as granule:
+            n_along,n_across = granule.shape(self.variables[0])
+            rows = max(10,(max_pixels//n_across)//10*10)
+            for row0 in range(0,n_along,rows):
+                row1 = min(n_along,row0+rows)
+                sid  = granule.sids(self.resolution,row0,row1).flatten()
+                yield sid,np.full(sid.shape,tid,dtype=np.int64)\
+                    ,np.arange(row0*n_across,row1*n_across,dtype=np.int64)\
+                    ,dict([(var,granule.read(var,row0,row1,cache=False).flatten()) for var in self.variables])
+
+class modis05_mosaic_source(join_source):
+    """Consecutive MOD05_L2 granules as one swath, see modis_mosaic. Blocks
+    are in trixel order and cross granule seams; src_coords run on across
+    the granules. Granules missing cover or time_window are skipped
+    unread, see prefilter_granules."""
+    def __init__(self,datapath,filenames,geo_filenames=None,name='modis',variables=None,resolution=None
+                 ,geo_datapath=None,bowtie='nadir',level=None,cover=None,time_window=None,cover_cache=None):
+        self.name = name
+        if geo_datapath is None:
+            geo_datapath = datapath
+        mod03_fnames = None if geo_filenames is None else [geo_datapath+f for f in geo_filenames]
+        self.mosaic  = modis_mosaic([datapath+f for f in filenames],mod03_fnames
+                                    ,variables=variables,resolution=resolution,bowtie=bowtie
+                                    ,cover=cover,time_window=time_window,cache_dir=cover_cache)
+        self.level   = level
+        return
+
+    def read(self):
+        return self.mosaic.blocks(level=self.level)
+
+###########################################################################
+# The engine
+#
+def gather_source(source):
+    "Concatenate the blocks of a source, dropping rows without a valid sid."
+    blocks = list(source.read())
+    if len(blocks) == 0:
+        return np.zeros([0],dtype=np.int64),np.zeros([0],dtype=np.int64),np.zeros([0],dtype=np.int64),{}
+    sid       = np.concatenate([np.asarray(b[0],dtype=np.int64) for b in blocks])
+    tid       = np.concatenate([np.asarray(b[1],dtype=np.int64) for b in blocks])
+    src_coord = np.concatenate([np.asarray(b[2],dtype=np.int64) for b in blocks])
+    columns   = {}
+    for name in blocks[0][3].keys():
+        columns[name] = np.concatenate([unmask(b[3][name]) for b in blocks])
+    metrics_registry.counter('join_engine-read-'+source.name)\
+        .inc(sid.size,sid.nbytes+tid.nbytes+src_coord.nbytes+sum(c.nbytes for c in columns.values()))
+    return sid,tid,src_coord,columns
+
+def unmask(values):
+    "Replace the masked values of a masked array (e.g. from netCDF4) with nan. Other arrays are returned as is."
+    if np.ma.is_masked(values):
+        return np.ma.filled(values.astype(np.double),np.nan)
+    return np.asarray(values)
+
+def join_sources(sources,spatial_resolution,temporal_resolution=None,primary=0):
+    """Join N sources onto the rows of sources[primary].
+
+    Input
+      sources             - a list of join_source plugins, with distinct names
+      spatial_resolution  - the STARE level at which sids match
+      temporal_resolution - None, or a key of temporal_bin_ms, e.g. '1hr'
+      primary             - the index of the source whose rows are returned
+
+    Returns a dictionary of arrays, one row per primary row with a valid sid:
+      'stare_spatial', 'stare_temporal', and for each source s,
+      '<s>_src_coord' (the first matching src_coord, -1 if none),
+      '<s>_count' (the number of matching rows), and '<s>_<column>'
+      (the mean of the matching rows, nan if none).
+    """
+    sw_timer.stamp('join_engine-join_sources-start')
+    names = [s.name for s in sources]
+    if len(set(names)) != len(names):
+        raise ValueError('join_sources: source names must be distinct, got %s'%names)
+
+    ##### Read and key every source.
+    sw_timer.stamp('join_engine-read-start')
+    gathered = []
+    for source in sources:
+        sid,tid,src_coord,columns = gather_source(source)
+        valid = np.nonzero(sid >= 0)[0]
+        gathered.append((sid[valid],tid[valid],src_coord[valid]
+                         ,dict((k,v[valid]) for k,v in columns.items())))
+    sw_timer.stamp('join_engine-read-end')
+
+    ##### One sort over all sources: by time bin, trixel, source, and src_coord.
+    sw_timer.stamp('join_engine-sort-start')
+    skey    = np.concatenate([spatial_key(g[0],spatial_resolution) for g in gathered])
+    tkey    = np.concatenate([temporal_key(g[1],temporal_resolution) for g in gathered])
+    src_idx = np.concatenate([np.full(len(g[0]),i,dtype=np.int64) for i,g in enumerate(gathered)])
+    src_crd = np.concatenate([g[2] for g in gathered])
+    order   = np.lexsort((src_crd,src_idx,skey,tkey))
+    skey_s  = skey[order]
+    tkey_s  = tkey[order]
+    src_s   = src_idx[order]
+    new_group = np.ones(order.size,dtype=bool)
+    new_group[1:] = (skey_s[1:] != skey_s[:-1]) | (tkey_s[1:] != tkey_s[:-1])
+    group_s  = np.cumsum(new_group)-1
+    n_groups = int(group_s[-1])+1 if order.size > 0 else 0
+    group = np.empty(order.size,dtype=np.int64)
+    group[order] = group_s
+    sw_timer.stamp('join_engine-sort-end')
+
+    ##### Aggregate each source per group and gather onto the primary rows.
+    sw_timer.stamp('join_engine-merge-start')
+    offsets = np.cumsum([0]+[len(g[0]) for g in gathered])
+    p_sid,p_tid,p_src,p_cols = gathered[primary]
+    p_group = group[offsets[primary]:offsets[primary+1]]
+    ret = {'stare_spatial':p_sid,'stare_temporal':p_tid}
+    for i,(source,g) in enumerate(zip(sources,gathered)):
+        prefix = source.name+'_'
+        if i == primary:
+            ret[prefix+'src_coord'] = p_src
+            ret[prefix+'count']     = np.ones(p_sid.size,dtype=np.int64)
+            for k,v in p_cols.items():
+                ret[prefix+k] = v
+            continue
+        s_group = group[offsets[i]:offsets[i+1]]
+        count   = np.bincount(s_group,minlength=n_groups)
+        # The sort puts each group's smallest src_coord first.
+        first   = np.full(n_groups,-1,dtype=np.int64)
+        sel     = order[src_s == i]-offsets[i]
+        u_group,u_first = np.unique(s_group[sel],return_index=True)
+        first[u_group] = g[2][sel[u_first]]
+        ret[prefix+'src_coord'] = first[p_group]
+        ret[prefix+'count']     = count[p_group]
+        with np.errstate(invalid='ignore',divide='ignore'):
+            for k,v in g[3].items():
+                if v.dtype.kind == 'f':
+                    ok = ~np.isnan(v)
+                else:
+                    ok = np.ones(v.shape,dtype=bool)
+                sums = np.bincount(s_group[ok],weights=v[ok],minlength=n_groups)
+                nums = np.bincount(s_group[ok],minlength=n_groups)
+                mean = np.where(nums > 0,sums/nums,np.nan)
+                ret[prefix+k] = mean[p_group]
+    sw_timer.stamp('join_engine-merge-end')
+    sw_timer.stamp('join_engine-join_sources-end')
+    return ret
+
+def joined_to_h5(joined,workFileName,layout='columnar',**kwargs):
+    "Write the result of join_sources as /image, using joined_h5. kwargs go to joined_h5.image_writer."
+    names  = list(joined.keys())
+    dtype  = np.dtype([(k,joined[k].dtype) for k in names])
+    n_rows = len(joined[names[0]])
+    with h5.File(workFileName,'w') as workFile:
+        image = jh5.image_writer(workFile,n_rows,dtype=dtype,layout=layout,**kwargs)
+        for k in names:
+            image.write(k,joined[k])
+    return
@@ -7,20 +7,73 @@ import h5py as h5
 from netCDF4 import Dataset
 import numpy as np
 import pystare as ps
+import itertools
 import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from sortedcontainers import SortedDict, SortedList
 
 import geodata as gd
 
 try:
-    from geodata.stopwatch import sw_timer
+    from geodata.stopwatch import sw_timer, timed_worker, merge_worker_results
 except ImportError:
-    from stopwatch import sw_timer
+    from stopwatch import sw_timer, timed_worker, merge_worker_results
+
+try:
+    from geodata.metrics import metrics_registry
+except ImportError:
+    from metrics import metrics_registry
+
+try:
+    import geodata.joined_h5 as jh5
+except ImportError:
+    import joined_h5 as jh5
 
 
 def hex16(i):
     return "0x%016x"%i
 
+def read_goes_band(path):
+    "Read and flatten the image of one GOES band file. At module level so that a process pool can use it."
+    ds   = Dataset(path)
+    data = ds['data'][0,:,:].flatten()
+    ds.close()
+    return data
+
+def read_goes_bands(paths,reader='thread',max_workers=None):
+    """Read GOES band files concurrently, yielding the flattened images in the order of paths.
+
+    The reads are submitted all at once, so the time for a set of bands is
+    bounded by the slowest read rather than their sum. The reads are I/O
+    bound, so a thread pool is the default. 'process' is opt-in: each
+    image is pickled back to this process, and the fork must not happen
+    while HDF5 files are open for writing here. Use 'serial' to read one
+    after the other. Each process worker's 'read_goes_band' span is merged
+    into sw_timer.
+    """
+    if reader == 'serial' or len(paths) < 2:
+        for path in paths:
+            yield read_goes_band(path)
+        return
+    if reader == 'process':
+        executor = ProcessPoolExecutor
+    elif reader == 'thread':
+        executor = ThreadPoolExecutor
+    else:
+        raise ValueError("Unknown band reader '%s', expected 'process', 'thread', or 'serial'."%reader)
+    if max_workers is None:
+        max_workers = len(paths)
+    with executor(max_workers=max_workers) as pool:
+        if reader == 'process':
+            futures = [pool.submit(timed_worker(read_goes_band),path) for path in paths]
+            for future in futures:
+                yield merge_worker_results([future.result()])[0]
+        else:
+            futures = [pool.submit(read_goes_band,path) for path in paths]
+            for future in futures:
+                yield future.result()
+    return
+
 class join_value(object):
     def __init__(self):
         self.bandmaps = {}
@@ -147,6 +200,7 @@ class join_goes_and_m2(object):
             m2_dataDayV     = np.mean(m2_ds['TQV'][m2_ifm,:,:],0)
             
         m2_dataDay      = m2_dataDayI + m2_dataDayL + m2_dataDayV
+        m2_ds.close()
         # print('m2_dataDay.shape: ',m2_dataDay.shape)
         m2_data         = m2_dataDay[:,:].T
         # print('m2_data.shape:    ',m2_data.shape)
@@ -207,15 +261,12 @@ class join_goes_and_m2(object):
         # TODO Add metadata for traceability.
     
         jkeys=join.keys()
-        ktr = 0; nktr = len(jkeys) # gd_idx_valid is a tuple with one element
-        ktr_max = nktr
-        elements_pushed = 0
-        print('Push joined m2 data into the dataset n = ',nktr)
+        nktr = len(jkeys) # gd_idx_valid is a tuple with one element
+        pushed   = metrics_registry.counter('join_goes_merra2-elements_pushed').reset() # Per join, not per process
+        progress = metrics_registry.progress('join_goes_merra2-push',total=nktr,unit='trixels'\
+                                             ,enabled=self.verbose_progress)
         for k in range(nktr):
-            ktr = ktr + 1
-            if self.verbose_progress:
-                if int(100.0*ktr/ktr_max) % 5 == 0 or int(100*ktr/ktr_max) < 2:
-                    print('join_goes_merra2: %2d%% complete, %d elements pushed.'%(int(100*ktr/ktr_max),elements_pushed),end='\r',flush=True)
+            progress.update()
             sid = jkeys[k]
             if join[sid].contains(self.goes_bandname):
                 if join[sid].contains('m2'):
@@ -224,9 +275,10 @@ class join_goes_and_m2(object):
                     # self.m2_tpw_h5[join[sid].get(self.goes_bandname)]       = (m2_data_flat[m2s]-self.tpw_offset)/self.tpw_scale
                     avg = (np.mean(m2_data_flat[join[sid].get('m2')])-self.tpw_offset)/self.tpw_scale
                     self.m2_tpw_h5[join[sid].get(self.goes_bandname)]       = avg
-                    elements_pushed = elements_pushed + len(join[sid].get(self.goes_bandname))
-        print('join_goes_merra2: done, %d elements pushed.           '%(elements_pushed),flush=True)
-        print('')
+                    pushed.inc(len(join[sid].get(self.goes_bandname)))
+        progress.close()
+        if self.verbose_progress:
+            pushed.emit()
         sw_timer.stamp('join_goes_and_m2-join-end')    
         sw_timer.stamp('join_goes_and_m2-start-goes-end')
         return self
@@ -235,32 +287,50 @@ class join_goes_and_m2(object):
         return getattr(self,attr)
 
     def to_h5(self,workFileName,options={'src_coord_format':'fixedwidth'}):
+        """Write the joined data to workFileName.
+
+        options
+          'src_coord_format' - 'fixedwidth' packs (i,j) into the src_coords, otherwise use the linear index.
+          'layout'           - 'compound' (default) or 'columnar', see joined_h5.
+          'compression'      - None, 'gzip', or 'lzf', columnar layout only.
+          'compression_opts' - e.g. the gzip level.
+          'shuffle'          - apply the HDF5 shuffle filter, columnar layout only.
+          'chunk_rows'       - rows per chunk, columnar layout only.
+          'schema'           - 'full' (default, int64 columns) or 'compact', see joined_h5.
+          'band_reader'      - 'thread' (default), 'serial', or 'process', see read_goes_bands.
+                               The first band, which join opened, is not read again.
+          'band_workers'     - the number of concurrent band reads, default one per band.
+          'cells'            - 'all' (default) writes every GOES pixel, 'sparse' writes only the
+                               valid, joined pixels sorted by stare_spatial, see joined_h5.scatter_to_image.
+        """
         ###########################################################################
         ##### HDF5 SAVE DATASET
 
         sw_timer.stamp('join_goes_and_m2-to_h5-start')
 
         ##### HDF5 Data types for output
-        image_dtype = np.dtype([
-            ('stare_spatial',np.int64)
-            ,('stare_temporal',np.int64)
-            ,('goes_src_coord',np.int64)
-            ,('goes_b3',np.int64)
-            ,('goes_b4',np.int64)
-            ,('goes_b5',np.int64)
-            ,('merra2_src_coord',np.int64)
-            ,('merra2_tpw',np.int64)
-        ])
-        image_description_dtype = np.dtype([
-            ('nx',np.int)
-            ,('ny',np.int)
-        ])
-        m2_description_dtype = np.dtype([
-            ('nx',np.int)
-            ,('ny',np.int)
-            ,('tpw_offset',np.double)
-            ,('tpw_scale',np.double)
-        ])
+        src_coord_format = options.get('src_coord_format','fixedwidth')
+        schema           = options.get('schema','full')
+        image_attrs      = {}
+        def pack_goes_src_coord(x):
+            return x
+        if schema == 'compact':
+            if jh5.src_coord_fits_int32(self.goes_ds['data'].shape[1:],src_coord_format):
+                src_coord_dtype = np.int32
+                if src_coord_format == 'fixedwidth':
+                    # Repack GOES (j << 32)+i so that the image_writer's checked_cast to int32 succeeds.
+                    # merra2_src_coord is the linear index, as m2_src_coord_h5 is flat.
+                    image_attrs['src_coord_bits'] = jh5.compact_src_coord_bits
+                    pack_goes_src_coord = jh5.compact_fixedwidth
+            else:
+                src_coord_dtype = np.int64
+            image_dtype_out         = jh5.compact_image_dtype(src_coord_dtype)
+            image_description_dtype = jh5.compact_image_description_dtype
+            m2_description_dtype    = jh5.compact_merra2_description_dtype
+        else:
+            image_dtype_out         = jh5.image_dtype
+            image_description_dtype = jh5.image_description_dtype
+            m2_description_dtype    = jh5.merra2_description_dtype
 
         # self.m2_src_coord_h5
         # self.m2_tpw_h5
@@ -272,26 +342,54 @@ class join_goes_and_m2(object):
         # self.goes_filenames_valid
         # self.goes_datapath
 
+        ##### Select the cells to write
+        cells = options.get('cells','all')
+        if cells == 'sparse':
+            rows = np.nonzero((self.goes_indices >= 0) & (self.m2_src_coord_h5 >= 0))[0]
+            rows = rows[np.argsort(self.goes_indices[rows],kind='stable')]
+            n_rows = rows.size
+            def select(x):
+                return x[rows]
+        elif cells == 'all':
+            rows = None
+            n_rows = self.goes_ds['data'].size
+            def select(x):
+                return x
+        else:
+            raise ValueError("Unknown cells option '%s', expected 'all' or 'sparse'."%cells)
+
         ##### HDF5 OUTPUT
         workFile = h5.File(workFileName,'w')
-        image_ds = workFile.create_dataset('image',[self.goes_ds['data'].size],dtype=image_dtype)
+        image = jh5.image_writer(workFile,n_rows,dtype=image_dtype_out
+                             ,layout=options.get('layout','compound')
+                             ,compression=options.get('compression',None)
+                             ,compression_opts=options.get('compression_opts',None)
+                             ,shuffle=options.get('shuffle',False)
+                             ,chunk_rows=options.get('chunk_rows',None)
+                             ,schema=schema
+                             ,fill_values=jh5.image_fill_values
+                             ,attrs=dict(image_attrs,cells=cells,src_coord_format=src_coord_format))
         image_description_ds = workFile.create_dataset('image_description',[],dtype=image_description_dtype)
         m2_description_ds = workFile.create_dataset('merra2_description',[],dtype=m2_description_dtype)
         
-        workFile['/image']['stare_spatial'] = self.goes_indices[:]
-        workFile['/image']['stare_temporal'] = gd.goes10_img_stare_time(self.goes_ds)[0]
-
-        if options['src_coord_format'] == 'fixedwidth':
-            workFile['/image']['goes_src_coord']   = gd.make_id_fixedwidth_idx(self.goes_ds['data'].shape[1:]).flatten()
+        image.write('stare_spatial',select(self.goes_indices[:]))
+        image.write('stare_temporal',gd.goes10_img_stare_time(self.goes_ds)[0])
+
+        if src_coord_format == 'fixedwidth':
+            if rows is None:
+                image.write('goes_src_coord',pack_goes_src_coord(gd.make_id_fixedwidth_idx(self.goes_ds['data'].shape[1:]).flatten()))
+            else:
+                nx = self.goes_ds['data'].shape[2]
+                image.write('goes_src_coord',pack_goes_src_coord(((rows // nx).astype(np.int64) << 32) + (rows % nx)))
             # np.arange(self.g_lat_size,dtype=np.int64)
-            workFile['/image']['merra2_src_coord'] = gd.id_fixedwidth_from_id(self.m2_src_coord_h5.flatten()
-                                                                              ,self.m2_src_coord_h5.shape)
+            image.write('merra2_src_coord',select(gd.id_fixedwidth_from_id(self.m2_src_coord_h5.flatten()
+                                                                           ,self.m2_src_coord_h5.shape)))
             # self.m2_src_coord_h5.flatten()
         else:
-            workFile['/image']['goes_src_coord']   = np.arange(self.g_lat_size,dtype=np.int64)
-            workFile['/image']['merra2_src_coord'] = self.m2_src_coord_h5.flatten()
+            image.write('goes_src_coord',select(np.arange(self.g_lat_size,dtype=np.int64)))
+            image.write('merra2_src_coord',select(self.m2_src_coord_h5.flatten()))
 
-        workFile['/image']['merra2_tpw']       = self.m2_tpw_h5.flatten()
+        image.write('merra2_tpw',select(self.m2_tpw_h5.flatten()))
     
         workFile['/image_description']['nx'] = self.goes_ds['data'].shape[2]
         workFile['/image_description']['ny'] = self.goes_ds['data'].shape[1]
@@ -302,19 +400,24 @@ class join_goes_and_m2(object):
         workFile['/merra2_description']['tpw_scale']  = self.tpw_scale
     
         sw_timer.stamp('join_goes_and_m2-to_h5-goes-before-loop')
-        while self.igoes < len(self.goes_filenames_valid):
+        # Assume remaining GOES bands have the same image sizes and locations.
+        # The band join opened is taken from goes_ds, the others are read
+        # concurrently, and all are written here, in order, by one writer.
+        first_band = self.goes_ds['data'][0,:,:].flatten()
+        self.goes_ds.close()
+        band_filenames = self.goes_filenames_valid[self.igoes:]
+        band_paths     = [self.goes_datapath+f for f in band_filenames[1:]]
+        band_datas     = itertools.chain([first_band]
+                                         ,read_goes_bands(band_paths
+                                                          ,reader=options.get('band_reader','thread')
+                                                          ,max_workers=options.get('band_workers',None)))
+        for band_filename,band_data in zip(band_filenames,band_datas):
             sw_timer.stamp('join_goes_and_m2-to_h5-goes-loop-start')
-            print(self.igoes,' saving ',self.goes_bandname,' from file ',self.goes_filenames_valid[self.igoes])
-            workFile['/image'][self.goes_bandname] = self.goes_ds['data'][0,:,:].flatten()
-            self.goes_ds.close()
+            self.goes_band     = band_filename.split('.')[4]
+            self.goes_bandname = self.goes_bandnames[self.goes_band]
+            print(self.igoes,' saving ',self.goes_bandname,' from file ',band_filename)
+            image.write(self.goes_bandname,select(band_data))
             self.igoes = self.igoes + 1
-            # Assume remaining GOES bands have the same image sizes and locations.
-            if self.igoes < len(self.goes_filenames_valid):
-                self.goes_band     = self.goes_filenames_valid[self.igoes].split('.')[4]
-                sw_timer.stamp('join_goes_and_m2-to_h5-goes-dataset-start')
-                self.goes_ds       = Dataset(self.goes_datapath+self.goes_filenames_valid[self.igoes])
-                sw_timer.stamp('join_goes_and_m2-to_h5-goes-dataset-end')
-                self.goes_bandname = self.goes_bandnames[self.goes_band]
             sw_timer.stamp('join_goes_and_m2-to_h5-goes-loop-end')
 
         workFile.close()
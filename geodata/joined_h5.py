@@ -0,0 +1,366 @@
+
+# geodata/joined_h5.py
+
+# HDF5 layouts for joined outputs, e.g. from join_goes_merra2.
+#
+# The original layout is a single compound '/image' dataset. The columnar
+# layout stores '/image' as a group holding one chunked (and optionally
+# compressed) dataset per column, so that each column is written once and
+# readers only touch the columns and rows they ask for. In both layouts
+# workFile['/image']['goes_b5'] names the same column.
+
+import h5py as h5
+import numpy as np
+
+###########################################################################
+# Default row type of the joined GOES & MERRA-2 image.
+#
+image_dtype = np.dtype([
+    ('stare_spatial',np.int64)
+    ,('stare_temporal',np.int64)
+    ,('goes_src_coord',np.int64)
+    ,('goes_b3',np.int64)
+    ,('goes_b4',np.int64)
+    ,('goes_b5',np.int64)
+    ,('merra2_src_coord',np.int64)
+    ,('merra2_tpw',np.int64)
+])
+
+image_description_dtype = np.dtype([
+    ('nx',np.int64)
+    ,('ny',np.int64)
+])
+
+merra2_description_dtype = np.dtype([
+    ('nx',np.int64)
+    ,('ny',np.int64)
+    ,('tpw_offset',np.double)
+    ,('tpw_scale',np.double)
+])
+
+###########################################################################
+# Compact row type. Band counts fit in 16 bits, TPW keeps its tpw_scale
+# (0.001 kg/m^2) as int32, so compact values equal full ones, and the
+# src_coords are int32 when they fit: the linear index of the source, or
+# (j << 16)+i for a fixedwidth goes_src_coord, see compact_fixedwidth.
+#
+compact_src_coord_bits = 16
+
+def compact_image_dtype(src_coord_dtype=np.int32):
+    "Return the compact row type. src_coords too large for an int32 need src_coord_dtype=np.int64."
+    return np.dtype([
+        ('stare_spatial',np.int64)
+        ,('stare_temporal',np.int64)
+        ,('goes_src_coord',src_coord_dtype)
+        ,('goes_b3',np.uint16)
+        ,('goes_b4',np.uint16)
+        ,('goes_b5',np.uint16)
+        ,('merra2_src_coord',src_coord_dtype)
+        ,('merra2_tpw',np.int32)
+    ])
+
+compact_image_description_dtype = np.dtype([
+    ('nx',np.int32)
+    ,('ny',np.int32)
+])
+
+compact_merra2_description_dtype = np.dtype([
+    ('nx',np.int32)
+    ,('ny',np.int32)
+    ,('tpw_offset',np.double)
+    ,('tpw_scale',np.double)
+])
+
+# Missing joins are marked with -1 in both schemas.
+image_fill_values = {
+    'stare_spatial'     : -1
+    ,'merra2_src_coord' : -1
+    ,'merra2_tpw'       : -1
+}
+
+image_schemas = ['full','compact']
+
+def src_coord_fits_int32(shape,src_coord_format='fixedwidth'):
+    "True if the compact src_coords of an array of this shape fit into an int32."
+    if src_coord_format == 'fixedwidth' and len(shape) > 1:
+        return shape[-2] <= (1 << (31-compact_src_coord_bits)) and shape[-1] <= (1 << compact_src_coord_bits)
+    return int(np.prod(shape)) < np.iinfo(np.int32).max
+
+def compact_fixedwidth(src_coord,bits=compact_src_coord_bits):
+    "Repack fixedwidth src_coords, (j << 32)+i, as (j << bits)+i. Negative fills are kept."
+    src_coord = np.asarray(src_coord,dtype=np.int64)
+    ret = ((src_coord >> 32) << bits) + (src_coord & ((1 << 32)-1))
+    return np.where(src_coord < 0,src_coord,ret)
+
+def full_fixedwidth(src_coord,bits=compact_src_coord_bits):
+    "Undo compact_fixedwidth, returning (j << 32)+i."
+    src_coord = np.asarray(src_coord,dtype=np.int64)
+    ret = ((src_coord >> bits) << 32) + (src_coord & ((1 << bits)-1))
+    return np.where(src_coord < 0,src_coord,ret)
+
+image_layouts = ['compound','columnar']
+
+default_chunk_rows = 1 << 18
+
+###########################################################################
+#
+def image_layout(workFile):
+    "Return the layout ('compound' or 'columnar') of the /image in an open h5 file."
+    if isinstance(workFile['/image'],h5.Group):
+        return 'columnar'
+    return 'compound'
+
+def image_columns(workFile):
+    "Return the names of the columns of /image in an open h5 file."
+    if image_layout(workFile) == 'columnar':
+        return [c.decode('ascii') if isinstance(c,bytes) else c for c in workFile['/image'].attrs['columns']]
+    return list(workFile['/image'].dtype.names)
+
+def image_schema(workFile):
+    "Return the schema ('full' or 'compact') of /image in an open h5 file."
+    schema = workFile['/image'].attrs.get('schema','full')
+    if isinstance(schema,bytes):
+        schema = schema.decode('ascii')
+    return schema
+
+def image_cells(workFile):
+    "Return 'all' if /image has a row for every source pixel, or 'sparse' if it only has the joined pixels."
+    cells = workFile['/image'].attrs.get('cells','all')
+    if isinstance(cells,bytes):
+        cells = cells.decode('ascii')
+    return cells
+
+def image_fill_value(workFile,name):
+    "Return the fill value recorded for a column of /image, or None."
+    if image_layout(workFile) == 'columnar':
+        return workFile['/image'][name].attrs.get('fill_value',None)
+    return workFile['/image'].attrs.get('fill_value.'+name,None)
+
+def image_src_coord_bits(workFile):
+    "Return the bits of i in the fixedwidth goes_src_coord of /image, or None if it is not repacked."
+    if image_schema(workFile) != 'compact':
+        return None
+    src_coord_format = workFile['/image'].attrs.get('src_coord_format','fixedwidth')
+    if isinstance(src_coord_format,bytes):
+        src_coord_format = src_coord_format.decode('ascii')
+    if src_coord_format != 'fixedwidth':
+        return None
+    bits = workFile['/image'].attrs.get('src_coord_bits',None)
+    return None if bits is None else int(bits)
+
+def upcast(values,fill_value=None):
+    "Widen a compact column to the full schema's types, mapping its fill value to -1."
+    if values.dtype.kind in 'iu':
+        ret = values.astype(np.int64)
+        if fill_value is not None and fill_value != -1:
+            ret[values == fill_value] = -1
+        return ret
+    return values
+
+def checked_cast(name,values,dtype):
+    "Cast values to dtype, raising ValueError instead of silently wrapping integers."
+    values = np.asarray(values)
+    dtype  = np.dtype(dtype)
+    if dtype.kind in 'iu' and values.size > 0 and values.dtype != dtype:
+        info = np.iinfo(dtype)
+        if np.amin(values) < info.min or np.amax(values) > info.max:
+            raise ValueError("Column '%s' has values in [%s,%s], outside the range of %s."
+                             %(name,np.amin(values),np.amax(values),dtype))
+    return values.astype(dtype,copy=False)
+
+def image_size(workFile):
+    "Return the number of rows in /image."
+    if image_layout(workFile) == 'columnar':
+        return int(workFile['/image'].attrs['n_rows'])
+    return workFile['/image'].shape[0]
+
+class image_writer(object):
+    "Create /image in an open h5 file and write it a column at a time."
+    def __init__(self,workFile,n_rows,dtype=image_dtype,layout='compound'
+                 ,compression=None,compression_opts=None,shuffle=False,chunk_rows=None
+                 ,schema='full',fill_values=None,attrs=None):
+        """
+        Input
+          n_rows      - the number of rows in /image
+          dtype       - a compound numpy dtype naming the columns and their types
+          layout      - 'compound' for one compound dataset, 'columnar' for one dataset per column
+          schema      - 'full' or 'compact', recorded so readers know to upcast
+          fill_values - a dictionary of fill values by column name, recorded as attributes
+          attrs       - other attributes for /image, e.g. {'cells':'sparse'}
+          compression - None, 'gzip', or 'lzf'; columnar layout only
+          shuffle     - apply the HDF5 shuffle filter; columnar layout only
+          chunk_rows  - rows per chunk; columnar layout only
+        """
+        if layout not in image_layouts:
+            raise ValueError("Unknown image layout '%s', expected one of %s."%(layout,image_layouts))
+        if schema not in image_schemas:
+            raise ValueError("Unknown image schema '%s', expected one of %s."%(schema,image_schemas))
+        self.workFile         = workFile
+        self.n_rows           = n_rows
+        self.dtype            = np.dtype(dtype)
+        self.layout           = layout
+        self.compression      = compression
+        self.compression_opts = compression_opts
+        self.shuffle          = shuffle
+        self.schema           = schema
+        if fill_values is None:
+            fill_values = {}
+        self.fill_values      = fill_values
+        if chunk_rows is None:
+            chunk_rows = default_chunk_rows
+        self.chunk_rows       = max(1,min(chunk_rows,n_rows))
+        if self.layout == 'compound':
+            image_ds = self.workFile.create_dataset('image',[n_rows],dtype=self.dtype)
+            for name in self.fill_values:
+                image_ds.attrs['fill_value.'+name] = self.dtype[name].type(self.fill_values[name])
+            image_ds.attrs['schema'] = schema
+        else:
+            image_group = self.workFile.create_group('image')
+            image_group.attrs['layout']  = 'columnar'
+            image_group.attrs['n_rows']  = n_rows
+            image_group.attrs['columns'] = [n.encode('ascii') for n in self.dtype.names]
+            image_group.attrs['schema']  = schema
+        if attrs is not None:
+            for key in attrs:
+                self.workFile['/image'].attrs[key] = attrs[key]
+        return
+
+    def write(self,name,values):
+        "Write a whole column. Scalars are broadcast to all rows."
+        if name not in self.dtype.names:
+            raise KeyError("Column '%s' is not in the image dtype."%name)
+        if np.ndim(values) == 0:
+            values = np.full([self.n_rows],values,dtype=self.dtype[name])
+        if self.schema == 'compact':
+            values = checked_cast(name,values,self.dtype[name])
+        if self.layout == 'compound':
+            self.workFile['/image'][name] = values
+            return
+        if len(values) != self.n_rows:
+            raise ValueError("Column '%s' has %i rows, expected %i."%(name,len(values),self.n_rows))
+        if self.n_rows == 0:
+            column_ds = self.workFile['/image'].create_dataset(name,[0],dtype=self.dtype[name])
+        else:
+            column_ds = self.workFile['/image'].create_dataset(
+                name
+                ,data=np.asarray(values,dtype=self.dtype[name])
+                ,chunks=(self.chunk_rows,)
+                ,compression=self.compression
+                ,compression_opts=self.compression_opts
+                ,shuffle=self.shuffle)
+        if name in self.fill_values:
+            column_ds.attrs['fill_value'] = self.dtype[name].type(self.fill_values[name])
+        return
+
+###########################################################################
+#
+def read_image(workFileName,columns=None,start=None,stop=None,upcast_compact=True):
+    """Read columns of /image from a joined h5 file of either layout and schema.
+
+    Only the requested columns and the rows in [start,stop) are read.
+    Compact columns are upcast to int64 with -1 fills, and a repacked
+    fixedwidth goes_src_coord back to (j << 32)+i, unless upcast_compact is False.
+    Returns a dictionary of numpy arrays keyed by column name.
+    """
+    with h5.File(workFileName,'r') as workFile:
+        if columns is None:
+            columns = image_columns(workFile)
+        rows   = slice(start,stop)
+        layout = image_layout(workFile)
+        compact = upcast_compact and image_schema(workFile) == 'compact'
+        bits    = image_src_coord_bits(workFile)
+        ret = {}
+        for name in columns:
+            if layout == 'columnar':
+                ret[name] = workFile['/image'][name][rows]
+            else:
+                ret[name] = workFile['/image'][name,rows]
+            if compact:
+                ret[name] = upcast(ret[name],image_fill_value(workFile,name))
+                if bits is not None and name == 'goes_src_coord':
+                    ret[name] = full_fixedwidth(ret[name],bits)
+    return ret
+
+def read_tpw(workFileName,start=None,stop=None):
+    "Read merra2_tpw from a joined h5 file and apply its tpw_offset and tpw_scale. Missing values are nan."
+    tpw = read_image(workFileName,columns=['merra2_tpw'],start=start,stop=stop)['merra2_tpw']
+    with h5.File(workFileName,'r') as workFile:
+        tpw_offset = workFile['/merra2_description']['tpw_offset']
+        tpw_scale  = workFile['/merra2_description']['tpw_scale']
+    ret = tpw_offset + tpw_scale*tpw.astype(np.double)
+    ret[tpw == -1] = np.nan
+    return ret
+
+def sorted_row_range(workFileName,sid_lo,sid_hi):
+    """Return the [start,stop) rows of a sparse /image, which is sorted by stare_spatial, with sid_lo <= sid <= sid_hi.
+
+    Bisects on disk, so only a few values of stare_spatial are read.
+    """
+    with h5.File(workFileName,'r') as workFile:
+        if image_cells(workFile) != 'sparse':
+            raise ValueError("%s is not sorted by stare_spatial, write it with cells='sparse'."%workFileName)
+        n = image_size(workFile)
+        if image_layout(workFile) == 'columnar':
+            def sid_at(k):
+                return workFile['/image']['stare_spatial'][k]
+        else:
+            def sid_at(k):
+                return workFile['/image']['stare_spatial',k]
+        def bisect(value,right):
+            lo,hi = 0,n
+            while lo < hi:
+                mid = (lo+hi)//2
+                v = sid_at(mid)
+                if v < value or (right and v == value):
+                    lo = mid+1
+                else:
+                    hi = mid
+            return lo
+        return bisect(sid_lo,False),bisect(sid_hi,True)
+
+def read_image_trixel(workFileName,sid,columns=None):
+    "Read the rows of a sparse /image that fall within the trixel sid as one contiguous read."
+    level  = sid & 31
+    mask   = (1 << (1+58-2*level))-1
+    start,stop = sorted_row_range(workFileName,sid & ~mask,sid | mask)
+    return read_image(workFileName,columns=columns,start=start,stop=stop)
+
+def scatter_to_image(values,src_coord,nx,ny,fill_value=-1,src_coord_format='fixedwidth'):
+    """Put the rows of a sparse /image back onto the (ny,nx) source image.
+
+    src_coord is the goes_src_coord column read along with values.
+    Pixels without a row get fill_value.
+    """
+    src_coord = np.asarray(src_coord,dtype=np.int64)
+    if src_coord_format == 'fixedwidth':
+        i = src_coord & ((1 << 32)-1)
+        j = src_coord >> 32
+    else:
+        i = src_coord % nx
+        j = src_coord // nx
+    ret = np.full([ny,nx],fill_value,dtype=np.asarray(values).dtype)
+    ret[j,i] = values
+    return ret
+
+def compound_to_columnar(inFileName,outFileName,compression='gzip',compression_opts=None,shuffle=True,chunk_rows=None):
+    "Rewrite a compound-layout joined h5 file using the columnar layout. Other datasets are copied as is."
+    with h5.File(inFileName,'r') as inFile, h5.File(outFileName,'w') as outFile:
+        if image_layout(inFile) != 'compound':
+            raise ValueError("%s does not have a compound /image."%inFileName)
+        image_ds = inFile['/image']
+        fill_values = {}
+        for name in image_ds.dtype.names:
+            if 'fill_value.'+name in image_ds.attrs:
+                fill_values[name] = image_ds.attrs['fill_value.'+name]
+        writer = image_writer(outFile,image_ds.shape[0],dtype=image_ds.dtype,layout='columnar'
+                              ,compression=compression,compression_opts=compression_opts
+                              ,shuffle=shuffle,chunk_rows=chunk_rows
+                              ,schema=image_schema(inFile),fill_values=fill_values
+                              ,attrs={key:image_ds.attrs[key] for key in image_ds.attrs
+                                      if key != 'schema' and not key.startswith('fill_value.')})
+        for name in image_ds.dtype.names:
+            writer.write(name,image_ds[name])
+        for key in inFile.keys():
+            if key != 'image':
+                inFile.copy(key,outFile)
+    return
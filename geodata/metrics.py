@@ -0,0 +1,238 @@
+
+# geodata/metrics.py
+
+# Counters, gauges and rate-limited progress for long loops, reported as
+# events to pluggable sinks instead of printed.
+
+import json
+import sys
+from time import perf_counter, time
+
+###########################################################################
+# Sinks. A sink is any callable taking one event, a dict with at least
+# 'time', 'kind' and 'name'.
+
+class stderr_sink(object):
+    "Human readable lines. Progress overwrites the current line until done."
+    def __init__(self,stream=None):
+        self.stream = stream
+        return
+
+    def __call__(self,event):
+        stream = sys.stderr if self.stream is None else self.stream
+        if event['kind'] == 'progress':
+            stream.write('\r'+format_event(event))
+        elif event['kind'] == 'done':
+            stream.write('\r'+format_event(event)+'\n')
+        else:
+            stream.write(format_event(event)+'\n')
+        stream.flush()
+        return
+
+class jsonl_sink(object):
+    "Append each event as a JSON line to fileName."
+    def __init__(self,fileName):
+        self.fileName = fileName
+        return
+
+    def __call__(self,event):
+        with open(self.fileName,'a') as f:
+            f.write(json.dumps(event)+'\n')
+        return
+
+class memory_sink(object):
+    "Keep the events in a list, e.g. for tests."
+    def __init__(self):
+        self.events = []
+        return
+
+    def __call__(self,event):
+        self.events.append(event)
+        return
+
+def format_event(event):
+    "One line for an event."
+    if event['kind'] in ('progress','done'):
+        ret = '%s: ' % event['name']
+        if event.get('total') is not None and event['total'] > 0:
+            ret = ret + '%3d%% ' % int(100.0*event['count']/event['total'])
+        ret = ret + '%d %s, %.1f %s/s' % (event['count'],event['unit'],event['rate'],event['unit'])
+        if event.get('bytes',0) > 0:
+            ret = ret + ', %.1f MB/s' % (event['byte_rate']/1.0e6)
+        if event['kind'] == 'done':
+            ret = ret + ', done in %.1f s' % event['elapsed']
+        elif event.get('eta') is not None:
+            ret = ret + ', eta %.0f s' % event['eta']
+        return ret
+    return '%s: %s' % (event['name'],event['value'])
+
+###########################################################################
+# Instruments.
+
+class counter(object):
+    "A count of items and bytes, with rates since it was made."
+    def __init__(self,registry,name):
+        self.registry = registry
+        self.name     = name
+        self.count    = 0
+        self.bytes    = 0
+        self.start    = perf_counter()
+        return
+
+    def inc(self,n=1,nbytes=0):
+        self.count += n
+        self.bytes += nbytes
+        return
+
+    def reset(self):
+        "Start counting again from zero, e.g. at the start of each run of a repeated job."
+        self.count = 0
+        self.bytes = 0
+        self.start = perf_counter()
+        return self
+
+    def event(self):
+        elapsed = perf_counter() - self.start
+        return {'time':time(),'kind':'counter','name':self.name,'value':self.count\
+                ,'bytes':self.bytes,'elapsed':elapsed\
+                ,'rate':self.count/elapsed if elapsed > 0 else 0.0\
+                ,'byte_rate':self.bytes/elapsed if elapsed > 0 else 0.0}
+
+    def emit(self):
+        self.registry.emit(self.event())
+        return
+
+class gauge(object):
+    "The latest value of something, e.g. a queue length or memory in use."
+    def __init__(self,registry,name):
+        self.registry = registry
+        self.name     = name
+        self.value    = None
+        return
+
+    def set(self,value):
+        self.value = value
+        return
+
+    def event(self):
+        return {'time':time(),'kind':'gauge','name':self.name,'value':self.value}
+
+    def emit(self):
+        self.registry.emit(self.event())
+        return
+
+class progress(object):
+    """Progress through total items, emitted at most once per interval seconds.
+
+    update() is cheap enough for a hot loop: it only reads the clock every
+    stride updates, and the stride adapts to the observed rate. A 'done'
+    event is emitted by close(), or on leaving a with block.
+    """
+    def __init__(self,registry,name,total=None,interval=1.0,unit='items',sinks=None):
+        self.registry = registry
+        self.name     = name
+        self.total    = total
+        self.interval = interval
+        self.unit     = unit
+        self.sinks    = sinks
+        self.count    = 0
+        self.bytes    = 0
+        self.start    = perf_counter()
+        self._last    = self.start
+        self._stride  = 1
+        self._next    = 1
+        self.closed   = False
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+        return False
+
+    def update(self,n=1,nbytes=0):
+        self.count += n
+        self.bytes += nbytes
+        if self.count >= self._next:
+            self._check()
+        return
+
+    def _check(self):
+        now = perf_counter()
+        if now - self._last >= self.interval:
+            self._last = now
+            self._emit('progress',now)
+        # Aim to look at the clock about ten times per interval.
+        elapsed = now - self.start
+        if elapsed > 0 and self.count > 0:
+            self._stride = max(1,int(0.1*self.interval*self.count/elapsed))
+        self._next = self.count + self._stride
+        return
+
+    def event(self,kind='progress',now=None):
+        if now is None:
+            now = perf_counter()
+        elapsed = now - self.start
+        rate    = self.count/elapsed if elapsed > 0 else 0.0
+        eta     = None
+        if self.total is not None and rate > 0:
+            eta = max(0.0,(self.total-self.count)/rate)
+        return {'time':time(),'kind':kind,'name':self.name,'count':self.count,'total':self.total\
+                ,'unit':self.unit,'bytes':self.bytes,'elapsed':elapsed,'rate':rate\
+                ,'byte_rate':self.bytes/elapsed if elapsed > 0 else 0.0,'eta':eta}
+
+    def _emit(self,kind,now=None):
+        self.registry.emit(self.event(kind,now),self.sinks)
+        return
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._emit('done')
+        return
+
+class metrics(object):
+    """Makes counters, gauges and progress that report to sinks.
+
+    m = metrics([jsonl_sink('run.jsonl')])
+    with m.progress('join',total=n) as p:
+        for ...: p.update()
+    """
+    def __init__(self,sinks=None):
+        self.sinks    = [stderr_sink()] if sinks is None else sinks
+        self.counters = {}
+        self.gauges   = {}
+        return
+
+    def emit(self,event,sinks=None):
+        for sink in (self.sinks if sinks is None else sinks):
+            sink(event)
+        return
+
+    def counter(self,name):
+        if name not in self.counters:
+            self.counters[name] = counter(self,name)
+        return self.counters[name]
+
+    def gauge(self,name):
+        if name not in self.gauges:
+            self.gauges[name] = gauge(self,name)
+        return self.gauges[name]
+
+    def progress(self,name,total=None,interval=1.0,unit='items',enabled=True):
+        "A new progress. If not enabled, it emits nothing."
+        return progress(self,name,total=total,interval=interval,unit=unit,sinks=None if enabled else [])
+
+    def snapshot(self):
+        "Events for every counter and gauge."
+        return [c.event() for c in self.counters.values()]+[g.event() for g in self.gauges.values()]
+
+    def report(self):
+        "Emit snapshot() to the sinks."
+        for event in self.snapshot():
+            self.emit(event)
+        return
+
+global metrics_registry
+metrics_registry = metrics()
@@ -0,0 +1,731 @@
+
+# geodata/modis.py
+
+# MODIS swath processing.
+#
+# Granule files, geolocation, STARE indexing of swaths, and mosaics of
+# consecutive granules.
+#
+# Coarse to fine geolocation as an interpolation_plan: the rows and columns
+# to gather and the weights depend only on the swath geometry, not on the
+# coordinates, so they are built once per (factor, swath shape) and
+# applied to any number of granules or data fields.
+
+import datetime as dt
+import os
+
+import numpy as np
+import pystare as ps
+from pyhdf.SD import SD, SDC
+
+import geodata as gd
+
+try:
+    from geodata.metrics import metrics_registry
+except ImportError:
+    from metrics import metrics_registry
+
+###########################################################################
+# Interpolation plans.
+#
+# A fine pixel i sits at coarse coordinate (i-offset)/factor. Along track,
+# the two coarse rows used are those of the fine row's scan, extrapolating
+# at the scan edges. Across track, the two coarse columns bracket the
+# pixel, extrapolating at the ends of the scan line. This is the scheme of
+# modis_coarse_to_fine_geolocation, which these plans match to rounding.
+
+# name : (factor, along-track offset, coarse rows per scan, cross-track offset, coarse columns, fine columns)
+plan_geometry = {
+    '5km_to_1km'   : (5,2.0,2,2.0,270,1354)
+    ,'1km_to_500m' : (2,0.5,10,0.0,1354,2708)
+    ,'1km_to_250m' : (4,1.5,10,0.0,1354,5416)
+}
+
+def bracket(fine,factor,offset,lo_min,lo_max):
+    "The lower coarse index lo in [lo_min,lo_max] and the weight w of lo+1 for fine indices."
+    pos = (fine-offset)/float(factor)
+    lo  = np.clip(np.floor(pos).astype(np.int64),lo_min,lo_max)
+    return lo,pos-lo
+
+class interpolation_plan(object):
+    """Gather indices and weights for interpolating a coarse swath of
+    n_along_coarse rows to the fine grid of name, e.g. '5km_to_1km'."""
+    def __init__(self,name,n_along_coarse):
+        if name not in plan_geometry:
+            raise ValueError('Unknown interpolation plan %s, expected one of %s.'%(name,sorted(plan_geometry.keys())))
+        factor,offset,scan_rows,offset_across,n_across_coarse,n_across_fine = plan_geometry[name]
+        self.name            = name
+        self.factor          = factor
+        self.n_along_coarse  = n_along_coarse
+        self.n_across_coarse = n_across_coarse
+        self.n_along_fine    = factor*n_along_coarse
+        self.n_across_fine   = n_across_fine
+        fine = np.arange(self.n_along_fine)
+        scan_start = (fine//(factor*scan_rows))*scan_rows
+        pos = (fine-offset)/float(factor)
+        lo  = np.clip(np.floor(pos).astype(np.int64),scan_start,scan_start+scan_rows-2)
+        self.row  = lo.astype(np.int32)
+        self.row_weight = pos-lo
+        lo,w = bracket(np.arange(n_across_fine),factor,offset_across,0,n_across_coarse-2)
+        self.col  = lo.astype(np.int32)
+        self.col_weight = w
+        return
+
+    def fname(self,directory):
+        return os.path.join(directory,'interpolation_plan.%s.%i.npz'%(self.name,self.n_along_coarse))
+
+    def save(self,directory):
+        np.savez(self.fname(directory),row=self.row,row_weight=self.row_weight,col=self.col,col_weight=self.col_weight)
+        return
+
+    def load(self,directory):
+        "Replace the tables with those saved in directory, if there. Returns True if loaded."
+        fname = self.fname(directory)
+        if not os.path.exists(fname):
+            return False
+        with np.load(fname) as f:
+            self.row,self.row_weight = f['row'],f['row_weight']
+            self.col,self.col_weight = f['col'],f['col_weight']
+        return True
+
+    def rows(self,start,stop):
+        if stop is None:
+            stop = self.n_along_fine
+        if start < 0 or stop > self.n_along_fine or start > stop:
+            raise ValueError('Invalid fine row range [%i,%i), expected within [0,%i].'%(start,stop,self.n_along_fine))
+        return slice(start,stop)
+
+    def apply(self,field,start=0,stop=None,dtype=np.float64):
+        "Interpolate a coarse data field to fine rows [start,stop)."
+        rows = self.rows(start,stop)
+        field = np.asarray(field,dtype=dtype)
+        r,wr = self.row[rows],self.row_weight[rows].astype(dtype)[:,None]
+        a = field[r,:]
+        y = a+(field[r+1,:]-a)*wr
+        a = y[:,self.col]
+        return a+(y[:,self.col+1]-a)*self.col_weight.astype(dtype)
+
+    def geolocate(self,lat,lon,start=0,stop=None,dtype=np.float64):
+        "The fine (lat,lon) of fine rows [start,stop) from coarse lat and lon, unwrapping at the dateline."
+        rows = self.rows(start,stop)
+        lat = self.apply(lat,start,stop,dtype)
+        lon = np.asarray(lon,dtype=dtype)
+        r,wr = self.row[rows],self.row_weight[rows].astype(dtype)[:,None]
+        y = lerp_lon(lon[r,:],lon[r+1,:],wr)
+        return lat,lerp_lon(y[:,self.col],y[:,self.col+1],self.col_weight.astype(dtype))
+
+def lerp_lon(a,b,w):
+    "a+(b-a)*w for longitudes, shifting negative ones by 360 where a and b straddle the dateline."
+    dateline = np.abs(b-a) > 180.0
+    if np.any(dateline):
+        a = np.where(dateline & (a < 0.0),a+360.0,a)
+        b = np.where(dateline & (b < 0.0),b+360.0,b)
+    lon = a+(b-a)*w
+    return np.where(lon > 180.0,lon-360.0,np.where(lon < -180.0,lon+360.0,lon))
+
+_plans = {}
+
+def get_plan(name,n_along_coarse,cache_dir=None):
+    """The interpolation_plan for name and n_along_coarse coarse rows,
+    cached in memory and, with cache_dir, on disk."""
+    key = (name,n_along_coarse)
+    if key not in _plans:
+        plan = interpolation_plan(name,n_along_coarse)
+        if cache_dir is not None and not plan.load(cache_dir):
+            plan.save(cache_dir)
+        _plans[key] = plan
+    return _plans[key]
+
+def coarse_to_fine_geolocation(lat,lon,name='5km_to_1km',start=0,stop=None,dtype=np.float64,cache_dir=None):
+    "Fine (lat,lon) of rows [start,stop) from coarse geolocation with a cached plan."
+    return get_plan(name,np.shape(lat)[0],cache_dir).geolocate(lat,lon,start,stop,dtype)
+
+###########################################################################
+# Scan geometry. A MODIS pixel grows from its nadir size to about 2x along
+# track and 5x along scan at the ends of the scan line, so each column of
+# a swath gets its own STARE level.
+
+modis_altitude_km    = 705.0
+modis_orbit_minutes  = 98.8
+earth_radius_km      = 6371.0
+modis_nadir_km       = {None:1.0,'5km_to_1km':1.0,'1km_to_500m':0.5,'1km_to_250m':0.25}
+
+def scan_angles(n_across=1354,nadir_km=1.0):
+    "The scan angle (radians) of each column, stepping by one nadir pixel."
+    return (np.arange(n_across)-0.5*(n_across-1))*nadir_km/modis_altitude_km
+
+def pixel_size_km(n_across=1354,nadir_km=1.0):
+    "(along scan, along track) size in km of each column's pixels, for a spherical earth."
+    theta = scan_angles(n_across,nadir_km)
+    beta  = nadir_km/modis_altitude_km # instantaneous field of view
+    r     = (earth_radius_km+modis_altitude_km)/earth_radius_km
+    eta   = np.arcsin(r*np.sin(theta)) # view zenith angle
+    gamma = eta-theta                  # earth central angle
+    slant = np.where(theta == 0,modis_altitude_km,earth_radius_km*np.sin(gamma)/np.where(theta == 0,1.0,np.sin(theta)))
+    along_scan  = earth_radius_km*beta*(r*np.cos(theta)/np.cos(eta)-1.0)
+    along_track = beta*slant
+    return along_scan,along_track
+
+_level_tables = {}
+
+def scan_level_table(resolution,n_across=1354,nadir_km=1.0):
+    """The STARE level of each column: that of the larger side of its
+    pixels, but no finer than resolution."""
+    key = (int(resolution),n_across,nadir_km)
+    if key not in _level_tables:
+        along_scan,along_track = pixel_size_km(n_across,nadir_km)
+        levels = np.floor(10-np.log2(np.maximum(along_scan,along_track)/10.0)).astype(np.int64)
+        _level_tables[key] = np.minimum(levels,int(resolution))
+    return _level_tables[key]
+
+def adapt_sid_resolution(sid,levels):
+    """Coarsen sid[...,j] to level levels[j]. The location bits below the
+    level are cleared too, so pixels sharing a trixel share an id."""
+    return gd.spatial_clear_to_resolution(gd.spatial_coerce_resolution(sid,levels))
+
+###########################################################################
+# Swath to STARE, a block of whole scans at a time, so that fine
+# resolution lat/lon never exist for more than a block.
+
+# Fine rows per scan, and for name None, i.e. lat/lon already at 1km.
+scan_rows_fine = {None:10,'5km_to_1km':10,'1km_to_500m':20,'1km_to_250m':40}
+
+def swath_sid_blocks(lat,lon,resolution,name=None,max_pixels=1<<20,start=0,stop=None,cache_dir=None,adaptive=False):
+    """Yield (start,stop,sid) for blocks of whole scans of fine rows [start,stop).
+
+    lat and lon are the coarse geolocation, interpolated with the plan of
+    name, e.g. '5km_to_1km', or already at the fine resolution if name is
+    None. sid is [stop-start,n_across] at the STARE resolution. Blocks hold
+    about max_pixels pixels, and their coordinates are dropped once indexed.
+    With adaptive, each column's sids are coarsened to scan_level_table.
+    """
+    if name is None:
+        n_along,n_across = np.shape(lat)
+    else:
+        plan = get_plan(name,np.shape(lat)[0],cache_dir)
+        n_along,n_across = plan.n_along_fine,plan.n_across_fine
+    if stop is None:
+        stop = n_along
+    if start < 0 or stop > n_along or start > stop:
+        raise ValueError('Invalid fine row range [%i,%i), expected within [0,%i].'%(start,stop,n_along))
+    scan_rows = scan_rows_fine[name]
+    rows = max(scan_rows,(max_pixels//max(1,n_across))//scan_rows*scan_rows)
+    row0 = start
+    while row0 < stop:
+        row1 = min(stop,(row0//scan_rows)*scan_rows+rows)
+        if name is None:
+            blat = np.asarray(lat[row0:row1],dtype=np.double)
+            blon = np.asarray(lon[row0:row1],dtype=np.double)
+        else:
+            blat,blon = plan.geolocate(lat,lon,row0,row1)
+        sid = ps.from_latlon(blat.ravel(),blon.ravel(),int(resolution)).reshape(blat.shape)
+        del blat,blon
+        if adaptive:
+            sid = adapt_sid_resolution(sid,scan_level_table(resolution,n_across,modis_nadir_km[name]))
+        yield row0,row1,sid
+        row0 = row1
+
+def swath_sids(lat,lon,resolution,name=None,max_pixels=1<<20,cache_dir=None,adaptive=False):
+    "The sids of a whole swath as one [n_along,n_across] array, built from swath_sid_blocks."
+    ret = None
+    for row0,row1,sid in swath_sid_blocks(lat,lon,resolution,name,max_pixels,cache_dir=cache_dir,adaptive=adaptive):
+        if ret is None:
+            n_along = np.shape(lat)[0] if name is None else get_plan(name,np.shape(lat)[0]).n_along_fine
+            ret = np.empty((n_along,sid.shape[1]),dtype=np.int64)
+        ret[row0:row1] = sid
+    return ret
+
+###########################################################################
+# Bow-tie overlaps. Toward the ends of the scan, consecutive 10 line scans
+# overlap, so pixels from two scans land in the same trixel. Working on
+# the sids sorted by trixel, each trixel holding pixels of more than one
+# scan is resolved by a policy:
+#   'nadir' - keep only the pixels of the scan with the pixel nearest nadir
+#   'mean'  - collapse the trixel to one row, the mean of its pixels, with
+#             the sid and src_coord of the pixel nearest nadir
+
+bowtie_policies = ['nadir','mean']
+
+def resolve_bowtie(sid,values=None,policy='nadir',level=None,scan_rows=10,row_offset=0):
+    """Resolve pixels of different scans sharing a trixel.
+
+    Input
+      sid        - [n_along,n_across] sids of whole scans, e.g. from swath_sids
+      values     - a dictionary of [n_along,n_across] arrays to carry along
+      level      - compare trixels at this level, by default each sid's own
+      row_offset - the swath row of sid[0], a multiple of scan_rows
+    Returns (src_coord,sid,values) of the rows kept, sorted by trixel,
+    where src_coord is the linear index into the swath. With 'mean', only
+    floating point values are averaged; others are those of the kept pixel.
+    """
+    if policy not in bowtie_policies:
+        raise ValueError("Unknown bow-tie policy '%s', expected one of %s."%(policy,bowtie_policies))
+    if values is None:
+        values = {}
+    n_along,n_across = sid.shape
+    row   = np.arange(row_offset,row_offset+n_along)
+    scan  = np.repeat(row//scan_rows,n_across)
+    dist  = np.tile(np.abs(np.arange(n_across)-0.5*(n_across-1)),n_along)
+    flat  = sid.ravel()
+    key   = adapt_sid_resolution(flat,flat & 31 if level is None else level)
+    order = np.lexsort((dist,key))
+    key   = key[order]
+    scan  = scan[order]
+    starts = np.concatenate([[0],np.nonzero(np.diff(key))[0]+1]) if key.size > 0 else np.zeros([0],dtype=np.int64)
+    counts = np.diff(np.append(starts,key.size))
+    multi  = np.minimum.reduceat(scan,starts) != np.maximum.reduceat(scan,starts) if key.size > 0 else np.zeros([0],dtype=bool)
+    src_coord = row_offset*n_across+order
+    if policy == 'nadir':
+        # The first pixel of a trixel is the nearest nadir; keep its scan.
+        keep = np.repeat(~multi,counts) | (scan == np.repeat(scan[starts],counts))
+        src_coord = src_coord[keep]
+        return src_coord,flat[order][keep],dict([(k,np.ravel(v)[order][keep]) for k,v in values.items()])
+    # mean: one row per multi-scan trixel, at its first, nearest nadir, pixel.
+    first = np.zeros(key.size,dtype=bool)
+    first[starts] = True
+    keep  = np.repeat(~multi,counts) | first
+    group = np.repeat(np.arange(starts.size),counts)[keep]
+    ret_values = {}
+    for k,v in values.items():
+        v = np.ravel(v)[order]
+        if not np.issubdtype(v.dtype,np.floating):
+            # Ids and counts are not averaged; they come from the kept pixel.
+            ret_values[k] = v[keep]
+            continue
+        v = v.astype(np.double)
+        finite = np.isfinite(v)
+        sums   = np.add.reduceat(np.where(finite,v,0.0),starts)
+        ns     = np.add.reduceat(finite.astype(np.int64),starts)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            means = sums/ns
+        ret_values[k] = np.where(multi[group],means[group],v[keep])
+    return src_coord[keep],flat[order][keep],ret_values
+
+###########################################################################
+# Granule files.
+
+def read_mod05_variable(hdf,name,row0=0,row1=None):
+    """A variable in physical units, (data-add_offset)*scale_factor, with nan
+    for _FillValue and outside valid_range. Only rows [row0,row1) are read,
+    and they are scaled in place in float32."""
+    sds   = hdf.select(name)
+    attrs = sds.attributes()
+    shape = [int(n) for n in np.atleast_1d(sds.info()[2])]
+    if row1 is None:
+        row1 = shape[0]
+    raw   = sds.get(start=[int(row0)]+[0]*(len(shape)-1),count=[int(row1-row0)]+shape[1:])
+    sds.endaccess()
+    metrics_registry.counter('modis-read-bytes').inc(raw.size,raw.nbytes)
+    invalid = np.zeros(raw.shape,dtype=bool)
+    if '_FillValue' in attrs:
+        invalid |= raw == attrs['_FillValue']
+    if 'valid_range' in attrs:
+        lo,hi = attrs['valid_range']
+        invalid |= (raw < lo) | (raw > hi)
+    data  = raw.astype(np.float32)
+    del raw
+    data -= np.float32(attrs.get('add_offset',0.0))
+    data *= np.float32(attrs.get('scale_factor',1.0))
+    data[invalid] = np.nan
+    return data
+
+def granule_key(fname):
+    "The acquisition date and time of a MODIS file name, e.g. A2005349.2120."
+    return '.'.join(os.path.basename(fname).split('.')[1:3])
+
+def granule_datetime(fname):
+    "The start of a MODIS granule from its file name."
+    adate,hhmm = granule_key(fname).split('.')
+    return dt.datetime(int(adate[1:5]),1,1)+dt.timedelta(days=int(adate[5:8])-1,hours=int(hhmm[0:2]),minutes=int(hhmm[2:4]))
+
+def find_mod03(mod05_fname,directory):
+    "The MOD03 (or MYD03) file in directory for the same granule as mod05_fname, or None."
+    prefix = 'MYD03' if os.path.basename(mod05_fname).startswith('MYD') else 'MOD03'
+    key    = granule_key(mod05_fname)
+    for entry in sorted(os.listdir(directory)):
+        if entry.startswith(prefix+'.') and granule_key(entry) == key:
+            return os.path.join(directory,entry)
+    return None
+
+###########################################################################
+# Covers. A cover's trixels, as sorted, merged ranges of sids, so that
+# testing points or other covers against it is a binary search instead of
+# a cmp_spatial of every pair.
+
+def cover_intervals(cover):
+    "Return (lo,hi), the sorted, disjoint sid ranges spanned by the trixels of cover."
+    cover = np.asarray(cover,dtype=np.int64)
+    if cover.size == 0:
+        return np.zeros([0],dtype=np.int64),np.zeros([0],dtype=np.int64)
+    lo    = gd.spatial_clear_to_resolution(cover) & ~31
+    hi    = gd.spatial_terminator(cover)
+    order = np.argsort(lo,kind='stable')
+    lo,hi = lo[order],np.maximum.accumulate(hi[order])
+    first = np.concatenate([[True],lo[1:] > hi[:-1]])
+    last  = np.append(first[1:],True)
+    return lo[first],hi[last]
+
+def in_cover(sid,intervals):
+    "True where sid falls in a trixel of the cover with intervals."
+    lo,hi = intervals
+    i = np.searchsorted(lo,sid,side='right')-1
+    return (i >= 0) & (sid <= hi[np.maximum(i,0)])
+
+def covers_intersect(a,b):
+    "True if the covers with intervals a and b share any part of a trixel."
+    a_lo,a_hi = a
+    b_lo,b_hi = b
+    if a_lo.size == 0 or b_lo.size == 0:
+        return False
+    i = np.searchsorted(a_lo,b_hi,side='right')-1
+    return bool(np.any((i >= 0) & (a_hi[np.maximum(i,0)] >= b_lo)))
+
+_covers = {}
+
+def granule_cover(fname,resolution=7,cache_dir=None,hdf=None):
+    """The GRING cover of a MODIS granule at resolution, cached in memory
+    and, with cache_dir, on disk as <granule file>.cover<resolution>.npy.
+    The file is opened only if the cover is not cached, or hdf is used."""
+    key = (os.path.basename(fname),resolution)
+    if key not in _covers:
+        cache_fname = None
+        if cache_dir is not None:
+            cache_fname = os.path.join(cache_dir,'%s.cover%02i.npy'%key)
+        if cache_fname is not None and os.path.exists(cache_fname):
+            cover = np.load(cache_fname)
+        else:
+            h = SD(fname,SDC.READ) if hdf is None else hdf
+            cover = np.asarray(gd.modis_cover_from_gring(h,resolution),dtype=np.int64)
+            if hdf is None:
+                h.end()
+            if cache_fname is not None:
+                os.makedirs(cache_dir,exist_ok=True)
+                np.save(cache_fname,cover)
+        _covers[key] = cover
+    return _covers[key]
+
+def roi_cover(lat,lon,radius_deg,resolution=7,ntri_max=1000,n_points=64):
+    "The cover of a circle of radius_deg degrees about (lat,lon), e.g. a job's region of interest."
+    phi = np.linspace(0,2*np.pi,n_points,endpoint=False)
+    return np.asarray(ps.to_hull_range_from_latlon(lat+radius_deg*np.sin(phi),lon+radius_deg*np.cos(phi),resolution,ntri_max),dtype=np.int64)
+
+def in_time_window(fname,time_window=None,granule_minutes=5):
+    "True if the granule of fname overlaps time_window, a (start,end) of datetimes, either None for open."
+    if time_window is None:
+        return True
+    t0,t1 = time_window
+    start = granule_datetime(fname)
+    return (t1 is None or start < t1) and (t0 is None or start+dt.timedelta(minutes=granule_minutes) > t0)
+
+def prefilter_granules(fnames,cover=None,time_window=None,cover_resolution=7,cache_dir=None,granule_minutes=5):
+    """The fnames whose granules overlap time_window and whose GRING cover
+    intersects cover, tested on the file name and cached covers before any
+    science dataset is read. Skipped granules and their file sizes are
+    counted in modis-prefilter-skipped, kept ones in modis-prefilter-kept."""
+    intervals = None if cover is None else cover_intervals(cover)
+    skipped   = metrics_registry.counter('modis-prefilter-skipped')
+    kept      = metrics_registry.counter('modis-prefilter-kept')
+    ret = []
+    for fname in fnames:
+        ok = in_time_window(fname,time_window,granule_minutes)
+        if ok and intervals is not None:
+            ok = covers_intersect(intervals,cover_intervals(granule_cover(fname,cover_resolution,cache_dir)))
+        if ok:
+            ret.append(fname)
+            kept.inc(1,os.path.getsize(fname))
+        else:
+            skipped.inc(1,os.path.getsize(fname))
+    return ret
+
+###########################################################################
+# Granules. A MOD05_L2 granule opened once, whose variables and
+# geolocation are read when asked for, optionally only the scans that
+# cross a region of interest.
+
+class modis05_granule(object):
+    """One MOD05_L2 granule, with its MOD03 if given, read lazily.
+
+    Rows are 1km rows; ranges are whole scans of 10 rows.
+    """
+    def __init__(self,mod05_fname,mod03_fname=None,cover_resolution=7,cache_dir=None):
+        self.mod05_fname      = mod05_fname
+        self.mod03_fname      = mod03_fname
+        self.cover_resolution = cover_resolution
+        self.cache_dir        = cache_dir
+        self.hdf              = None
+        self.data             = {}
+        self._shape           = None
+        self._coarse          = None
+        self._cover           = None
+        return
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+        return False
+
+    def open(self):
+        if self.hdf is None:
+            self.hdf = SD(self.mod05_fname,SDC.READ)
+        return self
+
+    def close(self):
+        if self.hdf is not None:
+            self.hdf.end()
+            self.hdf = None
+        return
+
+    def shape(self,name='Water_Vapor_Near_Infrared'):
+        "(nAlong,nAcross) of the 1km variables."
+        if self._shape is None:
+            sds = self.open().hdf.select(name)
+            self._shape = tuple(sds.info()[2][0:2])
+            sds.endaccess()
+        return self._shape
+
+    def read(self,name,row0=0,row1=None,cache=True):
+        "Variable name in physical units, float32, for rows [row0,row1), cached unless not cache."
+        if row1 is None:
+            row1 = self.shape()[0]
+        key = (name,row0,row1)
+        if key in self.data:
+            return self.data[key]
+        data = read_mod05_variable(self.open().hdf,name,row0,row1)
+        if cache:
+            self.data[key] = data
+        return data
+
+    def coarse_latlon(self):
+        "The 5km (Latitude,Longitude) of the MOD05_L2 file, cached."
+        if self._coarse is None:
+            self._coarse = (self.open().hdf.select('Latitude').get(),self.hdf.select('Longitude').get())
+        return self._coarse
+
+    def geolocation(self,row0=0,row1=None,dtype=np.float64):
+        "The 1km (lat,lon) of rows [row0,row1), from MOD03 or interpolated from 5km."
+        if row1 is None:
+            row1 = self.shape()[0]
+        if self.mod03_fname is None:
+            lat,lon = self.coarse_latlon()
+            return coarse_to_fine_geolocation(lat,lon,'5km_to_1km',row0,row1,dtype,self.cache_dir)
+        geo = SD(self.mod03_fname,SDC.READ)
+        ret = []
+        for name in ['Latitude','Longitude']:
+            sds = geo.select(name)
+            ret.append(sds.get(start=[int(row0),0],count=[int(row1-row0),int(sds.info()[2][1])]).astype(dtype))
+            sds.endaccess()
+        geo.end()
+        return tuple(ret)
+
+    def sids(self,resolution=None,row0=0,row1=None,adaptive=False):
+        "The [row1-row0,nAcross] sids of rows [row0,row1)."
+        if resolution is None:
+            resolution = int(gd.resolution(1))
+        n_along,n_across = self.shape()
+        if row1 is None:
+            row1 = n_along
+        if self.mod03_fname is None:
+            lat,lon = self.coarse_latlon()
+            blocks  = swath_sid_blocks(lat,lon,resolution,'5km_to_1km',start=row0,stop=row1,cache_dir=self.cache_dir,adaptive=adaptive)
+        else:
+            lat,lon = self.geolocation(row0,row1)
+            blocks  = swath_sid_blocks(lat,lon,resolution,adaptive=adaptive)
+        return np.concatenate([sid for r0,r1,sid in blocks],axis=0)[:,0:n_across]
+
+    def cover(self):
+        "The GRING cover, see granule_cover."
+        if self._cover is None:
+            self._cover = granule_cover(self.mod05_fname,self.cover_resolution,self.cache_dir,hdf=self.hdf)
+        return self._cover
+
+    def scan_rows(self,cover,pad_scans=1):
+        """(row0,row1), the whole scans whose 5km geolocation falls in cover,
+        padded by pad_scans on each side, or None if none do. ROIs narrower
+        than the 5km spacing may fall between the points and be missed."""
+        n_along   = self.shape()[0]
+        intervals = cover_intervals(cover)
+        level     = int(np.amax(np.asarray(cover) & 31)) if len(cover) > 0 else 0
+        lat,lon   = self.coarse_latlon()
+        sid       = ps.from_latlon(lat.ravel().astype(np.double),lon.ravel().astype(np.double),level).reshape(lat.shape)
+        rows      = np.nonzero(np.any(in_cover(sid,intervals),axis=1))[0]
+        if rows.size == 0:
+            return None
+        rows_per_coarse = n_along//lat.shape[0]
+        scan0 = max(0,rows[0]*rows_per_coarse//10-pad_scans)
+        scan1 = min((n_along+9)//10,(rows[-1]+1)*rows_per_coarse//10+1+pad_scans)
+        return int(scan0*10),int(min(n_along,scan1*10))
+
+    def read_roi(self,cover,variables=None,resolution=None,adaptive=False,pad_scans=1):
+        """Return (row0,row1,sid,data) for the scans crossing cover, see
+        scan_rows, reading only those rows, or None if the granule misses cover."""
+        if variables is None:
+            variables = ['Water_Vapor_Near_Infrared']
+        rows = self.scan_rows(cover,pad_scans)
+        if rows is None:
+            return None
+        row0,row1 = rows
+        data = dict([(v,self.read(v,row0,row1)) for v in variables])
+        return row0,row1,self.sids(resolution,row0,row1,adaptive),data
+
+###########################################################################
+# Mosaics. Consecutive granules of an orbit are read as one swath, so
+# bow-tie overlaps are resolved across the granule seams and each trixel's
+# rows come out together, once, instead of split between granules. A gap
+# in time ends a segment of consecutive granules, and a segment holds at
+# most about an orbit of granules. Where a run is split into segments,
+# the trixels of the last scan of a segment are held back and resolved
+# with the next segment, which also gets the two scans before its start.
+
+class modis_mosaic(object):
+    """MOD05_L2 granules read as continuous swath segments in trixel order.
+
+    src_coords run on across granules: granule k's pixels start at
+    src_offsets[k], see granule_of.
+    """
+    def __init__(self,mod05_fnames,mod03_fnames=None,variables=None,resolution=None
+                 ,adaptive=False,bowtie=None,granule_minutes=5,max_granules=None
+                 ,cover=None,time_window=None,cache_dir=None):
+        """
+        Input
+          mod05_fnames    - paths of MOD05_L2 granules, in any order
+          mod03_fnames    - matching MOD03 paths, or None to interpolate the 5km geolocation
+          bowtie          - None, 'nadir' or 'mean', see resolve_bowtie; applied across seams
+          granule_minutes - the granule duration; later starts are gaps
+          max_granules    - at most this many granules per segment, to bound memory,
+                            by default an orbit's, see modis_orbit_minutes
+          cover,time_window - granules missing either are dropped, see prefilter_granules
+        """
+        if mod03_fnames is None:
+            mod03_fnames = [None]*len(mod05_fnames)
+        if cover is not None or time_window is not None:
+            keep = set(prefilter_granules(mod05_fnames,cover,time_window,cache_dir=cache_dir,granule_minutes=granule_minutes))
+            mod05_fnames,mod03_fnames = zip(*[(f5,f3) for f5,f3 in zip(mod05_fnames,mod03_fnames) if f5 in keep]) if keep else ([],[])
+        # Sorted by start time, one granule per start.
+        granules = {}
+        for mod05,mod03 in zip(mod05_fnames,mod03_fnames):
+            granules.setdefault(granule_datetime(mod05),(mod05,mod03))
+        self.starts       = sorted(granules.keys())
+        self.granules     = [granules[t] for t in self.starts]
+        self.variables    = ['Water_Vapor_Near_Infrared'] if variables is None else variables
+        self.resolution   = int(gd.resolution(1)) if resolution is None else resolution
+        self.adaptive     = adaptive
+        self.bowtie       = bowtie
+        self.granule_minutes = granule_minutes
+        if max_granules is None:
+            max_granules = max(1,int(round(modis_orbit_minutes/granule_minutes)))
+        self.max_granules = max_granules
+        self.src_offsets  = [0]+[None]*len(self.granules)
+        return
+
+    def consecutive(self,k0,k1):
+        "True if granule k1 starts as granule k0 ends."
+        return self.starts[k1]-self.starts[k0] == dt.timedelta(minutes=self.granule_minutes)
+
+    def segments(self):
+        "Lists of the indices of consecutive granules, at most max_granules each."
+        ret = []
+        for k in range(len(self.starts)):
+            if len(ret) > 0 and self.consecutive(ret[-1][-1],k) and len(ret[-1]) < self.max_granules:
+                ret[-1].append(k)
+            else:
+                ret.append([k])
+        return ret
+
+    def read_granule(self,k):
+        "Return (sid,tid,data) of granule k, with [n_along,n_across] sid and data."
+        mod05,mod03 = self.granules[k]
+        with modis05_granule(mod05,mod03) as granule:
+            data = dict([(v,granule.read(v)) for v in self.variables])
+            sid  = granule.sids(self.resolution,adaptive=self.adaptive)
+        tid = gd.temporal_id_centered_from_modis_filename(os.path.basename(mod05))[0]
+        self.src_offsets[k+1] = self.src_offsets[k]+sid.size
+        return sid,tid,data
+
+    def granule_of(self,src_coord):
+        "The granule index of mosaic src_coords."
+        offsets = np.array([o for o in self.src_offsets[1:] if o is not None],dtype=np.int64)
+        return np.searchsorted(offsets,src_coord,side='right')
+
+    def read_segment(self,segment,carry=None,seam=False,scan_rows=10):
+        """Return (sid,tid,src_coord,columns,carry) of a segment of granules,
+        sorted by trixel, with bow-tie overlaps resolved across the seams.
+
+        carry is that returned for the preceding segment if this one
+        continues it: its rows are resolved with this segment's, and only
+        those in the held back trixels are returned. With seam, the next
+        segment continues this one, so the trixels of the last scan are
+        held back and the returned carry holds the last two scans;
+        otherwise the returned carry is None.
+        """
+        sids,tids,srcs,datas = [],[],[],[]
+        if carry is not None:
+            sids.append(carry['sid'])
+            tids.append(carry['tid'])
+            srcs.append(carry['src'])
+            datas.append(carry['data'])
+        for k in segment:
+            if self.src_offsets[k] is None:
+                raise ValueError('Granule %i read before the granules preceding it.'%k)
+            sid,tid,data = self.read_granule(k)
+            if sid.shape[0] % scan_rows != 0:
+                raise ValueError('Granule %s has %i rows, not whole scans.'%(self.granules[k][0],sid.shape[0]))
+            sids.append(sid)
+            tids.append(np.full(sid.shape,tid,dtype=np.int64))
+            srcs.append(self.src_offsets[k]+np.arange(sid.size,dtype=np.int64).reshape(sid.shape))
+            datas.append(data)
+        sid2d = np.concatenate(sids,axis=0)
+        tid2d = np.concatenate(tids,axis=0)
+        src2d = np.concatenate(srcs,axis=0)
+        data  = dict([(v,np.concatenate([d[v] for d in datas],axis=0)) for v in self.variables])
+        next_carry = None
+        if seam:
+            rows = min(2*scan_rows,sid2d.shape[0])
+            next_carry = {'sid':sid2d[-rows:],'tid':tid2d[-rows:],'src':src2d[-rows:]
+                          ,'data':dict([(k,v[-rows:]) for k,v in data.items()])
+                          ,'seam':np.unique(adapt_sid_resolution(sid2d[-scan_rows:],sid2d[-scan_rows:] & 31))}
+        # tids and src_coords stay out of resolve_bowtie's values, which
+        # 'mean' averages, and follow the kept pixels by their swath index.
+        if self.bowtie is not None:
+            local,sid,data = resolve_bowtie(sid2d,data,policy=self.bowtie)
+        else:
+            flat  = sid2d.ravel()
+            local = np.argsort(adapt_sid_resolution(flat,flat & 31),kind='stable')
+            sid   = flat[local]
+            data  = dict([(k,np.ravel(v)[local]) for k,v in data.items()])
+        flat_tid  = tid2d.ravel()
+        tid       = flat_tid[local]
+        src_coord = src2d.ravel()[local]
+        if not np.all(np.isin(tid,np.unique(flat_tid))):
+            raise ValueError('Mosaic tids are not those of the granules.')
+        keep = np.ones(sid.size,dtype=bool)
+        if carry is not None or next_carry is not None:
+            key = adapt_sid_resolution(sid,sid & 31)
+            if carry is not None:
+                # The carried rows outside the held back trixels were returned before.
+                keep &= (local >= carry['sid'].size) | np.isin(key,carry['seam'])
+            if next_carry is not None:
+                keep &= ~np.isin(key,next_carry['seam'])
+        return sid[keep],tid[keep],src_coord[keep],dict([(k,v[keep]) for k,v in data.items()]),next_carry
+
+    def blocks(self,level=None,max_rows=1<<20):
+        """Yield (sid,tid,src_coord,columns) blocks in trixel order, segment by
+        segment. Blocks end at trixel boundaries of level, so no trixel at
+        level is split between blocks of a segment. At most a segment of
+        granules is in memory at once."""
+        segments = self.segments()
+        carry    = None
+        for i,segment in enumerate(segments):
+            seam = i+1 < len(segments) and self.consecutive(segment[-1],segments[i+1][0])
+            sid,tid,src_coord,columns,carry = self.read_segment(segment,carry,seam)
+            if sid.size == 0:
+                continue
+            if level is None:
+                starts = np.arange(0,sid.size,max_rows)
+            else:
+                key    = adapt_sid_resolution(sid,np.minimum(sid & 31,level))
+                bounds = np.concatenate([[0],np.nonzero(np.diff(key))[0]+1])
+                starts = np.unique(bounds[np.searchsorted(bounds,np.arange(0,sid.size,max_rows),side='right')-1])
+            for i0,i1 in zip(starts,np.append(starts[1:],sid.size)):
+                yield sid[i0:i1],tid[i0:i1],src_coord[i0:i1],dict([(k,v[i0:i1]) for k,v in columns.items()])
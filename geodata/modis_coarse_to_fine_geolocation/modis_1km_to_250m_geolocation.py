@@ -259,6 +259,111 @@ def get_y_pos_1km_to_250m ( isc_1km, itk_p1_1km, itk_p2_1km,
 
     return lat, lon
 
+def get_250m_rows ( lat_1km, lon_1km, itk_250m_start, itk_250m_stop, n_sc_250m = sz_sc_250m, dtype = np.float64 ) :
+    """
+    return the (lat,lon) arrays of the 250m pixels of the along-track rows [itk_250m_start,itk_250m_stop), computed at once with the
+    same inter/extrapolation as get_250m_pix_pos
+    @param lat_1km latitudes dataset at 1km resolution
+    @param lon_1km longitudes dataset at 1km resolution
+    @param itk_250m_start first 250m along-track row
+    @param itk_250m_stop end of the 250m along-track rows
+    @param n_sc_250m number of 250m pixels cross-track
+    @param dtype floating point type of the computation and of the result
+    @return the ( lat, lon ) arrays of shape [ itk_250m_stop - itk_250m_start, n_sc_250m ]
+    """
+    # --- the bounding 1km pixels along track, as in get_250m_pix_pos
+    itk_250m = np.arange ( itk_250m_start, itk_250m_stop )
+    w_scan_250m = 40
+    itk_1km = np.floor ( itk_250m_to_1km ( itk_250m ) ).astype ( np.int64 )
+    start_of_scan = ( itk_250m % w_scan_250m ) <= 1
+    end_of_scan   = ( itk_250m % w_scan_250m ) >= 38
+    itk_p1_1km = np.where ( start_of_scan, np.ceil ( itk_250m_to_1km ( itk_250m ) ).astype ( np.int64 ), itk_1km )
+    itk_p2_1km = np.where ( end_of_scan, itk_p1_1km - 1, itk_p1_1km + 1 )
+
+    # --- the 250m rows on every 1km along-track line, as get_y_pos_1km_to_250m
+    lat_1km = np.asarray ( lat_1km )
+    lon_1km = np.asarray ( lon_1km )
+    p1_lat = lat_1km [ itk_p1_1km, : ].astype ( dtype )
+    p1_lon = lon_1km [ itk_p1_1km, : ].astype ( dtype )
+    p2_lat = lat_1km [ itk_p2_1km, : ].astype ( dtype )
+    p2_lon = lon_1km [ itk_p2_1km, : ].astype ( dtype )
+    dateline = np.abs ( p1_lon - p2_lon ) > 180.
+    p1_negative = p1_lon < 0.
+    p1_lon = np.where ( dateline & p1_negative, p1_lon + 360., p1_lon )
+    p2_lon = np.where ( dateline & ~p1_negative & ( p2_lon < 0. ), p2_lon + 360., p2_lon )
+    d_itk  = np.asarray ( itk_1km_to_250m ( itk_p2_1km ) - itk_1km_to_250m ( itk_p1_1km ), dtype = dtype ) [ :, None ]
+    t_itk  = np.asarray ( itk_250m - itk_1km_to_250m ( itk_p1_1km ), dtype = dtype ) [ :, None ]
+    y_lat  = p1_lat + ( ( p2_lat - p1_lat ) / d_itk ) * t_itk
+    y_lon  = p1_lon + ( ( p2_lon - p1_lon ) / d_itk ) * t_itk
+    y_lon  = np.where ( y_lon > 180., y_lon - 360., np.where ( y_lon < -180., y_lon + 360., y_lon ) )
+
+    # --- the bounding 1km pixels cross track
+    isc_250m = np.arange ( n_sc_250m )
+    isc_left_1km = np.floor ( isc_250m_to_1km ( isc_250m ) ).astype ( np.int64 )
+    isc_left_1km = np.where ( isc_250m_to_1km ( isc_250m ) >= 1353., isc_left_1km - 1, isc_left_1km )
+    isc_right_1km = isc_left_1km + 1
+
+    # --- interpolate along scan between the left and right lines, as get_x_pos_1km_to_250m
+    lat_left  = y_lat [ :, isc_left_1km ]
+    lon_left  = y_lon [ :, isc_left_1km ]
+    lat_right = y_lat [ :, isc_right_1km ]
+    lon_right = y_lon [ :, isc_right_1km ]
+    dateline  = np.abs ( lon_right - lon_left ) > 180.
+    lon_left  = np.where ( dateline & ( lon_left  < 0. ), lon_left  + 360., lon_left  )
+    lon_right = np.where ( dateline & ( lon_right < 0. ), lon_right + 360., lon_right )
+    isc_left_250m = isc_1km_to_250m ( isc_left_1km )
+    d_isc = np.asarray ( isc_1km_to_250m ( isc_right_1km ) - isc_left_250m, dtype = dtype )
+    t_isc = np.asarray ( isc_250m - isc_left_250m, dtype = dtype )
+    lat = lat_left + ( ( lat_right - lat_left ) / d_isc ) * t_isc
+    lon = lon_left + ( ( lon_right - lon_left ) / d_isc ) * t_isc
+    lon = np.where ( lon > 180., lon - 360., np.where ( lon < -180., lon + 360., lon ) )
+    return lat, lon
+
+def iter_250m_geolocation ( lat_1km, lon_1km, itk_250m_start = 0, itk_250m_stop = None, max_pixels = 1 << 22,
+                            n_sc_250m = sz_sc_250m, dtype = np.float64 ) :
+    """
+    yield ( itk_250m, lat, lon ) for tiles of whole scans of 40 250m rows, with about max_pixels pixels per tile, starting at
+    the 250m along-track row itk_250m, to bound the memory used for a granule's ~40M 250m pixels
+    @param lat_1km latitudes dataset at 1km resolution
+    @param lon_1km longitudes dataset at 1km resolution
+    @param itk_250m_start first 250m along-track row
+    @param itk_250m_stop end of the 250m along-track rows, by default 4 rows per 1km row
+    @param max_pixels the number of 250m pixels per tile, rounded to whole scans
+    """
+    sz_tk_250m = 4 * np.shape ( lat_1km ) [0]
+    if itk_250m_stop is None :
+        itk_250m_stop = sz_tk_250m
+    if ( itk_250m_start < 0 ) or ( itk_250m_stop > sz_tk_250m ) or ( itk_250m_start > itk_250m_stop ) :
+        raise ValueError ( "Invalid track range [%d,%d). Must be in [%d,%d]"%(itk_250m_start,itk_250m_stop,0,sz_tk_250m) )
+    if ( n_sc_250m < 0 ) or ( n_sc_250m > sz_sc_250m ) :
+        raise ValueError ( "Invalid scan size %d. Must be in range [%d,%d]"%(n_sc_250m,0,sz_sc_250m) )
+    w_scan_250m = 40
+    rows = max ( w_scan_250m, ( max_pixels // max ( 1, n_sc_250m ) ) // w_scan_250m * w_scan_250m )
+    itk0 = itk_250m_start
+    while itk0 < itk_250m_stop :
+        # end tiles on scan boundaries
+        itk1 = min ( itk_250m_stop, ( itk0 // w_scan_250m ) * w_scan_250m + rows )
+        lat, lon = get_250m_rows ( lat_1km, lon_1km, itk0, itk1, n_sc_250m, dtype )
+        yield itk0, lat, lon
+        itk0 = itk1
+
+def get_250m_geolocation ( lat_1km, lon_1km, itk_250m_start = 0, itk_250m_stop = None, max_pixels = 1 << 22,
+                           n_sc_250m = sz_sc_250m, dtype = np.float64 ) :
+    """
+    return the (lat,lon) arrays of the 250m pixels of a whole granule, or of the along-track rows [itk_250m_start,itk_250m_stop),
+    matching get_250m_pix_pos ; the temporaries are bounded by computing max_pixels at a time, see iter_250m_geolocation
+    @param dtype floating point type of the computation and of the result, e.g. np.float32 to halve the output
+    @return the ( lat, lon ) arrays of shape [ itk_250m_stop - itk_250m_start, n_sc_250m ]
+    """
+    if itk_250m_stop is None :
+        itk_250m_stop = 4 * np.shape ( lat_1km ) [0]
+    lat = np.empty ( ( max ( 0, itk_250m_stop - itk_250m_start ), n_sc_250m ), dtype = dtype )
+    lon = np.empty ( lat.shape, dtype = dtype )
+    for itk0, lat_tile, lon_tile in iter_250m_geolocation ( lat_1km, lon_1km, itk_250m_start, itk_250m_stop, max_pixels, n_sc_250m, dtype ) :
+        lat [ itk0 - itk_250m_start : itk0 - itk_250m_start + lat_tile.shape[0] ] = lat_tile
+        lon [ itk0 - itk_250m_start : itk0 - itk_250m_start + lon_tile.shape[0] ] = lon_tile
+    return lat, lon
+
 def get_1km_pix_to_plot ( itk_250m, isc_250m, lat_1km, lon_1km ) :
     """
     return the arrays of (lat,lon) and of [i,j] labels of the 1km pixelsto draw arounf the (itk_250m, isc_250m) pixel
@@ -262,6 +262,73 @@ def get_y_pos_5km_to_1km (  isc_5km, itk_p1_5km, itk_p2_5km,
 
     return lat, lon
 
+def get_1km_geolocation ( lat_5km, lon_5km, itk_1km_start = 0, itk_1km_stop = None, sz_sc_1km = 1354, dtype = np.float64 ) :
+    """
+    return the (lat,lon) arrays of the 1km pixels of a whole granule, or of the along-track rows [itk_1km_start,itk_1km_stop),
+    computed at once with the same inter/extrapolation as get_1km_pix_pos
+    @param lat_5km latitudes dataset at 5km resolution
+    @param lon_5km longitudes dataset at 5km resolution
+    @param itk_1km_start first 1km along-track row
+    @param itk_1km_stop end of the 1km along-track rows, by default 5 rows per 5km row
+    @param sz_sc_1km number of 1km pixels cross-track
+    @param dtype floating point type of the computation and of the result
+    @return the ( lat, lon ) arrays of shape [ itk_1km_stop - itk_1km_start, sz_sc_1km ]
+    """
+    lat_5km = np.asarray ( lat_5km, dtype = dtype )
+    lon_5km = np.asarray ( lon_5km, dtype = dtype )
+    if itk_1km_stop is None :
+        itk_1km_stop = 5 * lat_5km.shape[0]
+    if ( itk_1km_start < 0 ) or ( itk_1km_stop > 5 * lat_5km.shape[0] ) or ( itk_1km_start > itk_1km_stop ) :
+        raise ValueError ( "Invalid track range [%d,%d). Must be in [%d,%d]"%(itk_1km_start,itk_1km_stop,0,5*lat_5km.shape[0]) )
+    if ( sz_sc_1km < 0 ) or ( sz_sc_1km > ( 5 * sz_sc_5km ) + 6 ) :
+        raise ValueError ( "Invalid scan size %d. Must be in range [%d,%d]"%(sz_sc_1km,0,( 5 * sz_sc_5km ) + 6) )
+
+    # --- the bounding 5km pixels along track, as in get_1km_pix_pos : the 2 5km rows of the scan,
+    # taken in reverse order at the end of the scan
+    itk_1km  = np.arange ( itk_1km_start, itk_1km_stop )
+    w_scan_1km = 10
+    itk_scan_5km = 2 * ( itk_1km // w_scan_1km )
+    end_of_scan  = ( itk_1km % w_scan_1km ) >= 7
+    itk_p1_5km = np.where ( end_of_scan, itk_scan_5km + 1, itk_scan_5km )
+    itk_p2_5km = np.where ( end_of_scan, itk_scan_5km, itk_scan_5km + 1 )
+
+    # --- the 1km rows on every 5km along-track line, as get_y_pos_5km_to_1km
+    p1_lat = lat_5km [ itk_p1_5km, : ]
+    p1_lon = lon_5km [ itk_p1_5km, : ]
+    p2_lat = lat_5km [ itk_p2_5km, : ]
+    p2_lon = lon_5km [ itk_p2_5km, : ]
+    dateline = np.abs ( p1_lon - p2_lon ) > 180.
+    p1_lon = np.where ( dateline & ( p1_lon < 0. ), p1_lon + 360., p1_lon )
+    p2_lon = np.where ( dateline & ( p2_lon < 0. ), p2_lon + 360., p2_lon )
+    d_itk  = np.asarray ( itk_5km_to_1km ( itk_p2_5km ) - itk_5km_to_1km ( itk_p1_5km ), dtype = dtype ) [ :, None ]
+    t_itk  = np.asarray ( itk_1km - itk_5km_to_1km ( itk_p1_5km ), dtype = dtype ) [ :, None ]
+    y_lat  = p1_lat + ( ( p2_lat - p1_lat ) / d_itk ) * t_itk
+    y_lon  = p1_lon + ( ( p2_lon - p1_lon ) / d_itk ) * t_itk
+    y_lon  = np.where ( y_lon > 180., y_lon - 360., np.where ( y_lon < -180., y_lon + 360., y_lon ) )
+
+    # --- the bounding 5km pixels cross track
+    isc_1km = np.arange ( sz_sc_1km )
+    isc_left_5km = np.floor ( isc_1km_to_5km ( isc_1km ) ).astype ( np.int64 )
+    isc_left_5km = np.where ( isc_1km <= 2, 0, isc_left_5km )
+    isc_left_5km = np.where ( isc_1km_to_5km ( isc_1km ) >= ( sz_sc_5km - 1 ), sz_sc_5km - 2, isc_left_5km )
+    isc_right_5km = isc_left_5km + 1
+
+    # --- interpolate along scan between the left and right lines, as get_x_pos_5km_to_1km
+    lat_left  = y_lat [ :, isc_left_5km ]
+    lon_left  = y_lon [ :, isc_left_5km ]
+    lat_right = y_lat [ :, isc_right_5km ]
+    lon_right = y_lon [ :, isc_right_5km ]
+    dateline  = np.abs ( lon_right - lon_left ) > 180.
+    lon_left  = np.where ( dateline & ( lon_left  < 0. ), lon_left  + 360., lon_left  )
+    lon_right = np.where ( dateline & ( lon_right < 0. ), lon_right + 360., lon_right )
+    isc_left_1km = isc_5km_to_1km ( isc_left_5km )
+    d_isc = np.asarray ( isc_5km_to_1km ( isc_right_5km ) - isc_left_1km, dtype = dtype )
+    t_isc = np.asarray ( isc_1km - isc_left_1km, dtype = dtype )
+    lat = lat_left + ( ( lat_right - lat_left ) / d_isc ) * t_isc
+    lon = lon_left + ( ( lon_right - lon_left ) / d_isc ) * t_isc
+    lon = np.where ( lon > 180., lon - 360., np.where ( lon < -180., lon + 360., lon ) )
+    return lat, lon
+
 def get_5km_pix_to_plot ( itk_5km, isc_5km, lat_5km, lon_5km ) :
     """
     return the arrays of (lat,lon) and of [i,j] labels of the 5km pixels that bound the one at (itk_5km, isc_5km).
@@ -0,0 +1,206 @@
+
+# geodata/modis_to_stare.py
+
+# Convert MODIS MOD05_L2 granules to STARE indexed, columnar HDF5, one
+# output file per granule, replacing sketchG's per-pixel loop.
+#
+#   python -m geodata.modis_to_stare /data/MODIS /data/MODIS-stare --processes 8
+#
+# /image has a row per 1km pixel with stare_spatial, stare_temporal,
+# src_coord and the variables in physical units (float32, nan where
+# filled), optionally with Latitude and Longitude. Geolocation comes from
+# the companion MOD03 file if one is found, or else from the 5km
+# Latitude/Longitude in MOD05_L2.
+
+import argparse
+import datetime as dt
+import fnmatch
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py as h5
+import numpy as np
+from pyhdf.SD import SD, SDC
+
+import geodata as gd
+
+try:
+    from geodata.modis import swath_sids, coarse_to_fine_geolocation, resolve_bowtie, read_mod05_variable, find_mod03\
+        , prefilter_granules, roi_cover
+    from geodata.stopwatch import sw_timer, timed_worker, merge_worker_results
+    from geodata.metrics import metrics_registry
+    import geodata.joined_h5 as jh5
+except ImportError:
+    from modis import swath_sids, coarse_to_fine_geolocation, resolve_bowtie, read_mod05_variable, find_mod03\
+        , prefilter_granules, roi_cover
+    from stopwatch import sw_timer, timed_worker, merge_worker_results
+    from metrics import metrics_registry
+    import joined_h5 as jh5
+
+default_variables = ['Water_Vapor_Near_Infrared']
+
+image_description_dtype = np.dtype([
+    ('src_file','S256')
+    ,('geo_file','S256')
+    ,('nAlong',np.int64)
+    ,('nAcross',np.int64)
+])
+
+def mod05_image_dtype(variables=None,latlon=False):
+    "The row type of a converted granule."
+    if variables is None:
+        variables = default_variables
+    fields = [('stare_spatial',np.int64),('stare_temporal',np.int64),('src_coord',np.int32)]
+    if latlon:
+        fields = fields+[('Latitude',np.float32),('Longitude',np.float32)]
+    return np.dtype(fields+[(v,np.float32) for v in variables])
+
+def mod05_to_stare_h5(mod05_fname,out_fname,mod03_fname=None,variables=None,resolution=None,latlon=False
+                      ,compression='gzip',shuffle=True,max_pixels=1<<20,adaptive=False,bowtie=None):
+    """Write the STARE indexed /image of one MOD05_L2 granule to out_fname.
+
+    Geolocation is read from mod03_fname if given, else interpolated from
+    the granule's 5km geolocation. resolution is the STARE level, by
+    default that of 1km. With adaptive, pixels toward the ends of the scan
+    get coarser levels, see scan_level_table. With bowtie, 'nadir' or
+    'mean', pixels of overlapping scans are resolved by resolve_bowtie and
+    /image is sparse, sorted by trixel. Returns out_fname.
+    """
+    if variables is None:
+        variables = default_variables
+    if resolution is None:
+        resolution = int(gd.resolution(1))
+    sw_timer.stamp('mod05_to_stare_h5-start')
+    hdf  = SD(mod05_fname,SDC.READ)
+    data = dict([(v,read_mod05_variable(hdf,v)) for v in variables])
+    n_along,n_across = data[variables[0]].shape
+    if mod03_fname is None:
+        lat,lon = hdf.select('Latitude').get(),hdf.select('Longitude').get()
+        plan    = '5km_to_1km'
+    else:
+        geo = SD(mod03_fname,SDC.READ)
+        lat,lon = geo.select('Latitude').get(),geo.select('Longitude').get()
+        geo.end()
+        plan = None
+    hdf.end()
+    sw_timer.stamp('mod05_to_stare_h5-read')
+
+    sid = swath_sids(lat,lon,resolution,plan,max_pixels=max_pixels,adaptive=adaptive)[0:n_along,0:n_across]
+    tid = gd.temporal_id_centered_from_modis_filename(os.path.basename(mod05_fname))[0]
+    sw_timer.stamp('mod05_to_stare_h5-index')
+
+    if latlon:
+        if plan is not None:
+            lat,lon = coarse_to_fine_geolocation(lat,lon,plan,stop=n_along)
+        data['Latitude']  = np.asarray(lat,dtype=np.float32)[0:n_along,0:n_across]
+        data['Longitude'] = np.asarray(lon,dtype=np.float32)[0:n_along,0:n_across]
+    attrs = {'stare_resolution':resolution,'stare_adaptive':int(adaptive)}
+    if bowtie is None:
+        src_coord = np.arange(n_along*n_across,dtype=np.int32)
+        sid       = sid.flatten()
+        data      = dict([(k,v.flatten()) for k,v in data.items()])
+    else:
+        src_coord,sid,data = resolve_bowtie(sid,data,policy=bowtie)
+        attrs['cells']  = 'sparse'
+        attrs['bowtie'] = bowtie
+    sw_timer.stamp('mod05_to_stare_h5-bowtie')
+
+    with h5.File(out_fname,'w') as workFile:
+        writer = jh5.image_writer(workFile,sid.size,dtype=mod05_image_dtype(variables,latlon),layout='columnar'
+                                  ,compression=compression,shuffle=shuffle,chunk_rows=n_across*10,attrs=attrs)
+        writer.write('stare_spatial',sid)
+        writer.write('stare_temporal',tid)
+        writer.write('src_coord',src_coord.astype(np.int32))
+        for k in data:
+            writer.write(k,data[k].astype(np.float32))
+        description = np.zeros([],dtype=image_description_dtype)
+        description['src_file'] = os.path.basename(mod05_fname).encode('ascii','ignore')
+        description['geo_file'] = ('' if mod03_fname is None else os.path.basename(mod03_fname)).encode('ascii','ignore')
+        description['nAlong']   = n_along
+        description['nAcross']  = n_across
+        workFile.create_dataset('image_description',data=description)
+    sw_timer.stamp('mod05_to_stare_h5-write')
+    metrics_registry.counter('modis_to_stare-pixels').inc(sid.size)
+    return out_fname
+
+def stare_h5_name(mod05_fname,outdir):
+    "e.g. MOD05_L2.A2005349.2120.061.2017294065852.stare.h5"
+    return os.path.join(outdir,os.path.basename(mod05_fname)[0:-4]+'.stare.h5')
+
+def convert_directory(directory,outdir,pattern='MOD05_L2*.hdf',use_mod03=True,processes=None
+                      ,variables=None,resolution=None,latlon=False,compression='gzip',overwrite=False,adaptive=False,bowtie=None
+                      ,cover=None,time_window=None,cover_cache=None):
+    """Convert every granule matching pattern in directory, across a process pool.
+
+    With use_mod03, a granule's MOD03 in directory is used if there is one.
+    With cover or time_window, granules missing the region of interest or
+    the (start,end) window are dropped first, see prefilter_granules, with
+    GRING covers cached in cover_cache. Existing outputs are skipped unless
+    overwrite. Returns the output names.
+    """
+    os.makedirs(outdir,exist_ok=True)
+    mod05_fnames = [os.path.join(directory,entry) for entry in sorted(os.listdir(directory)) if fnmatch.fnmatch(entry,pattern)]
+    if cover is not None or time_window is not None:
+        skipped = metrics_registry.counter('modis-prefilter-skipped').reset()
+        kept    = metrics_registry.counter('modis-prefilter-kept').reset()
+        mod05_fnames = prefilter_granules(mod05_fnames,cover,time_window,cache_dir=cover_cache)
+        skipped.emit()
+        kept.emit()
+    jobs = []
+    for mod05_fname in mod05_fnames:
+        out_fname   = stare_h5_name(mod05_fname,outdir)
+        if os.path.exists(out_fname) and not overwrite:
+            continue
+        mod03_fname = find_mod03(mod05_fname,directory) if use_mod03 else None
+        jobs.append((mod05_fname,out_fname,mod03_fname))
+    ret = []
+    kwargs = {'variables':variables,'resolution':resolution,'latlon':latlon,'compression':compression,'adaptive':adaptive,'bowtie':bowtie}
+    with metrics_registry.progress('modis_to_stare-granules',total=len(jobs),unit='granules') as progress:
+        if processes == 1 or len(jobs) < 2:
+            for job in jobs:
+                ret.append(mod05_to_stare_h5(*job,**kwargs))
+                progress.update()
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                futures = [pool.submit(timed_worker(mod05_to_stare_h5),*job,**kwargs) for job in jobs]
+                for future in futures:
+                    ret.append(merge_worker_results([future.result()])[0])
+                    progress.update()
+    return ret
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='geodata.modis_to_stare',description='Convert MOD05_L2 granules to STARE indexed HDF5.')
+    parser.add_argument('directory')
+    parser.add_argument('outdir')
+    parser.add_argument('--pattern',default='MOD05_L2*.hdf')
+    parser.add_argument('--variables',nargs='+',default=default_variables)
+    parser.add_argument('--resolution',type=int,default=None,help='STARE level, by default that of 1km')
+    parser.add_argument('--no-mod03',action='store_true',help='interpolate the 5km geolocation even if MOD03 is present')
+    parser.add_argument('--latlon',action='store_true',help='also write Latitude and Longitude')
+    parser.add_argument('--adaptive',action='store_true',help='coarser STARE levels toward the ends of the scan')
+    parser.add_argument('--bowtie',choices=['nadir','mean'],default=None,help='resolve overlapping scans, writing a sparse /image')
+    parser.add_argument('--compression',default='gzip',choices=['gzip','lzf','none'])
+    parser.add_argument('--processes',type=int,default=None)
+    parser.add_argument('--overwrite',action='store_true')
+    parser.add_argument('--roi',nargs=3,type=float,default=None,metavar=('LAT','LON','RADIUS'),help='only granules whose GRING cover meets this circle, in degrees')
+    parser.add_argument('--roi-resolution',type=int,default=7,help='STARE level of the ROI cover')
+    parser.add_argument('--start',default=None,help='only granules ending after this time, e.g. 2005-12-15T03:00')
+    parser.add_argument('--end',default=None,help='only granules starting before this time')
+    parser.add_argument('--cover-cache',default=None,help='directory caching granule GRING covers')
+    args = parser.parse_args(argv)
+    cover = None if args.roi is None else roi_cover(args.roi[0],args.roi[1],args.roi[2],args.roi_resolution)
+    time_window = None
+    if args.start is not None or args.end is not None:
+        time_window = tuple(None if t is None else dt.datetime.fromisoformat(t) for t in (args.start,args.end))
+    outputs = convert_directory(args.directory,args.outdir,pattern=args.pattern,use_mod03=not args.no_mod03
+                                ,processes=args.processes,variables=args.variables,resolution=args.resolution
+                                ,latlon=args.latlon,compression=None if args.compression == 'none' else args.compression
+                                ,overwrite=args.overwrite,adaptive=args.adaptive,bowtie=args.bowtie
+                                ,cover=cover,time_window=time_window,cover_cache=args.cover_cache)
+    for fname in outputs:
+        print(fname)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
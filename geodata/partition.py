@@ -0,0 +1,232 @@
+
+# geodata/partition.py
+
+# Partition data into one h5 file per STARE trixel (sare_partition) and
+# stitch partitions back together with HDF5 virtual datasets. Promoted
+# from sketchH0, sketchJ0 and sketchJ3.
+#
+# Partition files are named s<sid>.<name_base>.h5 with the sid in hex, so
+# the trixel of a file can be recovered from its name (sare_from_fname).
+
+import os
+
+import h5py as h5
+import numpy as np
+import pystare as ps
+
+import geodata as gd
+
+###########################################################################
+#
+partition_metadata_dtype = np.dtype([
+    ('sare_id',np.int64)
+    ,('shape0',np.int32)
+    ,('shape1',np.int32)
+    ,('dataset_name','S1024')
+    ,('src_name','S1024')
+    ,('n_data',np.int64)
+])
+
+class sare_partition(object):
+    "The data of one source falling in one trixel, sid, stored as one h5 file."
+    def __init__(self,sid,name_base="",src_name='None',var_nmax=None,directory=None):
+        self.sid       = sid # The spatial id associated with the SARE partition
+        self.name_base = name_base
+        self.fname     = "s%016x.%s.h5"%(sid,name_base)
+        if directory is not None:
+            self.fname = os.path.join(directory,self.fname)
+        self.src_name  = src_name
+        self.var_nmax  = var_nmax
+        self.dtype     = None
+        return
+
+    def write1(self,shape=None,dataset_name="vars",vars={}):
+        """
+        Input
+          shape - the shape of the original source array [nacross, nalong]
+          vars - is a dictionary of np vars
+            'sare' - spatial ids, a numpy array with a position for each row in the 'tables'
+            'src_coord' - the index position in the original source array
+
+        With var_nmax set, the dataset is padded with -1 to var_nmax rows so
+        that partitions can be stacked into a fixed width virtual dataset.
+        """
+        self.dtype = [(i,vars[i].dtype) for i in vars]
+        vars_ns    = np.array([len(vars[i]) for i in vars],dtype=np.int64)
+        if np.amin(vars_ns) != np.amax(vars_ns):
+            raise ValueError('Arrays to be output have different lengths.')
+        src_vars_n = int(vars_ns[0])
+        tgt_vars_n = src_vars_n
+        if self.var_nmax is not None:
+            if self.var_nmax < src_vars_n:
+                raise ValueError('var_nmax=%i is too small, vars_n=%i'%(self.var_nmax,src_vars_n))
+            tgt_vars_n = self.var_nmax
+
+        with h5.File(self.fname,'w') as outFile:
+            outFile.create_dataset('metadata',[1],dtype=partition_metadata_dtype)
+            outFile['metadata']['sare_id']       = self.sid
+            outFile['metadata']['shape0']        = shape[0]
+            outFile['metadata']['shape1']        = shape[1]
+            outFile['metadata']['dataset_name']  = dataset_name
+            outFile['metadata']['src_name']      = self.src_name
+            outFile['metadata']['n_data']        = src_vars_n
+
+            table = np.full([tgt_vars_n],-1,dtype=self.dtype)
+            for i in vars:
+                table[i][0:src_vars_n] = vars[i][0:src_vars_n]
+            outFile.create_dataset(dataset_name,data=table)
+        return
+
+    def read1(self):
+        "Return (shape,dataset_name,vars,vars_dtype,metadata_dtype), dropping any padding."
+        with h5.File(self.fname,'r') as inFile:
+            dataset_name = inFile['metadata']['dataset_name'][0]
+            if isinstance(dataset_name,bytes):
+                dataset_name = dataset_name.decode()
+            shape        = (inFile['metadata']['shape0'][0],inFile['metadata']['shape1'][0])
+            src_vars_n   = inFile['metadata']['n_data'][0]
+            table        = inFile[dataset_name][0:src_vars_n]
+            vars = {}
+            for i in table.dtype.names:
+                vars[i] = table[i].copy()
+            vars_dtype     = inFile[dataset_name].dtype
+            metadata_dtype = inFile['metadata'].dtype
+        return (shape,dataset_name,vars,vars_dtype,metadata_dtype)
+
+def write_partitions(sid_cover,name_base,sare,vars,shape,dataset_name='vars',src_name='None',directory=None,fixed_width=True):
+    """Write one sare_partition per cover trixel holding the rows whose sare it contains.
+
+    Input
+      sid_cover - the trixels to partition into, e.g. a granule's cover
+      sare      - the spatial id of each row of vars
+      vars      - a dictionary of equal length numpy arrays, e.g. with 'src_coord'
+    With fixed_width, every partition is padded to the largest so that
+    make_vds can stack them. Returns the partition file names and the width.
+    """
+    idx_all = {}
+    nmax    = 0
+    for sid in sid_cover:
+        idx_all[sid] = np.nonzero(ps.cmp_spatial(np.array([sid],dtype=np.int64),sare) != 0)[0]
+        nmax = max(nmax,idx_all[sid].size)
+    fnames = []
+    for sid in sid_cover:
+        idx   = idx_all[sid]
+        spart = sare_partition(sid,name_base,src_name=src_name,var_nmax=nmax if fixed_width else None,directory=directory)
+        spart.write1(shape=shape,dataset_name=dataset_name
+                     ,vars=dict([('sare',sare[idx])]+[(k,v[idx]) for k,v in vars.items()]))
+        fnames.append(spart.fname)
+    return fnames,nmax
+
+def write_sorted_partitions(level,name_base,sare,vars,shape,dataset_name='vars',src_name='None',directory=None,fixed_width=True):
+    """Write one sare_partition per trixel at level for rows already sorted
+    by trixel, e.g. by resolve_bowtie or modis_mosaic.blocks.
+
+    The partitions are contiguous runs of sare, so no cover or cmp_spatial
+    is needed and each row lands in exactly one partition. Rows with sare
+    coarser than level go to the partition of their own trixel. Returns the
+    partition file names and the width, as write_partitions.
+    """
+    sare   = np.asarray(sare,dtype=np.int64)
+    levels = np.minimum(sare & 31,level)
+    key    = (sare & ~((np.int64(1) << (59-2*levels))-1)) | levels
+    if np.any(np.diff(key) < 0):
+        raise ValueError('sare is not sorted by trixel at level %i.'%level)
+    bounds = np.concatenate([[0],np.nonzero(np.diff(key))[0]+1,[key.size]])
+    nmax   = int(np.amax(np.diff(bounds))) if key.size > 0 else 0
+    fnames = []
+    for i0,i1 in zip(bounds[:-1],bounds[1:]):
+        spart = sare_partition(int(key[i0]),name_base,src_name=src_name,var_nmax=nmax if fixed_width else None,directory=directory)
+        spart.write1(shape=shape,dataset_name=dataset_name
+                     ,vars=dict([('sare',sare[i0:i1])]+[(k,v[i0:i1]) for k,v in vars.items()]))
+        fnames.append(spart.fname)
+    return fnames,nmax
+
+def make_vds(vds_fname,spart_names,dataset_name,var_nmax,vars_dtype,metadata_dtype=partition_metadata_dtype):
+    "Stack fixed width partitions into a [len(spart_names),var_nmax] virtual dataset plus their metadata."
+    layout    = h5.VirtualLayout(shape=(len(spart_names),var_nmax),dtype=vars_dtype)
+    layout_md = h5.VirtualLayout(shape=(len(spart_names),1),dtype=metadata_dtype)
+    for i in range(len(spart_names)):
+        layout[i]    = h5.VirtualSource(spart_names[i],dataset_name,shape=(var_nmax,))
+        layout_md[i] = h5.VirtualSource(spart_names[i],'metadata',shape=(1,))
+    with h5.File(vds_fname,'w',libver='latest') as f:
+        f.create_virtual_dataset(dataset_name,layout)
+        f.create_virtual_dataset('metadata',layout_md)
+    return vds_fname
+
+###########################################################################
+# Building coarser levels of virtual datasets.
+
+def sare_from_fname(fname):
+    "The sid of a partition file named s<sid>.*.h5."
+    return int(os.path.basename(fname).split('.')[0][1:],16)
+
+def build_coarser_level(fnames):
+    "Group partition files by the parent of their trixel, one level coarser."
+    sares = [sare_from_fname(i) for i in fnames]
+    resolutions = [gd.spatial_resolution(i) for i in sares]
+    if len(set(resolutions)) != 1:
+        raise ValueError('Filenames indicate multiple resolutions.')
+    resolution = resolutions[0]
+    coarser = {}
+    for i,sare in zip(fnames,sares):
+        si = gd.spatial_clear_to_resolution(gd.spatial_coerce_resolution(sare,resolution-1))
+        if si not in coarser.keys():
+            coarser[si] = []
+        coarser[si].append(i)
+    return coarser
+
+def src_coord_segments(src_coord):
+    "Return (starts,ends) of the runs of consecutive src_coords, ordered by the src_coord they start with."
+    n = src_coord.size
+    if n == 0:
+        return np.zeros([0],dtype=np.int64),np.zeros([0],dtype=np.int64)
+    breaks = np.nonzero(np.diff(src_coord) != 1)[0]+1
+    starts = np.concatenate([[0],breaks])
+    ends   = np.concatenate([breaks,[n]])
+    order  = np.argsort(src_coord[starts],kind='stable')
+    return starts[order],ends[order]
+
+def make_virtual(base_name,fnames,dataset_names,realign=False,sort=True):
+    """Concatenate the 1D datasets of fnames into the virtual datasets of base_name.
+
+    With sort and a 'src_coord' field, each file's rows are mapped in runs
+    of consecutive src_coord, in src_coord order. With realign, rows land
+    at their src_coord instead of packed one file after another.
+    """
+    layouts = {}
+    for dsn in dataset_names:
+        with h5.File(fnames[0],'r') as h:
+            ds_dtype = h[dsn].dtype
+        var_ns      = []
+        var_n_cumul = [0]
+        for f in fnames:
+            with h5.File(f,'r') as h:
+                var_ns.append(h[dsn].shape[0]) # Assume 1D
+                var_n_cumul.append(var_n_cumul[-1]+var_ns[-1])
+        layouts[dsn] = h5.VirtualLayout(shape=(var_n_cumul[-1],),dtype=ds_dtype)
+        for i in range(len(fnames)):
+            if var_ns[i] == 0:
+                continue
+            vs = h5.VirtualSource(fnames[i],dsn,shape=(var_ns[i],))
+            src_coord = None
+            if sort:
+                with h5.File(fnames[i],'r') as h:
+                    if 'src_coord' in h[dsn].dtype.names:
+                        src_coord = h[dsn]['src_coord']
+            if src_coord is None:
+                layouts[dsn][var_n_cumul[i]:var_n_cumul[i+1]] = vs[:]
+                continue
+            l = var_n_cumul[i]
+            for j0,j1 in zip(*src_coord_segments(src_coord)):
+                if realign:
+                    k0 = src_coord[j0]
+                    k1 = src_coord[j1-1]+1
+                else:
+                    k0 = l
+                    k1 = l + j1-j0
+                    l  = k1
+                layouts[dsn][k0:k1] = vs[j0:j1]
+    with h5.File(base_name,'w') as h:
+        for i in layouts: # i.e. dsn's
+            h.create_virtual_dataset(i,layouts[i])
+    return base_name
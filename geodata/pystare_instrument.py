@@ -0,0 +1,164 @@
+
+# geodata/pystare_instrument.py
+
+# Opt-in counting and timing of pystare calls by call site, to find calls
+# made with a few elements at a time inside loops.
+#
+#   import geodata.pystare_instrument as psi
+#   psi.enable()
+#   ...
+#   print(psi.report())
+#   psi.disable()
+
+import os
+import sys
+import threading
+from functools import wraps
+from time import perf_counter
+
+import numpy as np
+import pystare as ps
+
+# The entry points we spend our time in.
+default_functions = [
+    'from_latlon'
+    ,'to_latlon'
+    ,'cmp_spatial'
+    ,'cmp_temporal'
+    ,'to_hull_range_from_latlon'
+    ,'to_compressed_range'
+    ,'expand_intervals'
+    ,'triangulate_indices'
+    ,'to_vertices_latlon'
+    ,'adapt_resolution_to_proximity'
+    ,'to_circular_cover'
+    ,'intersect'
+    ,'from_utc'
+    ,'to_utc_approximate'
+]
+
+_lock      = threading.Lock()
+_originals = {}
+_stats     = {}
+
+class call_stat(object):
+    "Calls of one pystare function from one call site."
+    def __init__(self):
+        self.calls        = 0
+        self.elements     = 0
+        self.time         = 0.0
+        self.small_calls  = 0
+        return
+
+    def add(self,elements,dt,small):
+        self.calls    += 1
+        self.elements += elements
+        self.time     += dt
+        if elements <= small:
+            self.small_calls += 1
+        return
+
+def input_elements(args):
+    "The size of the first array argument, or 1 if there is none."
+    for a in args:
+        if isinstance(a,np.ndarray):
+            return a.size
+        if isinstance(a,(list,tuple)):
+            return len(a)
+    return 1
+
+def call_site(depth):
+    "file:line (function) of the caller depth frames above the wrapper's caller."
+    f = sys._getframe(depth+2)
+    return '%s:%i (%s)'%(os.path.basename(f.f_code.co_filename),f.f_lineno,f.f_code.co_name)
+
+def instrument(name,func,depth=0,small=1):
+    "Wrap func to record a call_stat for (name,call site)."
+    @wraps(func)
+    def wrapper(*args,**kwargs):
+        site  = call_site(depth)
+        start = perf_counter()
+        ret   = func(*args,**kwargs)
+        dt    = perf_counter() - start
+        key   = (name,site)
+        with _lock:
+            if key not in _stats:
+                _stats[key] = call_stat()
+            _stats[key].add(input_elements(args),dt,small)
+        return ret
+    wrapper.__wrapped_pystare__ = func
+    return wrapper
+
+def enable(functions=None,depth=0,small=1):
+    """Replace pystare functions with instrumented wrappers.
+
+    Code calling ps.<function> at call time is instrumented. Names bound
+    earlier with 'from pystare import ...' are not. depth attributes calls
+    to frames further up the stack, e.g. 1 for the caller of a helper.
+    Calls with at most small input elements are counted as small calls.
+    """
+    if functions is None:
+        functions = default_functions
+    for name in functions:
+        if name in _originals or not hasattr(ps,name):
+            continue
+        _originals[name] = getattr(ps,name)
+        setattr(ps,name,instrument(name,_originals[name],depth,small))
+    return
+
+def disable():
+    "Restore the original pystare functions. The statistics are kept."
+    for name,func in list(_originals.items()):
+        setattr(ps,name,func)
+        del _originals[name]
+    return
+
+def enabled():
+    return len(_originals) > 0
+
+def reset():
+    "Drop the statistics."
+    with _lock:
+        _stats.clear()
+    return
+
+class instrumented(object):
+    "with instrumented(): ... enables instrumentation for the block."
+    def __init__(self,functions=None,depth=0,small=1):
+        self.functions = functions
+        self.depth     = depth
+        self.small     = small
+        return
+
+    def __enter__(self):
+        enable(self.functions,self.depth,self.small)
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        disable()
+        return False
+
+def stats():
+    "A list of dicts, one per (function, call site), most time first."
+    with _lock:
+        items = [(k,v.calls,v.elements,v.time,v.small_calls) for k,v in _stats.items()]
+    ret = []
+    for (name,site),calls,elements,time,small_calls in items:
+        ret.append({'function':name,'site':site,'calls':calls,'elements':elements,'time':time\
+                    ,'small_calls':small_calls,'elements_per_call':elements/calls\
+                    ,'time_per_element':time/elements if elements > 0 else 0.0})
+    ret.sort(key=lambda s: -s['time'])
+    return ret
+
+def report(prefix='',limit=None,batch_threshold=16):
+    """The stats() as text. Sites averaging fewer than batch_threshold
+    elements per call over more than one call are marked 'batch?'."""
+    ret_str = prefix + '<pystare-calls>\n'
+    ret_str = ret_str + prefix + "'function','site','calls','elements','time (s)','elements/call','us/element','small calls',''\n"
+    for s in stats()[:limit]:
+        flag = 'batch?' if s['calls'] > 1 and s['elements_per_call'] < batch_threshold else ''
+        ret_str = ret_str + prefix + "'%s','%s',%i,%i,%f,%.1f,%.3f,%i,'%s'\n"\
+                  %(s['function'],s['site'],s['calls'],s['elements'],s['time']\
+                    ,s['elements_per_call'],1.0e6*s['time_per_element'],s['small_calls'],flag)
+    ret_str = ret_str + prefix + '</pystare-calls>\n'
+    return ret_str
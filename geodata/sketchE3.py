@@ -18,6 +18,8 @@ import cartopy.crs as ccrs
 import yaml
 
 from stopwatch import sw_timer
+from metrics import metrics_registry
+from joined_h5 import read_image
 
 import cv2
 from ccl_marker_stack import ccl_marker_stack
@@ -111,17 +113,20 @@ class ccl_tracker(object):
 
         tpw_scale  = workFile['/merra2_description']['tpw_scale']
         tpw_offset = workFile['/merra2_description']['tpw_offset']
-        m2_img = tpw_offset + tpw_scale*workFile['/image']['merra2_tpw']
-
-        # b3_img = workFile['/image']['goes_b3']
-        b4_img = workFile['/image']['goes_b4']
-        b5_img = workFile['/image']['goes_b5']
 
         nx = workFile['/image_description']['nx']
         ny = workFile['/image_description']['ny']
 
         workFile.close()
 
+        # Only read the columns we need, works for compound and columnar files.
+        image = read_image(workFileName,columns=['merra2_tpw','goes_b4','goes_b5'])
+        m2_img = tpw_offset + tpw_scale*image['merra2_tpw']
+
+        # b3_img = image['goes_b3']
+        b4_img = image['goes_b4']
+        b5_img = image['goes_b5']
+
         # Mask to valid and shift data values to zero
         bx_lo = self.bx_lo
         idx_valid   = np.where((b5_img>bx_lo) & (b4_img>bx_lo))
@@ -398,8 +403,9 @@ if __name__ == '__main__':
     tracker.verbose    = False
     tracker.verbose_io = True
     tracker.viz0       = False
-    while tracker.next():
-        print('iter: ',tracker.current_file,' time (s): ',sw_timer.delta_since_start())
+    with metrics_registry.progress('ccl_tracker',total=len(workFileNames),interval=0,unit='files') as progress:
+        while tracker.next():
+            progress.update()
     tracker.resolve()
     tracker.save_resolution()
     sw_timer.stamp('main end')
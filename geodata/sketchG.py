@@ -16,6 +16,7 @@ import pystare as ps
 import h5py as h5
 
 import modis_coarse_to_fine_geolocation.modis_5km_to_1km_geolocation as pascal_modis
+from metrics import metrics_registry
 
 ###########################################################################
 
@@ -117,13 +118,9 @@ print('resolution ',type(resolution))
 
 # exit()
 
-ktr = 0
-ktr_max = nAlong*nAcross
-print('interpolate from 5km to 1km: %2d%%'%int(100*ktr/ktr_max),end='\r',flush=True)
+progress = metrics_registry.progress('interpolate from 5km to 1km',total=nAlong*nAcross,unit='pixels')
 for itk_1km in range(nAlong):
     for isc_1km in range(nAcross):
-        if int(100*ktr/ktr_max) % 5 == 0 or int(100*ktr/ktr_max) < 2:
-            print('interpolate from 5km to 1km: %2d%%'%int(100*ktr/ktr_max),end='\r',flush=True)
         if False:
             lat[itk_1km,isc_1km],lon[itk_1km,isc_1km] = pascal_modis.get_1km_pix_pos(itk_1km,isc_1km,lat_5km,lon_5km)
         else:
@@ -133,8 +130,8 @@ for itk_1km in range(nAlong):
             ,np.array([lon[itk_1km,isc_1km]])
             ,resolution)
         stare_temporal[itk_1km,isc_1km] = tid # TODO use np.timedelta for more temporal resolution
-        ktr = ktr + 1
-print('interpolate from 5km to 1km: done')
+    progress.update(nAcross)
+progress.close()
 
 workFile = h5.File(workFileName,'w')
 
@@ -15,6 +15,8 @@ import h5py as h5
 from pyhdf.SD import SD, SDC
 
 from stopwatch import sw_timer as timer
+from metrics import metrics_registry
+from partition import sare_partition
 
 import pystare as ps
 
@@ -29,116 +31,6 @@ def safe_shape(x):
         ret = None
         pass
     return ret
-#
-###########################################################################
-#
-
-class sare_partition(object):
-    sid        = None
-    data       = None
-    dtype      = None
-    name_base  = None
-    var_name   = None
-    shape      = None # (nAcross,nAlong)
-    src_name   = None
-    
-    def __init__(self,sid,name_base="",src_name='None',var_nmax=None):
-        self.sid       = sid # The spatial id associated with the SARE partition
-        self.name_base = name_base
-        self.fname     = "s%016x.%s.h5"%(sid,name_base)
-        self.src_name  = src_name
-        self.var_nmax  = var_nmax
-        return
-
-    def write1(self,shape=None,dataset_name="vars",vars={}):
-        """
-        Input
-          shape - the shape of the original source array [nacross, nalong]
-          vars - is a dictionary of np vars
-            'sare' - spatial ids, a numpy array with a position for each row in the 'tables'
-            'src_coord' - the index position in the original source array
-        """
-        self.dtype     = [(i,vars[i].dtype) for i in vars]
-        # if sare and src_coord are not in self.dtype.names then raise?
-        vars_ns  = np.array([len(vars[i]) for i in vars],dtype=np.int)
-        vars_nmn = np.amin(vars_ns)
-        vars_nmx = np.amax(vars_ns)
-        if vars_nmn != vars_nmx:
-            raise ValueError('Arrays to be output have different lengths.')
-        vars_n = vars_nmn
-        if self.var_nmax is not None:
-            if self.var_nmax < vars_n:
-                raise ValueError('var_nmax=%i is too small, vars_n=%i'%(self.var_nmax,vars_n))
-            src_vars_n = vars_n
-            tgt_vars_n = self.var_nmax
-        else:
-            src_vars_n = vars_n
-            tgt_vars_n = vars_n
-
-        # print('writing %i items into an array of %i items.'%(src_vars_n,tgt_vars_n))
-        # print('input array size %i'%(len(vars['sare'])))
-
-        outFile = h5.File(self.fname,'w')
-
-        outFile.create_dataset('metadata',[1]
-                               ,dtype=np.dtype([('sare_id',np.int64)
-                                                ,('shape0',np.int32)
-                                                ,('shape1',np.int32)
-                                                ,('dataset_name','S1024')
-                                                ,('src_name','S1024')
-                                                # ,('dataset_name','S%i'%len(dataset_name))
-                                                # ,('src_name','S%i'%len(self.src_name))
-                                                ,('n_data',np.int64)
-                               ]))
-        outFile['metadata']['sare_id']       = self.sid
-        outFile['metadata']['shape0']        = shape[0]
-        outFile['metadata']['shape1']        = shape[1]
-        outFile['metadata']['dataset_name']  = dataset_name
-        outFile['metadata']['src_name']      = self.src_name
-        outFile['metadata']['n_data']        = src_vars_n
-        
-        outFile.create_dataset(dataset_name,[tgt_vars_n],dtype=self.dtype)
-        for i in vars:
-            # outFile[dataset_name][i] = np.full([tgt_vars_n],-1,dtype=vars[i].dtype)
-            # outFile[dataset_name][i][0:src_vars_n] = vars[i][0:src_vars_n].copy()
-            tmp = np.full([tgt_vars_n],-1,dtype=vars[i].dtype)
-            tmp[0:src_vars_n] = vars[i][0:src_vars_n]
-            outFile[dataset_name][i] = tmp
-            # print(i,' i,tmp ',tmp)
-            
-        outFile.close()
-        return
-
-    def read1(self):
-        inFile = h5.File(self.fname,'r')
-
-        # print('i.attrs: ',inFile.keys())
-        dataset_name = inFile['metadata']['dataset_name'][0]
-        shape        = (inFile['metadata']['shape0'][0],inFile['metadata']['shape1'][0])
-        src_vars_n   = inFile['metadata']['n_data'][0]
-        print('read1 reading %s of shape %s and %i records.'%(dataset_name,shape,src_vars_n))
-        sare         = inFile[dataset_name]['sare'][0:src_vars_n].copy()
-        src_coord    = inFile[dataset_name]['src_coord'][0:src_vars_n].copy()
-        # print('if.dtype: ',inFile[dataset_name].dtype)
-        # print('if.dtype.names: ',inFile[dataset_name].dtype.names)
-        # print('reading %i items each.'%(src_vars_n))
-        vars = {}
-        for i in inFile[dataset_name].dtype.names:
-            vars[i] = np.zeros([src_vars_n],dtype=inFile[dataset_name][i].dtype)
-            vars[i][:] = inFile[dataset_name][i][0:src_vars_n].copy()
-            # print(i,' i,vars[i] ',vars[i])
-        vars_dtype     = inFile[dataset_name].dtype;
-        metadata_dtype = inFile['metadata'].dtype;
-        inFile.close()
-        return (shape,dataset_name,vars,vars_dtype,metadata_dtype)
-    
-#
-###########################################################################
-#
-
-
-
-
 #
 ###########################################################################
 #
@@ -154,6 +46,7 @@ class modis05_set(object):
     cover       = None
     nAlong      = None
     nAcross     = None
+    _granule    = None
     def __init__(self,data,location,data_sourcedir=None,location_sourcedir=None):
         self.data     = data
         self.location = location
@@ -162,35 +55,28 @@ class modis05_set(object):
             location_sourcedir = data_sourcedir
         self.location_sourcedir = location_sourcedir
         return
+    def granule(self):
+        "The gd.modis05_granule, opened once and read lazily."
+        if self._granule is None:
+            self._granule = gd.modis05_granule(self.data_sourcedir+self.data,self.location_sourcedir+self.location)
+        return self._granule
     def load_geo(self):
         if self.geo_latlon is None:
-            geo          = SD(self.location_sourcedir+self.location,SDC.READ)
-            self.geo_lat = geo.select('Latitude').get()
-            self.geo_lon = geo.select('Longitude').get()
+            self.geo_lat,self.geo_lon = self.granule().geolocation()
             self.geo_latlon = (self.geo_lat,self.geo_lon)
-            geo.end()
         return self
     def load_wv_nir(self):
-        hdf              = SD(self.data_sourcedir+self.data,SDC.READ)
         if self.data_wv_nir is None:
-            ds_wv_nir        = hdf.select('Water_Vapor_Near_Infrared')
-            key_across       = 'Cell_Across_Swath_1km:mod05'
-            key_along        = 'Cell_Along_Swath_1km:mod05'
-            self.nAlong      = ds_wv_nir.dimensions()[key_along]
-            self.nAcross     = ds_wv_nir.dimensions()[key_across]
-            add_offset       = ds_wv_nir.attributes()['add_offset']
-            scale_factor     = ds_wv_nir.attributes()['scale_factor']
-            self.data_wv_nir = (ds_wv_nir.get()-add_offset)*scale_factor
-            ds_wv_nir.endaccess()
-            self.cover = gd.modis_cover_from_gring(hdf)
-            hdf.end()
+            self.nAlong,self.nAcross = self.granule().shape()
+            self.data_wv_nir = self.granule().read('Water_Vapor_Near_Infrared')
+            self.cover = self.granule().cover()
         return self
     def vmin(self):
-        return np.amin(self.data_wv_nir)
+        return np.nanmin(self.data_wv_nir)
     def vmax(self):
-        return np.amax(self.data_wv_nir)
-    def make_sare(self,res_km=1):
-        self.sare = ps.from_latlon(self.geo_lat.flatten(),self.geo_lon.flatten(),int(gd.resolution(res_km)))
+        return np.nanmax(self.data_wv_nir)
+    def make_sare(self,res_km=1,adaptive=False):
+        self.sare = gd.swath_sids(self.geo_lat,self.geo_lon,gd.resolution(res_km),adaptive=adaptive).flatten()
         return self
     def info(self):
         return '\n<modis05_set>' \
@@ -284,6 +170,7 @@ def main():
         # print('max spart items to write per file: ',spart_nmax)
 
         spart_names = []
+        partitions = metrics_registry.progress('sare_partition-write',total=len(tmp_cover),unit='partitions')
         for sid in tmp_cover:
             idx = idx_all[sid][0]
             # print(sid,' sid,cover sid: 0x%016x'%sid,' len(idx)=%i'%(len(idx)))
@@ -300,6 +187,7 @@ def main():
                     ,'Water_Vapor_Near_Infrared':modis_sets[tid].data_wv_nir.flatten()[idx]}
                 )
             spart_names.append(spart_h5.fname)
+            partitions.update(1,os.path.getsize(spart_h5.fname))
             if False:
                 ax = init_figure(proj)
                 ax.triplot(ctriang,'b-',transform=transf,lw=1.0,markersize=3,alpha=0.5)
@@ -345,6 +233,7 @@ def main():
                     ,vmax=vmax
                 )
                 plt.show()
+        partitions.close()
 
         ####
         
@@ -21,6 +21,7 @@ import h5py as h5
 from pyhdf.SD import SD, SDC
 
 from stopwatch import sw_timer as timer
+from partition import sare_from_fname, build_coarser_level, make_virtual
 
 import pystare as ps
 
@@ -55,126 +56,6 @@ def slam(client,action,data,partition_factor=1.5):
 #
 ###########################################################################
 #
-
-
-# s302c800000000006.t007d5c6d54800092.MOD05_L2.A2005349.2120.061.2017294065852.sketchJ0.h5
-
-def sare_from_fname(fname):
-    return int(fname.split('.')[0][1:],16)
-#    return int('0x'+fname.split('.')[0][1:],0)
-
-# take a list of files, get their sare, and then group them according to their occupancy in a coarser level
-def build_coarser_level(fnames):
-    sares = [sare_from_fname(i) for i in fnames]
-    resolutions = [gd.spatial_resolution(i) for i in sares]
-    levels = set(resolutions)
-    # print('levels: ',levels)
-    if len(levels) != 1:
-        raise ValueError('Filenames indicate multiple resolutions.')
-    resolution = resolutions[0]
-    coarser = {}
-    for i in fnames:
-        si = gd.spatial_clear_to_resolution(gd.spatial_coerce_resolution(sare_from_fname(i),resolution-1))
-        if si not in coarser.keys():
-            coarser[si] = []
-        coarser[si].append(i)
-    return coarser
-
-def make_virtual(base_name,fnames,dataset_names,realign=False,sort=True):
-    n_files = len(fnames)
-    layouts = {}
-    t0 = timer.current()
-    for dsn in dataset_names:
-        with h5.File(fnames[0],'r') as h:
-            ds_dtype = h[dsn].dtype
-        var_ns      = []
-        var_n_cumul = [0]
-        # print('fnames: ',fnames)
-        for f in fnames:
-            with h5.File(f,'r') as h:
-                print(f,' ',dsn,' shape= ',h[dsn].shape)
-                var_ns.append(h[dsn].shape[0]) # Assume 1D
-                var_n_cumul.append(var_n_cumul[-1]+var_ns[-1])
-        var_n_total = var_n_cumul[-1]
-        print('  layout shape: ',var_n_total)
-        layouts[dsn] = h5.VirtualLayout(shape=(var_n_total,),dtype=ds_dtype)
-        # print(dsn,' dsn, n_tot ',var_n_total)
-        # print(dsn,' dsn cum    ',var_n_cumul)
-        verbose = True
-        for i in range(n_files):
-            t1 = timer.current()
-            if var_ns[i] > 0:
-                print(i,' vs shape: ',var_ns[i],' from file ',fnames[i])
-                vs = h5.VirtualSource(fnames[i],dsn,shape=(var_ns[i],)) # could get shape from h
-                with h5.File(fnames[i]) as h:
-                    print('    100: ',dsn,' from ',fnames[i])
-                    # print('100: ',h[dsn])
-                    # print('101: ',h[dsn].dtype)
-                    # print('102: ',h[dsn].dtype.names)
-                    # print('')
-                    if sort and 'src_coord' in h[dsn].dtype.names:
-                        j    = 0
-                        nseg = 0
-                        segs = SortedDict()
-                        while j < h[dsn]['src_coord'].shape[0]:
-                            j0   = j
-                            k0   = h[dsn]['src_coord'][j0]
-                            k1   = k0 + 1
-                            done = False
-                            j1   = j + 1
-                            while not done:
-                                if j1 < h[dsn]['src_coord'].shape[0]:
-                                    if k1 == h[dsn]['src_coord'][j1]:
-                                        j1 = j1 + 1
-                                        k1 = k1 + 1
-                                    else:
-                                        done = True
-                                else:
-                                    done = True
-                            nseg = nseg + 1
-                            segs[h[dsn]['src_coord'][j0]] = (j0,j1)
-                            j = j1
-                            if verbose:
-                                print('  layout %s[%s] %5.2f%% complete, added %i points of %i in %s segments so far after %i seconds.'\
-                                      %(fnames[i],dsn,int(100.0*j/var_ns[i]),j,var_ns[i],nseg,timer.current()-t1)
-                                      ,end='\r',flush=True)
-                            ## # print('layout k=%i,%i j=%i,%i'%(k0,k1,j0,j1))
-                            ## if realign:
-                            ##     layouts[dsn][k0:k1] = vs[j0:j1]
-                            ## else:
-                            ##     layouts[dsn][j0:j1] = vs[j0:j1]
-                            ## j = j1
-                        l = 0
-                        for k in segs:
-                            j0,j1 = segs[k]
-                            if realign:
-                                k0 = h[dsn]['src_coord'][j0]
-                                k1 = h[dsn]['src_coord'][j1-1]
-                            else:
-                                k0 = l
-                                k1 = l + j1-j0
-                                l = l + j1-j0
-                            print(k,' segs j= ',j0,j1,' k= ',k0,k1)
-                            layouts[dsn][k0:k1] = vs[j0:j1]
-                        print('   Added %i of %i items in %i segments in %i seconds from %s.'%(j,var_ns[i],nseg,timer.current()-t1,fnames[i]))
-                    else:
-                        print('  assigning ds of shape %s to layout %s.'%(vs.shape,dsn))
-                        layouts[dsn][var_n_cumul[i]:var_n_cumul[i+1]] = vs[:]
-            # else:
-            #    raise ValueError('Size of source dataset %s unexpectedly greater than 1, equals %i.'%(dsn,var_ns[i]))
-                    
-    vds_name = '%s'%(base_name)
-    # print('writing ',vds_name)
-    with h5.File(vds_name,'w') as h:
-        for i in layouts: # i.e. dsn's
-            # print(' creating virtual dataset ',i)
-            h.create_virtual_dataset(i,layouts[i])
-    print('wrote %s in %i seconds.'%(vds_name,timer.current()-t0))
-    return vds_name
-#
-###########################################################################
-#
-
 def make_virtual_from(inputs):
     ret=[]
     for vars in inputs:
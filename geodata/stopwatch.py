@@ -1,46 +1,306 @@
 
-
+import csv
+import itertools
+import json
+import math
+import os
 import re
-from time import process_time
+import socket
+import threading
+import tracemalloc
+from collections import deque, namedtuple
+from functools import wraps
+from time import perf_counter, process_time, time
+
+# One stamp. timer is the value of the stopwatch's _timer (process_time by
+# default), wall is perf_counter, cpu is process_time, thread is the ident
+# of the thread that made the stamp. With memory accounting on, rss is
+# the resident set size and traced/peak are tracemalloc's current and
+# peak (since the previous stamp) traced bytes; otherwise they are None.
+# worker is None for local stamps and the worker_id() of the process that
+# made the stamp for records merged from elsewhere.
+stamp_record = namedtuple('stamp_record',['name','timer','wall','cpu','thread','rss','traced','peak','worker']\
+                          ,defaults=(None,None,None,None))
+
+def worker_id():
+    "host:pid, identifying this process among workers."
+    return '%s:%i'%(socket.gethostname(),os.getpid())
+
+try:
+    _page_size = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError,ValueError,OSError):
+    _page_size = None
+
+def rss_bytes():
+    "Resident set size of this process from /proc/self/statm, None where unavailable."
+    if _page_size is None:
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*_page_size
+    except (OSError,IndexError,ValueError):
+        return None
 
 class stopwatch(object):
-    timestamps = []
-    names      = {}
-    iteration  = {}
+    """Named timestamps, e.g. sw_timer.stamp('join-start').
+
+    Each instance has its own stamps. Each thread appends to its own list,
+    so stamping takes no lock; the lists are merged in time order when
+    read. In a process forked from this one the stopwatch starts over.
+
+    memory turns on memory accounting at each stamp: 'rss' reads
+    /proc/self/statm, 'tracemalloc' starts tracemalloc and records traced
+    and peak bytes, 'all' does both. None, the default, records nothing.
+
+    For long runs, set_streaming() keeps fixed size statistics per stamp
+    name instead of every stamp.
+    """
     _timer     = process_time
-    verbosity  = 0
 
-    def __init__(self,timer=None):
+    def __init__(self,timer=None,memory=None):
         if timer is not None:
             self._timer = timer
-        self.stamp("Instantiation")
+        self.verbosity = 0
+        self.streaming = False
+        self.set_memory(memory)
+        self._reset()
         return
 
-    def add_name(self,name):
-        if name not in self.names.keys():
-            self.iteration[name] = 0
-            self.names[name] = len(self.timestamps)
-        else:
-            self.iteration[name] = self.iteration[name] + 1
-            self.names["%s(%i)"%(name,self.iteration[name])] = len(self.timestamps)
+    def _reset(self):
+        "Drop all stamps and statistics, and stamp Instantiation."
+        self._pid     = os.getpid()
+        self._lock    = threading.Lock()
+        self._local   = threading.local()
+        self._buffers = [[self._record("Instantiation")]]
+        self._counter = itertools.count(1)
+        self._states  = []
+        self._cache   = (None,None,None,None)
+        self._flush_lock = threading.Lock()
+        self._last_flush = perf_counter()
+        return
+
+    def _buffer(self):
+        "Return the list this thread appends to, registering it on first use."
+        if self._pid != os.getpid():
+            # Forked: drop the parent's stamps, which the parent still holds.
+            self._reset()
+        try:
+            return self._local.records
+        except AttributeError:
+            records = deque(maxlen=self.ring) if self.streaming else []
+            state   = stream_state()
+            with self._lock:
+                self._buffers.append(records)
+                self._states.append(state)
+            self._local.records = records
+            self._local.state   = state
+            return records
+
+    def set_streaming(self,streaming=True,ring=0,flush_file=None,flush_interval=60.0,clock='wall'):
+        """Keep constant memory statistics instead of every stamp. The stopwatch starts over.
+
+        For each stamp name, the time since the previous stamp on the same
+        thread, and for each X-start/X-end span, its duration, are added to
+        a stream_stat: count, sum, min, max and a quantile_sketch. Only the
+        last ring stamps of each thread are kept. Stamp names should not
+        embed counters, since each distinct name gets its own statistics.
+        Every flush_interval seconds a stamp appends snapshot() as a JSON
+        line to flush_file. clock is 'timer', 'wall', or 'cpu'.
+        """
+        self.streaming      = streaming
+        self.ring           = ring
+        self.flush_file     = flush_file
+        self.flush_interval = flush_interval
+        self.stream_clock   = clock
+        self._reset()
+        return
+
+    def set_memory(self,memory=None):
+        "Set the memory accounting, one of None, 'rss', 'tracemalloc' or 'all'."
+        if memory not in (None,'rss','tracemalloc','all'):
+            raise ValueError("stopwatch memory must be None, 'rss', 'tracemalloc' or 'all', not %s"%memory)
+        self.memory = memory
+        self._rss   = memory in ('rss','all')
+        self._traced = memory in ('tracemalloc','all')
+        if self._traced and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return
+
+    def _record(self,name):
+        t = self._timer()
+        if self.memory is None:
+            return stamp_record(name,t,perf_counter(),process_time(),threading.get_ident())
+        rss    = rss_bytes() if self._rss else None
+        traced = peak = None
+        if self._traced:
+            traced,peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        return stamp_record(name,t,perf_counter(),process_time(),threading.get_ident(),rss,traced,peak)
+
+    def export_records(self,start=None,end=None):
+        """Return this process's stamps as a picklable dict to ship back from a worker.
+
+        start and end limit the stamps to a wall clock (perf_counter) window.
+        The clock offset lets merge() put the wall times on its own clock.
+        """
+        records = [tuple(r) for r in self.records()\
+                   if r.worker is None\
+                   and (start is None or r.wall >= start)\
+                   and (end is None or r.wall <= end)]
+        return {'worker':worker_id(),'clock_offset':time()-perf_counter(),'records':records}
+
+    def merge(self,exported):
+        """Add the records from another stopwatch's export_records(), tagged with its worker.
+
+        Wall times are shifted onto this process's perf_counter using the
+        system clocks, so workers on other hosts need synchronized clocks.
+        The timer and cpu values are left as the worker measured them, so
+        only compare them between stamps from the same worker.
+        """
+        if self._pid != os.getpid():
+            self._buffer()
+        shift   = exported['clock_offset'] - (time()-perf_counter())
+        records = []
+        for r in exported['records']:
+            r = stamp_record(*r)
+            records.append(r._replace(wall=r.wall+shift,worker=exported['worker'] if r.worker is None else r.worker))
+        with self._lock:
+            self._buffers.append(records)
+        return
+
+    def records(self):
+        "Return all stamp_records, from all threads, in wall clock order."
+        with self._lock:
+            buffers = list(self._buffers)
+        ret = []
+        for b in buffers:
+            ret.extend(list(b))
+        ret.sort(key=lambda r: r.wall)
+        return ret
+
+    def _index(self):
+        "Return (timestamps,names,iteration) for the merged records, caching until the next stamp."
+        with self._lock:
+            n = tuple((len(b),b[-1].wall if len(b) > 0 else None) for b in self._buffers)
+        if self._cache[0] == n:
+            return self._cache[1:]
+        timestamps = []
+        names      = {}
+        iteration  = {}
+        for r in self.records():
+            if r.name not in names.keys():
+                iteration[r.name] = 0
+                names[r.name] = len(timestamps)
+            else:
+                iteration[r.name] = iteration[r.name] + 1
+                names["%s(%i)"%(r.name,iteration[r.name])] = len(timestamps)
+            timestamps.append(r.timer)
+        self._cache = (n,timestamps,names,iteration)
+        return timestamps,names,iteration
+
+    @property
+    def timestamps(self):
+        return self._index()[0]
+
+    @property
+    def names(self):
+        return self._index()[1]
+
+    @property
+    def iteration(self):
+        return self._index()[2]
 
     def stamp(self,name=None):
         if name is None:
-            name = "stamp-%s"%len(self.names.keys())
-        self.add_name(name)
-        self.timestamps.append(self._timer())
+            name = "stamp" if self.streaming else "stamp-%i"%next(self._counter)
+        r = self._record(name)
+        self._buffer().append(r)
+        if self.streaming:
+            self._stream(r)
         if self.verbosity > 0:
             print(self.report())
-        return self.timestamps[-1]
+        return r.timer
+
+    def _stream(self,r):
+        "Add a stamp to this thread's statistics and flush if it is time."
+        state = self._local.state
+        t     = getattr(r,self.stream_clock)
+        if state.prev is not None:
+            state.add(state.stamps,r.name,t-state.prev)
+        state.prev = t
+        name,kind = split_span_name(r.name)
+        if kind == 'start':
+            starts = state.open.setdefault(name,[])
+            if len(starts) >= stream_state.max_open:
+                del starts[0]
+            starts.append(t)
+        elif kind == 'end' and len(state.open.get(name,[])) > 0:
+            state.add(state.spans,name,t-state.open[name].pop())
+        if self.flush_file is not None and r.wall - self._last_flush >= self.flush_interval:
+            if self._flush_lock.acquire(blocking=False):
+                try:
+                    self._last_flush = r.wall
+                    self.flush()
+                finally:
+                    self._flush_lock.release()
+        return
+
+    def stream_stats(self):
+        "Merge the threads' statistics, returning (stamps,spans), dicts of name -> stream_stat."
+        with self._lock:
+            states = list(self._states)
+        stamps = {}
+        spans  = {}
+        for state in states:
+            for merged,part in ((stamps,state.stamps),(spans,state.spans)):
+                for name,stat in list(part.items()):
+                    if name not in merged:
+                        merged[name] = stream_stat()
+                    merged[name].merge(stat)
+        return stamps,spans
+
+    def snapshot(self):
+        "The streaming statistics as a JSON-ready dict."
+        stamps,spans = self.stream_stats()
+        return {'time':time(),'worker':worker_id(),'clock':self.stream_clock\
+                ,'stamps':dict((k,v.to_dict()) for k,v in stamps.items())\
+                ,'spans':dict((k,v.to_dict()) for k,v in spans.items())}
+
+    def flush(self,fileName=None):
+        "Append snapshot() as one JSON line to fileName, the flush_file by default."
+        with open(self.flush_file if fileName is None else fileName,'a') as f:
+            f.write(json.dumps(self.snapshot())+'\n')
+        return
+
+    def span(self,name):
+        "A context manager stamping name-start and name-end, e.g. with sw_timer.span('join'): ..."
+        return stopwatch_span(self,name)
+
+    def timed(self,name=None):
+        "A decorator timing each call as a span, named for the function by default."
+        def decorator(func):
+            span_name = func.__qualname__ if name is None else name
+            @wraps(func)
+            def wrapper(*args,**kwargs):
+                with self.span(span_name):
+                    return func(*args,**kwargs)
+            return wrapper
+        return decorator
 
-    def delta(self,name1=None,name2=None):
+    def delta(self,name1=None,name2=None,clock='timer'):
+        "Time between two stamps. clock is 'timer' (the stopwatch's _timer), 'wall', or 'cpu'."
+        if clock == 'timer':
+            timestamps,names,_ = self._index()
+        else:
+            timestamps = [getattr(r,clock) for r in self.records()]
+            names      = self.names
         if name1 is None and name2 is None:
-            return self.timestamps[-1] - self.timestamps[0]
+            return timestamps[-1] - timestamps[0]
         if name2 is None:
-            return self.timestamps[-1] -  self.timestamps[self.names[name1]]
+            return timestamps[-1] -  timestamps[names[name1]]
         if name1 is None:
-            return self.timestamps[name2] -  self.timestamps[0]
-        return self.timestamps[self.names[name2]] - self.timestamps[self.names[name1]]
+            return timestamps[names[name2]] -  timestamps[0]
+        return timestamps[names[name2]] - timestamps[names[name1]]
 
     def current(self):
         return self._timer()
@@ -64,34 +324,465 @@ class stopwatch(object):
             ret_str=ret_str+prefix+self.report_string("Instantiation",keys[i])+"\n"
         return ret_str
 
-    def summary(self,prefix=''):
-        keys = list(self.names.keys())
-        deltas = []
+    def summary(self,prefix='',clock='timer'):
+        """Sum the time since the previous stamp on the same thread by stamp name. clock is 'timer', 'wall', or 'cpu'.
+
+        With memory accounting on, also the summed change in RSS and the
+        largest tracemalloc peak since the previous stamp. In streaming mode
+        the statistics for stamps and spans, on the streaming clock.
+        """
+        if self.streaming:
+            return self._stream_summary(prefix)
+        timestamps,names,_ = self._index()
+        records = self.records()
+        if clock != 'timer':
+            timestamps = [getattr(r,clock) for r in records]
+        keys = list(names.keys())
+        # Deltas are taken from the previous stamp of the same thread of the
+        # same worker, since the timer (process_time by default) and cpu
+        # clocks only compare within one.
+        previous      = {}
         deltas_gather = {}
-        for i in range(1,len(self.timestamps)):
-            deltas.append(self.timestamps[i]-self.timestamps[i-1])
+        rss_gather    = {}
+        peak_gather   = {}
+        for i in range(0,len(timestamps)):
+            thread = (records[i].worker,records[i].thread)
+            j = previous.get(thread)
+            previous[thread] = i
+            if j is None:
+                continue
             m = re.search('^(.*)\((.*)\)$',keys[i])
-            if m is None:
-                deltas_gather[keys[i]] = [deltas[-1]]
-            else:
-                deltas_gather[m.group(1)].append(deltas[-1])
+            key = keys[i] if m is None else m.group(1)
+            if key not in deltas_gather:
+                deltas_gather[key] = []
+                rss_gather[key]    = 0
+                peak_gather[key]   = 0
+            deltas_gather[key].append(timestamps[i]-timestamps[j])
+            if records[i].rss is not None and records[j].rss is not None:
+                rss_gather[key] += records[i].rss - records[j].rss
+            if records[i].peak is not None:
+                peak_gather[key] = max(peak_gather[key],records[i].peak)
         keys_gather = list(deltas_gather.keys())
         totals = {}
         iters  = {}
         ret_str = prefix + '<stopwatch-summary>\n'
-        ret_str = ret_str + prefix + "'key','sum (s)','min','max','iterations'\n"
+        if self.memory is None:
+            ret_str = ret_str + prefix + "'key','sum (s)','min','max','iterations'\n"
+        else:
+            ret_str = ret_str + prefix + "'key','sum (s)','min','max','iterations','rss delta (B)','peak traced (B)'\n"
         for i in range(0,len(keys_gather)):
             totals[keys_gather[i]] = sum(deltas_gather[keys_gather[i]])
             iters[keys_gather[i]]  = len(deltas_gather[keys_gather[i]])
-            ret_str = ret_str + prefix + "'%s',%f,%f,%f,%i\n"\
+            ret_str = ret_str + prefix + "'%s',%f,%f,%f,%i"\
                       %(keys_gather[i]\
                         ,totals[keys_gather[i]]\
                         ,min(deltas_gather[keys_gather[i]])\
                         ,max(deltas_gather[keys_gather[i]])\
                         ,iters[keys_gather[i]])
+            if self.memory is not None:
+                ret_str = ret_str + ",%i,%i"%(rss_gather[keys_gather[i]],peak_gather[keys_gather[i]])
+            ret_str = ret_str + "\n"
+        ret_str = ret_str + prefix + '</stopwatch-summary>\n'
+        return ret_str,totals,iters
+
+    def _stream_summary(self,prefix=''):
+        stamps,spans = self.stream_stats()
+        totals = {}
+        iters  = {}
+        ret_str = prefix + '<stopwatch-summary>\n'
+        ret_str = ret_str + prefix + "'key','sum (s)','min','max','iterations','p50','p95','p99'\n"
+        for label,stats in (('',stamps),('span:',spans)):
+            for name,stat in stats.items():
+                totals[label+name] = stat.sum
+                iters[label+name]  = stat.count
+                ret_str = ret_str + prefix + "'%s%s',%f,%f,%f,%i,%f,%f,%f\n"\
+                          %(label,name,stat.sum,stat.min,stat.max,stat.count\
+                            ,stat.quantile(0.5),stat.quantile(0.95),stat.quantile(0.99))
         ret_str = ret_str + prefix + '</stopwatch-summary>\n'
         return ret_str,totals,iters
 
+    def spans(self,clock='wall'):
+        """Pair X-start and X-end stamps into span_records, per thread.
+
+        An end closes the innermost open span of the same name. A span's
+        parent is the innermost span open when it started. Unclosed spans
+        and stamps that are neither a start nor an end are left out.
+
+        With memory accounting on, rss_delta is the change in RSS over the
+        span and peak the largest tracemalloc peak recorded within it. The
+        tracemalloc peak is process wide, so a span's peak includes other
+        threads' allocations.
+        """
+        stacks = {}
+        ret    = []
+        for r in self.records():
+            if r.peak is not None:
+                for stack in stacks.values():
+                    for entry in stack:
+                        entry[7] = r.peak if entry[7] is None else max(entry[7],r.peak)
+            name,kind = split_span_name(r.name)
+            if kind is None:
+                continue
+            stack = stacks.setdefault((r.worker,r.thread),[])
+            if kind == 'start':
+                parent = stack[-1] if len(stack) > 0 else None
+                path   = (parent[1] if parent is not None else '')+'/'+name
+                # [name,path,start,depth,time in children,parent,rss at start,peak]
+                stack.append([name,path,getattr(r,clock),len(stack),0.0,parent,r.rss,None])
+                continue
+            for i in range(len(stack)-1,-1,-1):
+                if stack[i][0] == name:
+                    _,path,start,depth,children,parent,rss,peak = stack.pop(i)
+                    end = getattr(r,clock)
+                    if parent is not None:
+                        parent[4] += end - start
+                    rss_delta = None if rss is None or r.rss is None else r.rss - rss
+                    ret.append(span_record(name,path,r.thread,start,end,depth,end-start-children,rss_delta,peak,r.worker))
+                    break
+        ret.sort(key=lambda s: s.start)
+        return ret
+
+    def span_tree(self,clock='wall'):
+        """Per span path, the call count and the inclusive and exclusive times.
+
+        Returns a dict of path -> {'count','inclusive','exclusive','min','max',
+        'rss_delta','peak'} in order of first start. Exclusive time is
+        inclusive time less that of the child spans. rss_delta is summed and
+        peak is the largest over calls, both None without memory accounting.
+        """
+        tree = {}
+        for s in self.spans(clock):
+            inclusive = s.end - s.start
+            if s.path not in tree:
+                tree[s.path] = {'count':0,'inclusive':0.0,'exclusive':0.0\
+                                ,'min':inclusive,'max':inclusive,'rss_delta':None,'peak':None}
+            node = tree[s.path]
+            node['count']     += 1
+            node['inclusive'] += inclusive
+            node['exclusive'] += s.exclusive
+            node['min']        = min(node['min'],inclusive)
+            node['max']        = max(node['max'],inclusive)
+            if s.rss_delta is not None:
+                node['rss_delta'] = s.rss_delta + (node['rss_delta'] or 0)
+            if s.peak is not None:
+                node['peak'] = s.peak if node['peak'] is None else max(node['peak'],s.peak)
+        return tree
+
+    def span_report(self,prefix='',clock='wall'):
+        "The span tree as text, indented by depth."
+        tree = self.span_tree(clock)
+        ret_str = prefix + '<stopwatch-spans>\n'
+        ret_str = ret_str + prefix + "'span','count','inclusive (s)','exclusive (s)','min','max'"
+        if self.memory is not None:
+            ret_str = ret_str + ",'rss delta (B)','peak traced (B)'"
+        ret_str = ret_str + "\n"
+        for path in sorted(tree.keys(),key=lambda p: p.split('/')):
+            node  = tree[path]
+            depth = path.count('/') - 1
+            ret_str = ret_str + prefix + "'%s%s',%i,%f,%f,%f,%f"\
+                      %('  '*depth,path.rsplit('/',1)[-1]\
+                        ,node['count'],node['inclusive'],node['exclusive']\
+                        ,node['min'],node['max'])
+            if self.memory is not None:
+                ret_str = ret_str + ",%s,%s"%(node['rss_delta'],node['peak'])
+            ret_str = ret_str + "\n"
+        ret_str = ret_str + prefix + '</stopwatch-spans>\n'
+        return ret_str
+
+    def to_csv(self,fileName,clock='wall'):
+        "Write the span tree as a flat CSV, one row per span path."
+        tree = self.span_tree(clock)
+        with open(fileName,'w',newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['path','count','inclusive','exclusive','min','max','mean','rss_delta','peak'])
+            for path,node in tree.items():
+                writer.writerow([path,node['count'],node['inclusive'],node['exclusive']\
+                                 ,node['min'],node['max'],node['inclusive']/node['count']\
+                                 ,'' if node['rss_delta'] is None else node['rss_delta']\
+                                 ,'' if node['peak'] is None else node['peak']])
+        return
+
+    def chrome_trace(self,clock='wall'):
+        """Trace events for chrome://tracing or Perfetto, times in microseconds.
+
+        Spans are complete ('X') events, other stamps instant ('i') events.
+        With memory accounting on, spans carry rss_delta and peak in their
+        args and each stamp adds a 'memory' counter ('C') event. Merged
+        workers appear as separate processes.
+        """
+        records = self.records()
+        if len(records) == 0:
+            return {'traceEvents':[],'displayTimeUnit':'ms'}
+        t0  = getattr(records[0],clock)
+        pids = {None:os.getpid()}
+        for r in records:
+            if r.worker not in pids:
+                pid = int(r.worker.rsplit(':',1)[-1])
+                while pid in pids.values():
+                    pid += 1000000
+                pids[r.worker] = pid
+        events = []
+        for worker,pid in pids.items():
+            events.append({'name':'process_name','ph':'M','pid':pid\
+                           ,'args':{'name':worker_id() if worker is None else worker}})
+        for s in self.spans(clock):
+            pid  = pids[s.worker]
+            args = {'path':s.path}
+            if s.rss_delta is not None:
+                args['rss_delta'] = s.rss_delta
+            if s.peak is not None:
+                args['peak'] = s.peak
+            events.append({'name':s.name,'cat':'span','ph':'X','pid':pid,'tid':s.thread\
+                           ,'ts':1.0e6*(s.start-t0),'dur':1.0e6*(s.end-s.start)\
+                           ,'args':args})
+        for r in records:
+            pid = pids[r.worker]
+            ts  = 1.0e6*(getattr(r,clock)-t0)
+            if split_span_name(r.name)[1] is None:
+                events.append({'name':r.name,'cat':'stamp','ph':'i','s':'t','pid':pid\
+                               ,'tid':r.thread,'ts':ts})
+            if r.rss is not None or r.traced is not None:
+                args = {}
+                if r.rss is not None:
+                    args['rss'] = r.rss
+                if r.traced is not None:
+                    args['traced'] = r.traced
+                events.append({'name':'memory','ph':'C','pid':pid,'ts':ts,'args':args})
+        return {'traceEvents':events,'displayTimeUnit':'ms'}
+
+    def to_chrome_trace(self,fileName,clock='wall'):
+        "Write chrome_trace() as JSON."
+        with open(fileName,'w') as f:
+            json.dump(self.chrome_trace(clock),f)
+        return
+
+    def worker_report(self,prefix='',clock='wall'):
+        """Per stage totals, per worker skew and the critical path over merged workers.
+
+        A stage is a span name. For each stage, the total over all workers,
+        the calls, and the smallest, mean and largest per worker total; skew
+        is largest/mean, 1 when the work is balanced. The critical path
+        starts from the outermost span that ends last and steps back to the
+        outermost span, on any worker, that ended last before it started.
+        Returns (ret_str,stages,critical_path).
+        """
+        spans = self.spans(clock)
+        local = worker_id()
+        stages = {}
+        for s in spans:
+            worker = local if s.worker is None else s.worker
+            stage  = stages.setdefault(s.name,{'total':0.0,'count':0,'workers':{}})
+            stage['total'] += s.end - s.start
+            stage['count'] += 1
+            stage['workers'][worker] = stage['workers'].get(worker,0.0) + s.end - s.start
+        for stage in stages.values():
+            w = list(stage['workers'].values())
+            stage['min']  = min(w)
+            stage['mean'] = sum(w)/len(w)
+            stage['max']  = max(w)
+            stage['skew'] = stage['max']/stage['mean'] if stage['mean'] > 0 else 1.0
+        critical_path = []
+        outer = sorted([s for s in spans if s.depth == 0],key=lambda s: s.end)
+        if len(outer) > 0:
+            s = outer[-1]
+            critical_path.append(s)
+            while True:
+                before = [p for p in outer if p.end <= s.start]
+                if len(before) == 0:
+                    break
+                s = before[-1]
+                critical_path.append(s)
+            critical_path.reverse()
+        ret_str = prefix + '<stopwatch-workers>\n'
+        ret_str = ret_str + prefix + "'stage','total (s)','calls','workers','min','mean','max','skew'\n"
+        for name,stage in stages.items():
+            ret_str = ret_str + prefix + "'%s',%f,%i,%i,%f,%f,%f,%f\n"\
+                      %(name,stage['total'],stage['count'],len(stage['workers'])\
+                        ,stage['min'],stage['mean'],stage['max'],stage['skew'])
+        ret_str = ret_str + prefix + "'critical path','worker','start (s)','duration (s)'\n"
+        t0 = critical_path[0].start if len(critical_path) > 0 else 0.0
+        for s in critical_path:
+            ret_str = ret_str + prefix + "'%s','%s',%f,%f\n"\
+                      %(s.name,local if s.worker is None else s.worker,s.start-t0,s.end-s.start)
+        ret_str = ret_str + prefix + '</stopwatch-workers>\n'
+        return ret_str,stages,critical_path
+
+# A span between name-start and name-end stamps. path is the '/' joined
+# names of the enclosing spans on the same thread, start and end are on
+# the clock requested, exclusive is the time not spent in child spans.
+# rss_delta and peak are None unless memory accounting is on. worker is
+# None for local spans.
+span_record = namedtuple('span_record',['name','path','thread','start','end','depth','exclusive','rss_delta','peak','worker']\
+                         ,defaults=(None,None,None))
+
+def split_span_name(stamp_name):
+    "Return (name,'start'|'end') for 'name-start' or 'name-end', else (stamp_name,None)."
+    for kind in ('start','end'):
+        if stamp_name.endswith('-'+kind) and len(stamp_name) > len(kind)+1:
+            return stamp_name[:-len(kind)-1],kind
+    return stamp_name,None
+
+class quantile_sketch(object):
+    """Approximate quantiles of positive values in fixed memory.
+
+    Values are counted in logarithmic buckets, so a quantile is within
+    relative_accuracy of a value of the right rank. Values at or below
+    min_value are counted as zero. Past max_buckets, the lowest buckets
+    are folded together, losing accuracy only at the low end.
+    """
+    def __init__(self,relative_accuracy=0.01,min_value=1.0e-9,max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.min_value   = min_value
+        self.max_buckets = max_buckets
+        self.gamma       = (1.0+relative_accuracy)/(1.0-relative_accuracy)
+        self.log_gamma   = math.log(self.gamma)
+        self.buckets     = {}
+        self.zero        = 0
+        self.count       = 0
+        return
+
+    def add(self,value,n=1):
+        self.count += n
+        if value <= self.min_value:
+            self.zero += n
+            return
+        k = int(math.ceil(math.log(value)/self.log_gamma))
+        self.buckets[k] = self.buckets.get(k,0) + n
+        if len(self.buckets) > self.max_buckets:
+            keys = sorted(self.buckets.keys())
+            self.buckets[keys[1]] += self.buckets.pop(keys[0])
+        return
+
+    def merge(self,other):
+        self.zero  += other.zero
+        self.count += other.count
+        for k,n in list(other.buckets.items()):
+            self.buckets[k] = self.buckets.get(k,0) + n
+        while len(self.buckets) > self.max_buckets:
+            keys = sorted(self.buckets.keys())
+            self.buckets[keys[1]] += self.buckets.pop(keys[0])
+        return
+
+    def quantile(self,q):
+        if self.count == 0:
+            return float('nan')
+        rank = q*(self.count-1)
+        seen = self.zero
+        if rank < seen:
+            return 0.0
+        for k in sorted(self.buckets.keys()):
+            seen += self.buckets[k]
+            if rank < seen:
+                return 2.0*self.gamma**k/(self.gamma+1.0)
+        return 2.0*self.gamma**max(self.buckets.keys())/(self.gamma+1.0)
+
+class stream_stat(object):
+    "Count, sum, min, max and a quantile_sketch of a stream of durations."
+    def __init__(self):
+        self.count  = 0
+        self.sum    = 0.0
+        self.min    = float('inf')
+        self.max    = float('-inf')
+        self.sketch = quantile_sketch()
+        return
+
+    def add(self,value):
+        self.count += 1
+        self.sum   += value
+        self.min    = min(self.min,value)
+        self.max    = max(self.max,value)
+        self.sketch.add(value)
+        return
+
+    def merge(self,other):
+        self.count += other.count
+        self.sum   += other.sum
+        self.min    = min(self.min,other.min)
+        self.max    = max(self.max,other.max)
+        self.sketch.merge(other.sketch)
+        return
+
+    def quantile(self,q):
+        return self.sketch.quantile(q)
+
+    def to_dict(self):
+        return {'count':self.count,'sum':self.sum,'min':self.min,'max':self.max\
+                ,'p50':self.quantile(0.5),'p95':self.quantile(0.95),'p99':self.quantile(0.99)}
+
+class stream_state(object):
+    "One thread's streaming statistics: stamps and spans by name, the previous stamp, and open span starts."
+    max_open = 64
+
+    def __init__(self):
+        self.stamps = {}
+        self.spans  = {}
+        self.prev   = None
+        self.open   = {}
+        return
+
+    def add(self,stats,name,value):
+        if name not in stats:
+            stats[name] = stream_stat()
+        stats[name].add(value)
+        return
+
+class stopwatch_span(object):
+    "Stamps name-start on entry and name-end on exit, following our naming convention."
+    def __init__(self,sw,name):
+        self.sw   = sw
+        self.name = name
+        return
+
+    def __enter__(self):
+        self.sw.stamp(self.name+'-start')
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.sw.stamp(self.name+'-end')
+        return False
+
 global sw_timer
 sw_timer = stopwatch()
 
+def timed(name=None,sw=None):
+    "Decorator timing each call as a span on sw, the global sw_timer by default, e.g. @timed('join')."
+    def decorator(func):
+        span_name = func.__qualname__ if name is None else name
+        @wraps(func)
+        def wrapper(*args,**kwargs):
+            with (sw_timer if sw is None else sw).span(span_name):
+                return func(*args,**kwargs)
+        return wrapper
+    return decorator
+
+class timed_worker(object):
+    """Wrap a function for a process pool or dask so that it returns (result,records).
+
+    The call is timed as a span on the worker's sw_timer, and records are
+    the worker's stamps made during the call, from export_records(). The
+    wrapper pickles as long as func does. Use merge_worker_results() to
+    unpack the results and merge the records.
+    """
+    def __init__(self,func,name=None):
+        self.func = func
+        self.name = func.__name__ if name is None else name
+        return
+
+    def __call__(self,*args,**kwargs):
+        # In a forked worker the first use of sw_timer starts it over with
+        # a new Instantiation stamp, which must fall before the window.
+        sw_timer._buffer()
+        start = perf_counter()
+        with sw_timer.span(self.name):
+            result = self.func(*args,**kwargs)
+        return result,sw_timer.export_records(start=start)
+
+def merge_worker_results(results,sw=None):
+    "Merge the records from timed_worker results into sw, sw_timer by default, and return the results."
+    if sw is None:
+        sw = sw_timer
+    ret = []
+    for result,records in results:
+        sw.merge(records)
+        ret.append(result)
+    return ret
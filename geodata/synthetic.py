@@ -0,0 +1,409 @@
+
+# geodata/synthetic.py
+
+# Structurally faithful synthetic GOES, MERRA-2 and MODIS (MOD03/MOD05)
+# files, named so that the filename parsers in geodata.py accept them, for
+# reproducing and scaling performance work without the original data.
+#
+#   python -m geodata.synthetic /tmp/synthetic --goes-times 4 --modis-granules 2
+#
+# The fields are smooth plus noise, not physical; the geometry is.
+
+import argparse
+import datetime as dt
+import os
+import sys
+
+import numpy as np
+from netCDF4 import Dataset
+from pyhdf.SD import SD, SDC
+
+re_km = 6371.0
+
+###########################################################################
+# GOES imager, one netCDF file per band.
+
+goes_fill = 2.0e30 # Off-disk lat/lon, which the join drops as > 90.
+
+def goes_filename(t,band,satellite='goes10'):
+    "e.g. goes10.2005.349.030145.BAND_04.nc"
+    return '%s.%04i.%03i.%02i%02i%02i.BAND_%02i.nc'\
+        %(satellite,t.year,t.timetuple().tm_yday,t.hour,t.minute,t.second,band)
+
+def goes_latlon(ny,nx,sub_lon=-135.0,max_scan_deg=8.7):
+    "Lat/lon of a geostationary imager's pixels, goes_fill off the disk."
+    r_sat = 42164.0
+    y,x = np.meshgrid(np.deg2rad(np.linspace(max_scan_deg,-max_scan_deg,ny))
+                      ,np.deg2rad(np.linspace(-max_scan_deg,max_scan_deg,nx)),indexing='ij')
+    # Ray from the satellite toward the earth's center, turned by the scan angles.
+    dx = -np.cos(x)*np.cos(y)
+    dy = np.sin(x)*np.cos(y)
+    dz = np.sin(y)
+    b  = r_sat*dx
+    c  = r_sat*r_sat-re_km*re_km
+    disc = b*b-c
+    on_disk = disc >= 0
+    s = -b-np.sqrt(np.where(on_disk,disc,0.0))
+    px,py,pz = r_sat+s*dx,s*dy,s*dz
+    lat = np.rad2deg(np.arcsin(np.clip(pz/re_km,-1.0,1.0)))
+    lon = sub_lon+np.rad2deg(np.arctan2(py,px))
+    lon = (lon+180.0) % 360.0 - 180.0
+    lat = np.where(on_disk,lat,goes_fill).astype(np.float32)
+    lon = np.where(on_disk,lon,goes_fill).astype(np.float32)
+    return lat,lon
+
+def smooth_field(lat,lon,seed,phase=0.0):
+    "A smooth field on [0,1] plus a little noise."
+    rng = np.random.default_rng(seed)
+    f = 0.5+0.25*np.sin(np.deg2rad(3.0*lon)+phase)*np.cos(np.deg2rad(2.0*lat))\
+        +0.2*np.sin(np.deg2rad(7.0*lat+5.0*lon)+2.0*phase)
+    return np.clip(f+0.02*rng.standard_normal(np.shape(lat)),0.0,1.0)
+
+def write_goes(directory,t,band,ny=500,nx=800,elem_res=4.0,seed=0,satellite='goes10',latlon=None):
+    "Write one GOES band file with lat, lon, data[1,ny,nx], time and elemRes. Returns the file name."
+    fname = goes_filename(t,band,satellite)
+    if latlon is None:
+        latlon = goes_latlon(ny,nx)
+    lat,lon = latlon
+    on_disk = lat <= 90.0
+    counts  = np.where(on_disk,1023.0*smooth_field(np.where(on_disk,lat,0),np.where(on_disk,lon,0),seed+band,phase=0.1*band),0)
+    with Dataset(os.path.join(directory,fname),'w') as ds:
+        ds.createDimension('time',1)
+        ds.createDimension('yc',ny)
+        ds.createDimension('xc',nx)
+        ds.createDimension('auxiliary',1)
+        ds.Satellite = satellite
+        ds.Band      = band
+        v = ds.createVariable('time','f8',('time',))
+        v.units = 'seconds since 1970-1-1 0:0:0'
+        v[:] = [(t-dt.datetime(1970,1,1)).total_seconds()]
+        v = ds.createVariable('lat','f4',('yc','xc'))
+        v.units = 'degrees_north'
+        v[:,:] = lat
+        v = ds.createVariable('lon','f4',('yc','xc'))
+        v.units = 'degrees_east'
+        v[:,:] = lon
+        v = ds.createVariable('data','i2',('time','yc','xc'))
+        v[0,:,:] = counts.astype(np.int16)
+        v = ds.createVariable('elemRes','f4',('auxiliary',))
+        v.units = 'km'
+        v[:] = [elem_res]
+        v = ds.createVariable('lineRes','f4',('auxiliary',))
+        v.units = 'km'
+        v[:] = [elem_res]
+    return fname
+
+###########################################################################
+# MERRA-2 tavg1_2d_slv_Nx, 24 hourly averages per daily file.
+
+def merra2_filename(day,stream=400):
+    "e.g. MERRA2_400.tavg1_2d_slv_Nx.20051215.nc4"
+    return 'MERRA2_%03i.tavg1_2d_slv_Nx.%04i%02i%02i.nc4'%(stream,day.year,day.month,day.day)
+
+def write_merra2(directory,day,nlat=361,nlon=576,seed=0):
+    "Write one day of TQI, TQL and TQV on the MERRA-2 grid. Returns the file name."
+    fname = merra2_filename(day)
+    lat = np.linspace(-90.0,90.0,nlat)
+    lon = -180.0+np.arange(nlon)*(360.0/nlon)
+    glat,glon = np.meshgrid(lat,lon,indexing='ij')
+    with Dataset(os.path.join(directory,fname),'w') as ds:
+        ds.createDimension('time',24)
+        ds.createDimension('lat',nlat)
+        ds.createDimension('lon',nlon)
+        v = ds.createVariable('time','i4',('time',))
+        v.units      = 'minutes since %04i-%02i-%02i 00:30:00'%(day.year,day.month,day.day)
+        v.begin_date = np.int32(day.year*10000+day.month*100+day.day)
+        v.begin_time = np.int32(3000) # hhmmss, the first hourly average is centered at 00:30
+        v[:] = 60*np.arange(24)
+        v = ds.createVariable('lat','f8',('lat',))
+        v.units = 'degrees_north'
+        v[:] = lat
+        v = ds.createVariable('lon','f8',('lon',))
+        v.units = 'degrees_east'
+        v[:] = lon
+        for name,scale in (('TQI',0.1),('TQL',0.3),('TQV',60.0)):
+            v = ds.createVariable(name,'f4',('time','lat','lon'),zlib=True)
+            v.units = 'kg m-2'
+            for hr in range(24):
+                v[hr,:,:] = scale*smooth_field(glat,glon,seed+hr,phase=2.0*np.pi*hr/24.0)
+    return fname
+
+###########################################################################
+# MODIS MOD03 geolocation and MOD05_L2 water vapor, HDF4.
+
+modis_scan_lines_1km = 10
+modis_n_across_1km   = 1354
+
+def modis_filenames(t,collection=61,production='2017294065852'):
+    "The MOD03 and MOD05_L2 names of the granule starting at t."
+    stem = 'A%04i%03i.%02i%02i.%03i.%s.hdf'%(t.year,t.timetuple().tm_yday,t.hour,t.minute,collection,production)
+    return 'MOD03.'+stem,'MOD05_L2.'+stem
+
+def modis_swath_latlon(n_along,n_across=modis_n_across_1km,lat0=-10.0,lon0=-100.0,heading_deg=-10.0,pixel_km=1.0):
+    "1km lat/lon of a swath along a great circle from (lat0,lon0), centered across track."
+    i,j = np.meshgrid(np.arange(n_along),np.arange(n_across)-0.5*(n_across-1),indexing='ij')
+    h = np.deg2rad(heading_deg)
+    north = pixel_km*(i*np.cos(h)-j*np.sin(h))
+    east  = pixel_km*(i*np.sin(h)+j*np.cos(h))
+    lat = lat0+np.rad2deg(north/re_km)
+    lon = lon0+np.rad2deg(east/(re_km*np.cos(np.deg2rad(lat))))
+    lon = (lon+180.0) % 360.0 - 180.0
+    return lat.astype(np.float32),lon.astype(np.float32)
+
+def gring_metadata(lat,lon):
+    "ArchiveMetadata.0 text holding the GRING of a swath, clockwise from the first corner."
+    corners = [(0,0),(0,-1),(-1,-1),(-1,0)]
+    glat = ', '.join(['%.6f'%lat[c] for c in corners])
+    glon = ', '.join(['%.6f'%lon[c] for c in corners])
+    return '\n'.join([
+        ''
+        ,'GROUP                  = ARCHIVEDMETADATA'
+        ,'  GROUPTYPE            = MASTERGROUP'
+        ,''
+        ,'  GROUP                  = GPOLYGON'
+        ,''
+        ,'    OBJECT                 = GPOLYGONCONTAINER'
+        ,'      CLASS                = "1"'
+        ,''
+        ,'      GROUP                  = GRINGPOINT'
+        ,'        CLASS                = "1"'
+        ,''
+        ,'        OBJECT                 = GRINGPOINTLONGITUDE'
+        ,'          NUM_VAL              = 4'
+        ,'          CLASS                = "1"'
+        ,'          VALUE                = (%s)'%glon
+        ,'        END_OBJECT             = GRINGPOINTLONGITUDE'
+        ,''
+        ,'        OBJECT                 = GRINGPOINTLATITUDE'
+        ,'          NUM_VAL              = 4'
+        ,'          CLASS                = "1"'
+        ,'          VALUE                = (%s)'%glat
+        ,'        END_OBJECT             = GRINGPOINTLATITUDE'
+        ,''
+        ,'        OBJECT                 = GRINGPOINTSEQUENCENO'
+        ,'          NUM_VAL              = 4'
+        ,'          CLASS                = "1"'
+        ,'          VALUE                = (1, 2, 3, 4)'
+        ,'        END_OBJECT             = GRINGPOINTSEQUENCENO'
+        ,''
+        ,'      END_GROUP              = GRINGPOINT'
+        ,''
+        ,'    END_OBJECT             = GPOLYGONCONTAINER'
+        ,''
+        ,'  END_GROUP              = GPOLYGON'
+        ,''
+        ,'END_GROUP              = ARCHIVEDMETADATA'
+        ,''
+        ,'END'
+        ,''])
+
+def write_sds(hdf,name,data,hdf_type,dim_names,attrs=None):
+    sds = hdf.create(name,hdf_type,data.shape)
+    for k,dim_name in enumerate(dim_names):
+        sds.dim(k).setname(dim_name)
+    sds[:] = data
+    if attrs is not None:
+        for key,(attr_type,value) in attrs.items():
+            sds.attr(key).set(attr_type,value)
+    sds.endaccess()
+    return
+
+def write_modis(directory,t,n_scans=203,seed=0,lat0=-10.0,lon0=-100.0):
+    """Write the MOD03 and MOD05_L2 files of one granule of n_scans 10 line scans.
+
+    MOD03 has the 1km Latitude and Longitude. MOD05_L2 has the 5km
+    Latitude and Longitude, sampled at 1km pixels 2+5i as the 5km to 1km
+    interpolation expects, and the 1km Water_Vapor_Near_Infrared with
+    scale_factor and add_offset. Both carry the GRING in ArchiveMetadata.0.
+    Returns the two file names.
+    """
+    mod03_name,mod05_name = modis_filenames(t)
+    n_along  = n_scans*modis_scan_lines_1km
+    lat,lon  = modis_swath_latlon(n_along,lat0=lat0,lon0=lon0)
+    metadata = gring_metadata(lat,lon)
+
+    hdf = SD(os.path.join(directory,mod03_name),SDC.WRITE|SDC.CREATE)
+    hdf.attr('ArchiveMetadata.0').set(SDC.CHAR,metadata)
+    dims = ['nscans*10:MODIS_Swath_Type_GEO','mframes:MODIS_Swath_Type_GEO']
+    write_sds(hdf,'Latitude',lat,SDC.FLOAT32,dims)
+    write_sds(hdf,'Longitude',lon,SDC.FLOAT32,dims)
+    hdf.end()
+
+    wv = np.round(5000.0*smooth_field(lat,lon,seed)).astype(np.int16)
+    lat_5km = lat[2::5,2::5][:,:270]
+    lon_5km = lon[2::5,2::5][:,:270]
+    hdf = SD(os.path.join(directory,mod05_name),SDC.WRITE|SDC.CREATE)
+    hdf.attr('ArchiveMetadata.0').set(SDC.CHAR,metadata)
+    dims_5km = ['Cell_Along_Swath_5km:mod05','Cell_Across_Swath_5km:mod05']
+    dims_1km = ['Cell_Along_Swath_1km:mod05','Cell_Across_Swath_1km:mod05']
+    write_sds(hdf,'Latitude',lat_5km,SDC.FLOAT32,dims_5km)
+    write_sds(hdf,'Longitude',lon_5km,SDC.FLOAT32,dims_5km)
+    write_sds(hdf,'Water_Vapor_Near_Infrared',wv,SDC.INT16,dims_1km
+              ,attrs={'scale_factor':(SDC.FLOAT64,0.001)
+                      ,'add_offset':(SDC.FLOAT64,0.0)
+                      ,'_FillValue':(SDC.INT16,-9999)
+                      ,'units':(SDC.CHAR,'cm')})
+    hdf.end()
+    return mod03_name,mod05_name
+
+###########################################################################
+# Moving features. A track is the field sum_k exp(-r_k/rthick) of the
+# distances r_k to samples (xc,yc) of a polynomial center line, as in
+# sketch2, evaluated by blocked broadcasting instead of a double loop.
+
+class track(object):
+    """A feature along y = y0 + sum_i coeffs[i]*(x-x0)**i for x in x0+dxmnmx.
+
+    The center line is sampled at the unique x of the grid it is evaluated
+    on, or at samples if given.
+    """
+    def __init__(self,coeffs=[],dxmnmx=[],xyc=[],rthick=1,samples=None):
+        self.coeffs = coeffs
+        self.dxmnmx = dxmnmx
+        self.xyc    = xyc
+        if(len(xyc) == 2):
+            self.x0 = xyc[0]
+            self.y0 = xyc[1]
+        else:
+            self.x0 = 0
+            self.y0 = 0
+        xmnmx=[]
+        if(len(dxmnmx) == 2):
+            xmnmx = [self.x0+dxmnmx[0],self.x0+dxmnmx[1]]
+        self.xmnmx   = xmnmx
+        self.rthick  = rthick
+        self.samples = samples
+        return
+
+    def moved(self,dx,dy):
+        "A copy of the track displaced by (dx,dy)."
+        return track(self.coeffs,self.dxmnmx,[self.x0+dx,self.y0+dy],self.rthick,samples=None if self.samples is None else np.asarray(self.samples)+dx)
+
+    def centerline(self,x):
+        "The (xc,yc) samples of the center line."
+        xc = np.unique(x) if self.samples is None else np.asarray(self.samples,dtype=np.float64)
+        if len(self.xmnmx) == 2:
+            xc = xc[(xc >= self.xmnmx[0]) & (xc <= self.xmnmx[1])]
+        yc = np.zeros(xc.shape)
+        for c in self.coeffs[::-1]:
+            yc = c+yc*(xc-self.x0)
+        return xc,yc+self.y0
+
+    def evaluate(self,x,y,cutoff=None,block_elements=1<<22):
+        """The field at points (x,y), of any shape.
+
+        With cutoff, samples farther than cutoff*rthick from a point are
+        dropped: points are binned into tiles of that size and each tile
+        sees only the samples near it. exp(-cutoff) bounds the relative
+        error per sample, e.g. 4.5e-5 for cutoff=10. Distances are
+        computed for at most block_elements pairs at a time.
+        """
+        shape = np.shape(x)
+        x = np.ravel(x).astype(np.float64)
+        y = np.ravel(y).astype(np.float64)
+        xc,yc = self.centerline(x)
+        vsum = np.zeros(x.size)
+        if xc.size == 0:
+            return vsum.reshape(shape)
+        if cutoff is None:
+            self._accumulate(vsum,np.arange(x.size),x,y,xc,yc,None,block_elements)
+            return vsum.reshape(shape)
+        rmax = cutoff*self.rthick
+        tx = np.floor((x-x.min())/rmax).astype(np.int64)
+        ty = np.floor((y-y.min())/rmax).astype(np.int64)
+        tile  = ty*(tx.max()+1)+tx
+        order = np.argsort(tile,kind='stable')
+        tiles,starts = np.unique(tile[order],return_index=True)
+        ends  = np.append(starts[1:],x.size)
+        for i0,i1 in zip(starts,ends):
+            idx = order[i0:i1]
+            xi,yi = x[idx],y[idx]
+            near = (xc >= xi.min()-rmax) & (xc <= xi.max()+rmax) & (yc >= yi.min()-rmax) & (yc <= yi.max()+rmax)
+            if np.any(near):
+                self._accumulate(vsum,idx,x,y,xc[near],yc[near],rmax,block_elements)
+        return vsum.reshape(shape)
+
+    def _accumulate(self,vsum,idx,x,y,xc,yc,rmax,block_elements):
+        step = max(1,block_elements//xc.size)
+        for j0 in range(0,idx.size,step):
+            j  = idx[j0:j0+step]
+            dx = x[j,None]-xc[None,:]
+            dy = y[j,None]-yc[None,:]
+            r  = np.sqrt(dx*dx+dy*dy)
+            v  = np.exp(-r/self.rthick)
+            if rmax is not None:
+                v[r > rmax] = 0.0
+            vsum[j] += np.sum(v,axis=1)
+        return
+
+def track_fields(x,y,tracks,n_times,velocities,cutoff=10.0,normalize=True):
+    """Yield n_times fields of tracks moving at velocities, (dx,dy) per step.
+
+    The field of a step is the sum of the tracks' fields, each scaled to a
+    maximum of 1 if normalize.
+    """
+    for k in range(n_times):
+        field = np.zeros(np.shape(x))
+        for t,(u,v) in zip(tracks,velocities):
+            f = t.moved(k*u,k*v).evaluate(x,y,cutoff=cutoff)
+            if normalize:
+                fmax = np.max(f)
+                if fmax > 0:
+                    f /= fmax
+            field += f
+        yield field
+
+###########################################################################
+# A whole data set.
+
+def make_dataset(directory,start=dt.datetime(2005,12,15,3,0,0)
+                 ,goes_times=1,goes_interval_min=15,goes_shape=(500,800),bands=(3,4,5)
+                 ,merra2_days=1,merra2_shape=(361,576)
+                 ,modis_granules=0,modis_scans=203,modis_interval_min=5
+                 ,seed=0):
+    "Write a consistent set of synthetic files to directory. Returns the file names by kind."
+    os.makedirs(directory,exist_ok=True)
+    ret = {'goes':[],'merra2':[],'mod03':[],'mod05':[]}
+    if goes_times > 0:
+        latlon = goes_latlon(*goes_shape)
+        for k in range(goes_times):
+            t = start+dt.timedelta(minutes=k*goes_interval_min,seconds=15)
+            for band in bands:
+                ret['goes'].append(write_goes(directory,t,band,ny=goes_shape[0],nx=goes_shape[1],seed=seed+k,latlon=latlon))
+    for k in range(merra2_days):
+        ret['merra2'].append(write_merra2(directory,(start+dt.timedelta(days=k)).date()
+                                          ,nlat=merra2_shape[0],nlon=merra2_shape[1],seed=seed+k))
+    for k in range(modis_granules):
+        t = start+dt.timedelta(minutes=k*modis_interval_min)
+        # Successive granules continue down the orbit track.
+        mod03,mod05 = write_modis(directory,t,n_scans=modis_scans,seed=seed+k
+                                  ,lat0=-10.0+k*modis_scans*modis_scan_lines_1km/111.2)
+        ret['mod03'].append(mod03)
+        ret['mod05'].append(mod05)
+    return ret
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='geodata.synthetic',description='Write synthetic GOES, MERRA-2 and MODIS files.')
+    parser.add_argument('directory')
+    parser.add_argument('--start',default='2005-12-15T03:00:00',help='ISO time of the first GOES image and MODIS granule')
+    parser.add_argument('--goes-times',type=int,default=1)
+    parser.add_argument('--goes-shape',type=int,nargs=2,default=[500,800],metavar=('NY','NX'))
+    parser.add_argument('--bands',type=int,nargs='+',default=[3,4,5])
+    parser.add_argument('--merra2-days',type=int,default=1)
+    parser.add_argument('--merra2-shape',type=int,nargs=2,default=[361,576],metavar=('NLAT','NLON'))
+    parser.add_argument('--modis-granules',type=int,default=0)
+    parser.add_argument('--modis-scans',type=int,default=203,help='10 line scans per granule, 203 for a full granule')
+    parser.add_argument('--seed',type=int,default=0)
+    args = parser.parse_args(argv)
+    files = make_dataset(args.directory,start=dt.datetime.fromisoformat(args.start)
+                         ,goes_times=args.goes_times,goes_shape=tuple(args.goes_shape),bands=tuple(args.bands)
+                         ,merra2_days=args.merra2_days,merra2_shape=tuple(args.merra2_shape)
+                         ,modis_granules=args.modis_granules,modis_scans=args.modis_scans
+                         ,seed=args.seed)
+    for kind in files:
+        for fname in files[kind]:
+            print(os.path.join(args.directory,fname))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())